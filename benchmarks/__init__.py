@@ -0,0 +1,2 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
@@ -0,0 +1,49 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+# Benchmark a daemon with a long history of finished jobs, with and without
+# moving the old ones to the archive.
+# usage: python -m benchmarks.bench_archive [num_jobs] [keep_jobs]
+
+import sys
+import time
+import tracemalloc
+
+from pyqueue.daemon import CtlDaemon
+from pyqueue.jobs import CallableJob
+from pyqueue.utils import try_unpickle
+
+
+def run(num_jobs, keep_jobs):
+    tracemalloc.start()
+    daemon = CtlDaemon(keep_jobs=keep_jobs)
+    daemon.submit_jobs([CallableJob(abs, (-i,)) for i in range(num_jobs)])
+    t0 = time.perf_counter()
+    for _ in range(num_jobs):
+        daemon.job_finished(try_unpickle(daemon.try_acquire_job()).id, 0, None)
+    t_run = time.perf_counter() - t0
+    daemon.submit_jobs([CallableJob(abs, (-i,)) for i in range(100)])
+
+    t0 = time.perf_counter()
+    filter = {"me": False, "user": None, "job": None, "finished": False}
+    for _ in range(100):
+        daemon.squeue("me", dict(filter, status="pending"))
+    t_squeue = (time.perf_counter() - t0) / 100
+    mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    daemon.close()
+    return t_run / num_jobs, t_squeue, mem
+
+
+def main(num_jobs=50_000, keep_jobs=1000):
+    print(f"{num_jobs} finished jobs")
+    for name, keep in [("all in memory", num_jobs), (f"keep {keep_jobs}", keep_jobs)]:
+        t_job, t_squeue, mem = run(num_jobs, keep)
+        print(
+            f"{name:14s}: {t_job * 1e6:6.1f} us/job, squeue {t_squeue * 1e3:6.2f} ms,"
+            f" {mem / 2**20:6.1f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
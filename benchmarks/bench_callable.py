@@ -0,0 +1,56 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+# Benchmark the overhead per job of running trivial jobs: BashJobs forked by a
+# Worker and CallableJobs run in the warm pool of a PoolWorker. The daemon runs
+# in the same process, so only the cost of running a job is measured.
+# usage: python -m benchmarks.bench_callable [num_jobs] [slots]
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from pyqueue.daemon import CtlDaemon
+from pyqueue.jobs import BashJob, CallableJob
+from pyqueue.utils import try_unpickle
+from pyqueue.worker import PoolWorker, Worker
+
+
+def run_jobs(worker, jobs):
+    daemon = CtlDaemon()
+    worker.register_with_queue_server(daemon)
+    daemon.submit_jobs(jobs)
+    threading.Thread(target=worker._reap_forever, daemon=True).start()
+
+    t0 = time.perf_counter()
+    while daemon.get_num_pending_jobs() > 0:
+        with worker._jobs_changed:
+            worker._jobs_changed.wait_for(worker.has_free_slot)
+        worker.run_job(try_unpickle(daemon.try_acquire_job(worker_id=worker.id)))
+    with worker._jobs_changed:
+        worker._jobs_changed.wait_for(lambda: not worker.jobs)
+    dt = time.perf_counter() - t0
+    assert daemon.queue.count("finished") == len(jobs)
+    return dt
+
+
+def main(num_jobs=2000, slots=4):
+    print(f"{num_jobs} trivial jobs, {slots} slots")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        jobs = [BashJob("true") for _ in range(num_jobs)]
+        dt = run_jobs(Worker(slots=slots, cpus=slots), jobs)
+        print(f"BashJob:     {dt:6.2f}s, {dt / num_jobs * 1e6:8.1f} us/job")
+
+        worker = PoolWorker(slots=slots, cpus=slots)
+        worker.start_pool()
+        jobs = [CallableJob(abs, (-i,)) for i in range(num_jobs)]
+        dt = run_jobs(worker, jobs)
+        worker.close()
+        print(f"CallableJob: {dt:6.2f}s, {dt / num_jobs * 1e6:8.1f} us/job")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,60 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+# Benchmark scheduling pipelines of dependent jobs: a long chain, where each
+# job releases the next, and a fan-out/fan-in, where one job releases all jobs
+# of a stage and the last of them releases a final job.
+# usage: python -m benchmarks.bench_dag [num_jobs]
+
+import sys
+import tempfile
+import time
+
+from pyqueue.daemon import Queue
+from pyqueue.jobs import BashJob
+
+
+def make_chain(num_jobs, output_dir):
+    jobs = [BashJob("true", output_dir=output_dir) for _ in range(num_jobs)]
+    for parent, job in zip(jobs, jobs[1:]):
+        job.dependencies = [parent.id]
+    return jobs
+
+
+def make_fan(num_jobs, output_dir):
+    source, *stage, sink = [
+        BashJob("true", output_dir=output_dir) for _ in range(num_jobs)
+    ]
+    for job in stage:
+        job.dependencies = [source.id]
+    sink.dependencies = [job.id for job in stage]
+    return [source, *stage, sink]
+
+
+def bench(jobs):
+    """Seconds to submit and to run all jobs in the order they are released."""
+    queue = Queue()
+    t0 = time.perf_counter()
+    queue.extend(jobs)
+    t_submit = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    while len(queue) > 0:
+        queue.set_status(queue.next_job(), "finished")
+    t_run = time.perf_counter() - t0
+    assert queue.count("finished") == len(jobs)
+    return t_submit, t_run
+
+
+def main(num_jobs=50_000):
+    with tempfile.TemporaryDirectory() as output_dir:
+        for name, make in [("chain", make_chain), ("fan", make_fan)]:
+            t_submit, t_run = bench(make(num_jobs, output_dir))
+            print(
+                f"{name:5s} of {num_jobs} jobs: submit {t_submit / num_jobs * 1e6:6.2f} us/job,"
+                f" dispatch and finish {t_run / num_jobs * 1e6:6.2f} us/job"
+            )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,46 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+# Benchmark recovering a queue from a large journal.
+# usage: python -m benchmarks.bench_journal [num_records]
+
+import os
+import sys
+import tempfile
+import time
+
+from pyqueue.daemon import Queue
+from pyqueue.jobs import BashJob
+from pyqueue.journal import Journal
+
+
+def main(num_records=1_000_000):
+    num_jobs = num_records // 4  # every job is appended and updated three times
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "queue.journal")
+        journal = Journal(path, compact_every=float("inf"))
+        jobs = BashJob.array("echo {idx}", range(num_jobs), output_dir=tmp_dir)
+
+        t0 = time.perf_counter()
+        for job in jobs:
+            journal.log_append(job)
+        for status in ["submitted", "running", "finished"]:
+            for job in jobs:
+                journal.log_update(job.id, {"status": status})
+        journal.close()
+        t_write = time.perf_counter() - t0
+        size = os.path.getsize(path) / 1e6
+        print(f"wrote {num_records} records ({size:.0f} MB) in {t_write:.2f}s")
+
+        t0 = time.perf_counter()
+        queue = Queue.load(Journal(path))
+        print(f"replayed and compacted journal in {time.perf_counter() - t0:.2f}s")
+        assert queue.count("finished") == num_jobs
+
+        t0 = time.perf_counter()
+        queue = Queue.load(Journal(path))
+        print(f"restored from snapshot in {time.perf_counter() - t0:.2f}s")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,49 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+# Benchmark the memory the daemon needs per queued job: a job array is pickled
+# as it is sent by `submit_jobs`, unpickled and added to a queue.
+# usage: python -m benchmarks.bench_memory [num_jobs]
+
+import gc
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from pyqueue.daemon import Queue
+from pyqueue.jobs import BashJob
+
+
+def main(num_jobs=200_000):
+    with tempfile.TemporaryDirectory() as output_dir:
+        jobs = BashJob.array(
+            "python train.py --seed {idx}", range(num_jobs), output_dir=output_dir
+        )
+    for job in jobs:
+        job.owner = "me"
+    data = pickle.dumps(jobs, protocol=pickle.HIGHEST_PROTOCOL)
+    del jobs
+    print(f"{num_jobs} jobs, {len(data) / num_jobs:.1f} bytes/job pickled")
+
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    jobs = pickle.loads(data)
+    t_load = time.perf_counter() - t0
+    mem_jobs = tracemalloc.get_traced_memory()[0]
+    queue = Queue()
+    queue.extend(jobs)
+    del jobs
+    gc.collect()
+    mem_queue = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"jobs:         {mem_jobs / num_jobs:8.1f} bytes/job")
+    print(f"jobs + queue: {mem_queue / num_jobs:8.1f} bytes/job")
+    print(f"unpickling:   {t_load / num_jobs * 1e6:8.2f} us/job")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,60 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+# Benchmark dispatching jobs from a large queue.
+# usage: python -m benchmarks.bench_queue [num_jobs]
+
+import random
+import sys
+import tempfile
+import time
+
+from pyqueue.daemon import Queue
+from pyqueue.jobs import BashJob
+
+
+def fill_queue(num_jobs, output_dir):
+    queue = Queue()
+    for i in range(num_jobs):
+        job = BashJob(
+            f"echo {i}", priority=random.randint(0, 10), output_dir=output_dir
+        )
+        queue.append(job)
+    return queue
+
+
+def bench_dispatch(queue, num_dispatches):
+    t0 = time.perf_counter()
+    for _ in range(num_dispatches):
+        job = queue.next_job()
+        queue.set_status(job, "finished")
+    return (time.perf_counter() - t0) / num_dispatches
+
+
+def bench_len(queue, num_calls=1000):
+    t0 = time.perf_counter()
+    for _ in range(num_calls):
+        len(queue)
+    return (time.perf_counter() - t0) / num_calls
+
+
+def main(num_jobs=100_000):
+    with tempfile.TemporaryDirectory() as output_dir:
+        t0 = time.perf_counter()
+        queue = fill_queue(num_jobs, output_dir)
+        t_fill = time.perf_counter() - t0
+
+    print(f"queued {num_jobs} jobs in {t_fill:.2f}s")
+    print(f"len(queue):      {bench_len(queue) * 1e6:8.2f} us/call")
+    print(f"next_job (full): {bench_dispatch(queue, 1000) * 1e6:8.2f} us/job")
+
+    # dispatch and finish almost all jobs, the history stays in the queue
+    bench_dispatch(queue, num_jobs - 2000)
+    print(
+        f"next_job (with {queue.count('finished')} finished jobs in history): ", end=""
+    )
+    print(f"{bench_dispatch(queue, 1000) * 1e6:.2f} us/job")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,82 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+# Load test of the daemon RPC front-end: many concurrent clients send cheap
+# requests while one client keeps rendering a large squeue.
+# usage: python -m benchmarks.bench_rpc_load [num_clients] [calls_per_client]
+
+import sys
+import tempfile
+import threading
+import time
+import xmlrpc.client
+
+from pyqueue.daemon import StoppableServerThread
+from pyqueue.jobs import BashJob
+
+PORT = 8002
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def run_clients(num_clients, calls_per_client):
+    latencies, errors = [], []
+    stop = threading.Event()
+
+    def client():
+        server = xmlrpc.client.ServerProxy(f"http://localhost:{PORT}", allow_none=True)
+        for _ in range(calls_per_client):
+            t0 = time.perf_counter()
+            try:
+                server.get_num_pending_jobs()
+            except OSError as exception:
+                errors.append(exception)
+                continue
+            latencies.append(time.perf_counter() - t0)
+
+    def slow_client():
+        server = xmlrpc.client.ServerProxy(f"http://localhost:{PORT}", allow_none=True)
+        while not stop.is_set():
+            server.squeue("bench", {"me": False, "user": None, "job": None})
+
+    slow = threading.Thread(target=slow_client, daemon=True)
+    slow.start()
+    threads = [threading.Thread(target=client) for _ in range(num_clients)]
+    t0 = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    t_total = time.perf_counter() - t0
+    stop.set()
+    slow.join()
+    return latencies, errors, t_total
+
+
+def main(num_clients=200, calls_per_client=20):
+    for threaded in [False, True]:
+        thread = StoppableServerThread(port=PORT, threaded=threaded)
+        daemon = thread.server.instance
+        with tempfile.TemporaryDirectory() as output_dir:
+            for i in range(5000):
+                daemon.submit_job(BashJob(f"echo {i}", output_dir=output_dir))
+        thread.start()
+
+        latencies, errors, t_total = run_clients(num_clients, calls_per_client)
+        thread.stop()
+
+        mode = "threaded" if threaded else "single  "
+        print(
+            f"{mode}: {len(latencies) / t_total:8.0f} calls/s, "
+            f"p50 {percentile(latencies, 50) * 1e3:7.2f} ms, "
+            f"p99 {percentile(latencies, 99) * 1e3:7.2f} ms, "
+            f"{len(errors)} failed calls"
+        )
+        time.sleep(0.5)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,156 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+# Simulate the scheduling policies on a job trace and compare waiting times.
+# The trace is either a csv file with the columns
+# submit_time,owner,priority,runtime,cpus (seconds), the journal of a daemon
+# (runtimes of finished jobs as recorded), or generated: one user submits a
+# large batch of high priority jobs at once, the others submit a few jobs
+# over time.
+# usage: python -m benchmarks.bench_scheduler [trace.csv | journal] [workers] [cpus]
+
+import copy
+import csv
+import heapq
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from pyqueue.daemon import Queue
+from pyqueue.jobs import BashJob
+from pyqueue.journal import Journal
+from pyqueue.scheduler import (
+    AgingScheduler,
+    BackfillScheduler,
+    FairShareScheduler,
+    PriorityScheduler,
+)
+
+
+def generate_trace(num_jobs=20_000, num_users=5, seed=0):
+    rng = random.Random(seed)
+    trace = []
+    for _ in range(num_jobs * 7 // 10):
+        trace.append((0.0, "heavy", 5, rng.lognormvariate(3, 1), 1))
+    duration = num_jobs * 2.0  # light users keep submitting while heavy runs
+    for _ in range(num_jobs - len(trace)):
+        owner = f"user{rng.randrange(num_users)}"
+        cpus = rng.choice([1, 1, 1, 2, 4, 8])
+        trace.append(
+            (
+                rng.uniform(0, duration),
+                owner,
+                rng.randint(0, 3),
+                rng.lognormvariate(3, 1),
+                cpus,
+            )
+        )
+    return sorted(trace)
+
+
+def load_trace(path):
+    if path.endswith(".csv"):
+        with open(path) as f:
+            return sorted(
+                (float(t), owner, int(prio), float(runtime), int(cpus))
+                for t, owner, prio, runtime, cpus in csv.reader(f)
+            )
+    # journal of a daemon, only finished jobs have a known runtime
+    jobs = [job for job in Journal(path).replay() if job._end_time is not None]
+    t0 = min(job.created_at for job in jobs)
+    return sorted(
+        (
+            (job.created_at - t0).total_seconds(),
+            str(job.owner),
+            job.priority,
+            (job._end_time - job._start_time).total_seconds(),
+            job.cpus,
+        )
+        for job in jobs
+    )
+
+
+def simulate(trace, scheduler, num_workers, cpus_per_worker, output_dir):
+    now = [0.0]
+    queue = Queue(scheduler=scheduler)
+    free = [cpus_per_worker] * num_workers
+    running = []  # heap of (t_end, seq, worker, job)
+    waits = {}  # owner -> list of waiting times
+    submitted = {}  # id -> (submit time, runtime) of a job
+    t_dispatch, num_dispatch = 0.0, 0
+    template = BashJob("true", output_dir=output_dir)
+
+    i, seq = 0, 0
+    while i < len(trace) or running:
+        t_submit = trace[i][0] if i < len(trace) else float("inf")
+        t_finish = running[0][0] if running else float("inf")
+        now[0] = min(t_submit, t_finish)
+        while running and running[0][0] <= now[0]:
+            _, _, worker, job = heapq.heappop(running)
+            free[worker] += job.cpus
+            queue.set_status(job, "finished")
+        while i < len(trace) and trace[i][0] <= now[0]:
+            t, owner, priority, runtime, cpus = trace[i]
+            job = copy.copy(template)
+            job.id, job.owner, job.priority, job.cpus = str(i), owner, priority, cpus
+            job._created = t  # jobs age from their submission
+            submitted[job.id] = (t, runtime)
+            queue.append(job)
+            i += 1
+
+        for worker in range(num_workers):
+            while free[worker] > 0:
+                t0 = time.perf_counter()
+                try:
+                    job = queue.next_job({"cpus": free[worker]})
+                except IndexError:
+                    break
+                finally:
+                    t_dispatch += time.perf_counter() - t0
+                num_dispatch += 1
+                free[worker] -= job.cpus
+                t_queued, runtime = submitted.pop(job.id)
+                waits.setdefault(job.owner, []).append(now[0] - t_queued)
+                heapq.heappush(running, (now[0] + runtime, seq, worker, job))
+                seq += 1
+    return waits, now[0], t_dispatch / max(num_dispatch, 1)
+
+
+def percentile(values, p):
+    return sorted(values)[min(len(values) - 1, int(p * len(values)))]
+
+
+def main(trace=None, num_workers=16, cpus_per_worker=8):
+    trace = generate_trace() if trace is None else load_trace(trace)
+    num_workers, cpus_per_worker = int(num_workers), int(cpus_per_worker)
+    print(f"{len(trace)} jobs on {num_workers} workers with {cpus_per_worker} cpus")
+
+    policies = {
+        "priority": PriorityScheduler,
+        "aging": lambda: AgingScheduler(rate=1 / 60),
+        "fairshare": FairShareScheduler,
+        "backfill": BackfillScheduler,
+        "fairshare+backfill": lambda: FairShareScheduler(policy=BackfillScheduler),
+    }
+    print(
+        "policy; mean wait; p95 wait; max wait; mean wait (light users); makespan; dispatch"
+    )
+    with tempfile.TemporaryDirectory() as output_dir:
+        for name, policy in policies.items():
+            waits, makespan, t_dispatch = simulate(
+                trace, policy(), num_workers, cpus_per_worker, output_dir
+            )
+            all_waits = [w for owner_waits in waits.values() for w in owner_waits]
+            light = [w for owner, ws in waits.items() if owner != "heavy" for w in ws]
+            print(
+                f"{name}; {statistics.mean(all_waits):.0f}s; "
+                f"{percentile(all_waits, 0.95):.0f}s; {max(all_waits):.0f}s; "
+                f"{statistics.mean(light) if light else float('nan'):.0f}s; "
+                f"{makespan:.0f}s; {t_dispatch * 1e6:.1f} us/job"
+            )
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,63 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+# Benchmark how long squeue holds the daemon with a large queue, for the whole
+# queue, for the first page, as `pyqueue squeue` requests by default, and for
+# the changes `pyqueue squeue --watch` requests.
+# usage: python -m benchmarks.bench_squeue [num_jobs]
+
+import sys
+import tempfile
+import time
+
+from pyqueue.daemon import CtlDaemon
+from pyqueue.helpers import format_job_rows
+from pyqueue.jobs import BashJob
+
+
+def bench(daemon, filter, repeat=5, **kwargs):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        page = daemon.squeue("me", dict(filter), **kwargs)
+    return (time.perf_counter() - t0) / repeat, page
+
+
+def main(num_jobs=100_000):
+    daemon = CtlDaemon()
+    with tempfile.TemporaryDirectory() as output_dir:
+        for owner in range(10):
+            jobs = BashJob.array(
+                "echo {idx}", range(num_jobs // 10), output_dir=output_dir
+            )
+            for job in jobs:
+                job.owner = f"user{owner}"
+            daemon.submit_jobs(jobs)
+
+    print(f"squeue of {num_jobs} jobs:")
+    filter = {"me": False, "user": None, "job": None, "finished": False}
+    cases = [
+        ("all jobs", filter, {}),
+        ("first 1000", filter, {"limit": 1000}),
+        ("first 1000, -priority", filter, {"limit": 1000, "sort": "-priority"}),
+        ("first 1000 of user3", {**filter, "user": "user3"}, {"limit": 1000}),
+    ]
+    for name, filter, kwargs in cases:
+        dt, page = bench(daemon, filter, **kwargs)
+        t0 = time.perf_counter()
+        format_job_rows(page["jobs"])
+        t_format = time.perf_counter() - t0
+        print(f"{name:22s}: daemon {dt * 1e3:8.2f} ms, client {t_format * 1e3:8.2f} ms")
+
+    # what `squeue --watch` fetches per refresh, once 100 jobs have changed
+    seq = daemon.squeue("me", dict(filter), limit=0)["seq"]
+    for _ in range(100):
+        daemon.acquire_job()
+    t0 = time.perf_counter()
+    changes = daemon.get_changes(seq)
+    dt = time.perf_counter() - t0
+    print(f"{len(changes['jobs'])} changed jobs (--watch): daemon {dt * 1e3:8.2f} ms")
+    daemon.close()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,46 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+# Benchmark submitting many jobs to the daemon: one RPC per job, one bulk RPC,
+# and a job array that is expanded by the daemon.
+# usage: python -m benchmarks.bench_submit [num_jobs]
+
+import os
+import sys
+import tempfile
+import time
+import xmlrpc.client
+
+from pyqueue.daemon import StoppableServerThread
+from pyqueue.jobs import BashJob
+from pyqueue.utils import try_pickle
+
+PORT = 8002
+
+
+def main(num_jobs=5000):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        thread = StoppableServerThread(port=PORT)
+        thread.start()
+        server = xmlrpc.client.ServerProxy(f"http://localhost:{PORT}", allow_none=True)
+        jobs = [BashJob(f"echo {i}") for i in range(num_jobs)]
+
+        t0 = time.perf_counter()
+        for job in jobs:
+            server.submit_job(try_pickle(job))
+        print(f"submit_job:   {time.perf_counter() - t0:6.2f}s for {num_jobs} jobs")
+
+        t0 = time.perf_counter()
+        server.submit_jobs([try_pickle(job) for job in jobs])
+        print(f"submit_jobs:  {time.perf_counter() - t0:6.2f}s for {num_jobs} jobs")
+
+        t0 = time.perf_counter()
+        server.sbatch("echo {idx}", {"array": f"0-{num_jobs - 1}"})
+        print(f"sbatch array: {time.perf_counter() - t0:6.2f}s for {num_jobs} jobs")
+
+        thread.stop()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
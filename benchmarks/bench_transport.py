@@ -0,0 +1,74 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+# Compare the XML-RPC transport with the binary protocol, over TCP and unix
+# sockets: size of a submitted job on the wire and messages per second for
+# submitting and acquiring jobs.
+# usage: python -m benchmarks.bench_transport [num_jobs]
+
+import os
+import pickle
+import sys
+import tempfile
+import time
+import xmlrpc.client
+
+from pyqueue.daemon import StoppableServerThread
+from pyqueue.jobs import BashJob
+from pyqueue.transport import connect
+from pyqueue.utils import try_pickle, try_unpickle
+
+PORT = 8002
+
+
+def request_size(transport, job):
+    if transport == "pyq":
+        return len(pickle.dumps(("submit_job", (job,), {}), protocol=5))
+    return len(xmlrpc.client.dumps((try_pickle(job),), "submit_job"))
+
+
+def main(num_jobs=5000):
+    with tempfile.TemporaryDirectory() as output_dir:
+        jobs = [BashJob(f"echo {i}", output_dir=output_dir) for i in range(num_jobs)]
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "pyqueue.sock")
+    for transport, unix in [
+        ("http", False),
+        ("http", True),
+        ("pyq", False),
+        ("pyq", True),
+    ]:
+        thread = StoppableServerThread(
+            port=PORT,
+            threaded=True,
+            transport=transport,
+            socket_path=socket_path if unix else None,
+        )
+        thread.start()
+        if unix:
+            address = f"{transport}+unix://{socket_path}"
+        else:
+            address = f"{transport}://localhost:{PORT}"
+        server = connect(address)
+
+        t0 = time.perf_counter()
+        for job in jobs:
+            server.submit_job(try_pickle(job))
+        t_submit = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for _ in jobs:
+            try_unpickle(server.try_acquire_job())
+        t_acquire = time.perf_counter() - t0
+
+        thread.stop()
+        print(
+            f"{address.split(':')[0]:>9}: {request_size(transport, jobs[0]):5d} bytes/job, "
+            f"submit {num_jobs / t_submit:7.0f} msgs/s, "
+            f"acquire {num_jobs / t_acquire:7.0f} msgs/s"
+        )
+        time.sleep(0.5)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -2,20 +2,39 @@
 # under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
 
 from pyqueue.client import QueueClient, main
-from pyqueue.daemon import CtlDaemon, Queue, StoppableServer, StoppableServerThread
+from pyqueue.daemon import (
+    BinaryStoppableServer,
+    CtlDaemon,
+    Queue,
+    StoppableServer,
+    StoppableServerThread,
+    ThreadedStoppableServer,
+    make_server,
+)
 from pyqueue.helpers import (  # NEEDS REFACTOR! this module only exists to avoid cyclic imports with jobs.py and utils.py
     dt2dict,
+    parse_array,
     timedelta2dict,
     timedeltastr,
 )
-from pyqueue.jobs import BashJob, Job
+from pyqueue.jobs import BashJob, CallableJob, Job
+from pyqueue.scheduler import (
+    AgingScheduler,
+    BackfillScheduler,
+    FairShareScheduler,
+    PriorityScheduler,
+    Scheduler,
+    make_scheduler,
+)
+from pyqueue.transport import BinaryServer, BinaryServerProxy, connect
 from pyqueue.utils import (
     catch_connection_refused,
     check_pickle,
     fix_datetime,
     get_logger,
+    make_worker_id,
     try_pickle,
     try_unpickle,
     wait_until,
 )
-from pyqueue.worker import BaseWorker, Worker
+from pyqueue.worker import BaseWorker, PoolWorker, Worker
@@ -0,0 +1,120 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+
+# attributes of jobs that the archive can be queried and sorted by
+COLUMNS = ["id", "status", "owner", "name", "type", "array_id", "priority", "_created"]
+
+
+class Archive:
+    """Finished and failed jobs that were moved out of the queue, in SQLite.
+
+    Jobs are stored pickled, next to the columns they can be looked up by.
+    Without a `path`, the archive is kept in a temporary file that is created
+    when the first jobs are archived and removed on close.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._tmp_dir = None
+        self._db = None
+        if path is not None:
+            self._connect()
+
+    def _connect(self):
+        if self.path is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix="pyqueue_archive_")
+            self.path = os.path.join(self._tmp_dir, "archive.db")
+        # the daemon serializes all access to the queue, also across threads
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT,"
+            " owner TEXT, name TEXT, type TEXT, array_id TEXT, priority INTEGER,"
+            " _created REAL, job BLOB)"
+        )
+        for column in ["status", "owner", "name", "type", "array_id"]:
+            self._db.execute(
+                f"CREATE INDEX IF NOT EXISTS jobs_{column} ON jobs ({column})"
+            )
+        self._db.commit()
+
+    def add(self, jobs):
+        """Archive jobs in one transaction, replaces jobs with the same id."""
+        rows = [
+            (
+                *[getattr(job, column, None) for column in COLUMNS],
+                pickle.dumps(job, protocol=pickle.HIGHEST_PROTOCOL),
+            )
+            for job in jobs
+        ]
+        if self._db is None:
+            self._connect()
+        with self._db:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO jobs VALUES ({', '.join('?' * 9)})", rows
+            )
+
+    def _select(self, what, filter, order=None, reverse=False, offset=0, limit=None):
+        """Rows of `what` of the jobs with the values in `filter`.
+
+        Rows are sorted by the column `order` (jobs without a value as if their
+        value was the largest), or in the order the jobs were archived.
+        """
+        unknown = set(filter) - set(COLUMNS)
+        if unknown or order not in [None, *COLUMNS]:
+            raise ValueError(f"The archive has no column {order or sorted(unknown)}")
+        if self._db is None:
+            return []
+        where = " AND ".join(f"{column} = ?" for column in filter) or "1"
+        direction = "DESC" if reverse else "ASC"
+        order = f"{order} IS NULL {direction}, {order} {direction}, " if order else ""
+        return self._db.execute(
+            f"SELECT {what} FROM jobs WHERE {where} ORDER BY {order}rowid"
+            " LIMIT ? OFFSET ?",
+            [*filter.values(), -1 if limit is None else limit, offset],
+        ).fetchall()
+
+    def query(self, filter={}, sort=None, offset=0, limit=None):
+        """Jobs with the attribute values in `filter`, i.e. {"owner": "me"}.
+
+        `sort` is the attribute to sort by, prefixed by "-" for descending.
+        """
+        order = None if sort is None else sort.lstrip("-")
+        reverse = sort is not None and sort.startswith("-")
+        rows = self._select("job", filter, order, reverse, offset, limit)
+        return [pickle.loads(row[0]) for row in rows]
+
+    def count(self, filter={}):
+        rows = self._select("COUNT(*)", filter)
+        return rows[0][0] if rows else 0
+
+    def ids(self, filter={}):
+        return [row[0] for row in self._select("id", filter)]
+
+    def get(self, id):
+        """The archived job `id`, None if there is none."""
+        jobs = self.query({"id": id})
+        return jobs[0] if jobs else None
+
+    def status(self, id):
+        rows = self._select("status", {"id": id})
+        return rows[0][0] if rows else None
+
+    def __contains__(self, id):
+        return self.status(id) is not None
+
+    def __len__(self):
+        return self.count()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
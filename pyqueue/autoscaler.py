@@ -0,0 +1,161 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import psutil
+
+from pyqueue.utils import get_logger, make_worker_id
+
+log = get_logger("AUTOSCALER")
+
+
+class Autoscaler(threading.Thread):
+    """Starts and stops the worker processes of a CtlDaemon depending on its load.
+
+    Every `interval` seconds:
+    - At least `min_workers` workers are kept running.
+    - If there are more pending jobs than free slots and the oldest pending
+      job has waited for `scale_up_delay` seconds, workers are started for the
+      jobs that can not run, up to `max_workers`. This only happens while the
+      cpu load of the host is below `max_load` percent.
+    - Workers that have been idle for `scale_down_delay` seconds while no
+      job is pending are stopped.
+
+    The delays keep the number of workers from oscillating with short bursts
+    of jobs. Only workers started by the autoscaler are stopped.
+
+    Every started worker gets `cpus` cpus and `mem` MB of memory. By default,
+    the machine is split evenly between `max_workers` workers, so that the
+    daemon does not hand out more resources than the host has.
+    """
+
+    def __init__(
+        self,
+        daemon,
+        address,
+        min_workers=0,
+        max_workers=4,
+        slots=1,
+        cpus=None,
+        mem=None,
+        interval=1.0,
+        scale_up_delay=2.0,
+        scale_down_delay=30.0,
+        max_load=90.0,
+        clock=time.time,
+        load=psutil.cpu_percent,
+    ):
+        super().__init__(daemon=True)
+        self.ctl_daemon = daemon
+        self.address = address  # where the started workers connect to
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.slots = slots  # slots of every started worker
+        share = max(max_workers, 1)
+        self.cpus = max(psutil.cpu_count() // share, 1) if cpus is None else cpus
+        if mem is None:
+            mem = psutil.virtual_memory().total // 2**20 // share
+        self.mem = mem  # in MB
+        self.interval = interval
+        self.scale_up_delay = scale_up_delay
+        self.scale_down_delay = scale_down_delay
+        self.max_load = max_load
+        self.clock = clock
+        self.load = load  # returns the cpu load of the host in percent
+        self.processes = {}  # worker id -> Popen of the started workers
+        self._idle_since = {}  # worker id -> time since which a started worker is idle
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.scale()
+            except Exception:
+                log.exception("Could not scale the workers")
+
+    def scale(self):
+        """Start or stop workers once, depending on the current load."""
+        now = self.clock()
+        self._reap()
+        stats = self.ctl_daemon.get_scaling_stats()
+        num_workers = len(self.processes)
+        # started workers that did not register yet will take jobs soon
+        starting = [
+            worker_id
+            for worker_id in self.processes
+            if worker_id not in stats["workers"]
+        ]
+        backlog = stats["pending"] - stats["free_slots"] - len(starting) * self.slots
+
+        if num_workers < self.min_workers:
+            self.start_workers(self.min_workers - num_workers)
+        elif (
+            backlog > 0
+            and num_workers < self.max_workers
+            and stats["backlog_age"] >= self.scale_up_delay
+            and self.load() < self.max_load
+        ):
+            needed = math.ceil(backlog / self.slots)
+            self.start_workers(min(needed, self.max_workers - num_workers))
+
+        for worker_id in self.processes:
+            if stats["workers"].get(worker_id) == "idle":
+                self._idle_since.setdefault(worker_id, now)
+            else:
+                self._idle_since.pop(worker_id, None)
+        if stats["pending"] > 0:
+            return
+        for worker_id, t_idle in list(self._idle_since.items()):
+            if len(self.processes) <= self.min_workers:
+                break
+            if now - t_idle >= self.scale_down_delay:
+                self.stop_worker(worker_id)
+
+    def worker_command(self):
+        """Command that starts a worker with the resources of every started one."""
+        cmd = [sys.executable, "-m", "pyqueue.worker"]
+        cmd += ["--slots", str(self.slots), "--idle-timeout", "-1"]
+        return cmd + ["--cpus", str(self.cpus), "--mem", str(self.mem)]
+
+    def start_workers(self, num):
+        cmd = self.worker_command()
+        env = dict(os.environ, PYQUEUE_ADDRESS=self.address)
+        for _ in range(num):
+            process = subprocess.Popen(
+                cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            self.processes[make_worker_id(process.pid)] = process
+        log.info(f"Started {num} workers, {len(self.processes)} are running")
+
+    def stop_worker(self, worker_id):
+        """Stop a started worker, unless it got a job in the meantime."""
+        if not self.ctl_daemon.retire_idle_worker(worker_id):
+            return
+        process = self.processes.pop(worker_id)
+        self._idle_since.pop(worker_id, None)
+        process.terminate()
+        process.wait()
+        log.info(f"Stopped worker [ID:{worker_id}], {len(self.processes)} are running")
+
+    def _reap(self):
+        for worker_id, process in list(self.processes.items()):
+            if process.poll() is not None:
+                log.warning(f"Worker [ID:{worker_id}] exited with {process.returncode}")
+                self.processes.pop(worker_id)
+                self._idle_since.pop(worker_id, None)
+                self.ctl_daemon.retire_idle_worker(worker_id, force=True)
+
+    def stop(self):
+        """Stop scaling and all started workers."""
+        self._stopped.set()
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.wait()
+        self.processes = {}
@@ -5,28 +5,33 @@ import argparse
 import datetime
 import getpass
 import os
+import pickle
 import sys
-import xmlrpc.client
+import time
 
-import psutil
-
-from pyqueue.daemon import StoppableServer
+from pyqueue.daemon import SORT_KEYS, make_server
+from pyqueue.helpers import format_job_rows, format_stats, parse_mem
+from pyqueue.results import to_bytes
+from pyqueue.scheduler import SCHEDULERS
+from pyqueue.transport import DEFAULT_ADDRESS, connect, get_token, parse_address
 from pyqueue.utils import catch_connection_refused, get_logger, is_up, wait_until
-from pyqueue.worker import Worker
+from pyqueue.worker import PoolWorker, Worker
 
 log = get_logger("CLIENT")
 
 
 class QueueClient(object):
-    def __init__(self, server):
+    def __init__(self, server, address=DEFAULT_ADDRESS):
         parser = argparse.ArgumentParser(
             description="Client to interact with the job queue server.",
             usage="""pyqueue <command> [<args>]
         
         sinfo: Show current system and queue status.
         squeue: Show submitted jobs.
+        sstats: Show the queue wait, dispatch latency and runtime of jobs.
         sbatch: Submit batch job.
         scancel: Cancel batch job.
+        sresult: Show the result of a job.
 
         start: Start the queue daemon or a worker process
         stop: Stops the queue daemon or a worker process
@@ -35,7 +40,7 @@ class QueueClient(object):
         parser.add_argument(
             "command",
             nargs="?",
-            help="Subcommand to run. [sinfo, squeue, sbatch, scancel, start, stop]",
+            help="Subcommand to run. [sinfo, squeue, sstats, sbatch, scancel, sresult, start, stop]",
         )
         parser.add_argument(
             "-v",
@@ -60,6 +65,7 @@ class QueueClient(object):
             exit(1)
         # use dispatch pattern to invoke method with same name
         self.server = server
+        self.address = address
         self.user, self.timestamp, self.pid = self.get_client_info()
         self.deamon_thread = None
 
@@ -94,14 +100,137 @@ class QueueClient(object):
             "--finished",
             action="store_true",
             default=False,
-            help="also show jobs that have already finished",
+            help="also show jobs that have already finished, also those in the archive",
+        )
+        parser.add_argument(
+            "--sort",
+            choices=[f"{sign}{key}" for key in SORT_KEYS for sign in ["", "-"]],
+            help="sort jobs by this column, descending if prefixed by -",
+        )
+        parser.add_argument(
+            "--limit", default=1000, type=int, help="show at most this many jobs"
+        )
+        parser.add_argument(
+            "--offset", default=0, type=int, help="skip this many jobs, for paging"
+        )
+        parser.add_argument(
+            "-w",
+            "--watch",
+            nargs="?",
+            const=1.0,
+            type=float,
+            help="refresh every this many seconds (default 1), only fetching the jobs that changed",
         )
         # now that we're inside a subcommand, ignore the first TWO argvs
         args = parser.parse_args(sys.argv[2:])
+        filter = dict(args.__dict__)
+        limit, offset, sort = (
+            filter.pop("limit"),
+            filter.pop("offset"),
+            filter.pop("sort"),
+        )
+        filter.pop("watch")
 
         _, user_name, _ = self.get_client_info()
 
-        print(self.server.squeue(user_name, args.__dict__))
+        if args.watch is not None:
+            self._watch(user_name, filter, limit, offset, sort, args.watch)
+            return
+        page = self.server.squeue(user_name, filter, limit, offset, sort)
+        print(format_job_rows(page["jobs"], offset))
+        if page["jobs"] and (offset > 0 or len(page["jobs"]) < page["total"]):
+            last = offset + len(page["jobs"]) - 1
+            print(
+                f"Showing jobs {offset} to {last} of {page['total']}, see --offset and --limit."
+            )
+
+    def _watch(self, user_name, filter, limit, offset, sort, interval):
+        """Show the queue until interrupted, fetching only the jobs that changed."""
+        match = {
+            "owner": user_name if filter["me"] else filter["user"],
+            "id": filter["job"],
+            "name": filter["name"],
+            "type": filter["type"],
+            "status": filter["status"],
+        }
+        match = {k: v for k, v in match.items() if v is not None}
+        column = (sort or "submitted").lstrip("-")
+        key = lambda row: (row[column] is None, row[column])
+        rows, seq = {}, None
+        try:
+            while True:
+                changes = None if seq is None else self.server.get_changes(seq)
+                if changes is None or changes["reset"]:
+                    page = self.server.squeue(user_name, dict(filter), None, 0, sort)
+                    rows = {row["id"]: row for row in page["jobs"]}
+                    seq = page["seq"]
+                else:
+                    seq = changes["seq"]
+                    for id in changes["removed"]:
+                        rows.pop(id, None)
+                    for row in changes["jobs"]:
+                        if (filter["finished"] or row["status"] != "finished") and all(
+                            row[k] == v for k, v in match.items()
+                        ):
+                            rows[row["id"]] = row
+                        else:
+                            rows.pop(row["id"], None)
+                shown = sorted(
+                    rows.values(), key=key, reverse=bool(sort and sort[0] == "-")
+                )
+                print("\033[H\033[J", end="")  # clear the terminal
+                print(format_job_rows(shown[offset : offset + limit], offset))
+                print(f"{len(rows)} jobs, refreshed every {interval}s, ctrl+c to stop.")
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+    def sstats(self):
+        parser = argparse.ArgumentParser(
+            description="Show percentiles of the queue wait, dispatch latency and"
+            " runtime of the jobs since the daemon was started."
+        )
+        parser.add_argument(
+            "-b",
+            "--by",
+            action="append",
+            default=[],
+            choices=["owner", "type"],
+            help="group the jobs by owner or type, can be given twice",
+        )
+        args = parser.parse_args(sys.argv[2:])
+
+        print(format_stats(self.server.get_stats(args.by)))
+
+    def sresult(self):
+        parser = argparse.ArgumentParser(
+            description="Show the result of a job, i.e. the output of a BashJob."
+        )
+        parser.add_argument("id", help="id of the job")
+        parser.add_argument(
+            "-o", "--output", help="write the result to this file instead of stdout"
+        )
+        args = parser.parse_args(sys.argv[2:])
+
+        info = self.server.get_result_info(args.id)
+        if info is None:
+            print(f"There is no result for job {args.id}.")
+            return
+        # downloaded chunk by chunk, large results do not fit into one message
+        chunks = (
+            to_bytes(self.server.get_result(args.id, index))
+            for index in range(info["chunks"])
+        )
+        if info["type"] == "CallableJob" and args.output is None:
+            print(repr(pickle.loads(b"".join(chunks))))  # the return value
+        elif args.output is None:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+        else:
+            with open(args.output, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
 
     def register_worker(self):
         parser = argparse.ArgumentParser(
@@ -138,13 +267,45 @@ class QueueClient(object):
         parser = argparse.ArgumentParser(description="submit job")
         parser.add_argument("input")
         parser.add_argument("-p", "--priority")
+        parser.add_argument(
+            "-a",
+            "--array",
+            help="submit a job array, i.e. 0-9 or 1,3,5. {idx} in input is replaced by the index",
+        )
+        parser.add_argument("-c", "--cpus", help="number of cpus the job needs")
+        parser.add_argument(
+            "--mem", help="memory the job needs, i.e. 512M or 4G (default unit: MB)"
+        )
+        parser.add_argument(
+            "-r", "--retries", help="rerun the job up to this many times if it fails"
+        )
+        parser.add_argument(
+            "--retry-delay",
+            help="seconds before the first retry, doubled for every further retry",
+        )
+        parser.add_argument(
+            "-d",
+            "--dependency",
+            help="run the job after other jobs have finished, i.e. afterok:<id>:<id>",
+        )
         args = parser.parse_args(sys.argv[2:])
 
         kwargs = {
             k: v for k, v in zip(["owner", "timestamp", "pid"], self.get_client_info())
         }
+        kwargs.update(
+            {
+                "priority": args.priority,
+                "array": args.array,
+                "retries": args.retries,
+                "retry_delay": args.retry_delay,
+                "cpus": args.cpus,
+                "mem": args.mem,
+                "dependency": args.dependency,
+            }
+        )
 
-        self.server.sbatch(args.input, kwargs)
+        print(f"Submitted batch job {self.server.sbatch(args.input, kwargs)}")
 
     def scancel(self):
         parser = argparse.ArgumentParser(description="cancel job")
@@ -201,19 +362,159 @@ class QueueClient(object):
             default=False,
             help="quick start daemon with flag argument",
         )
+        parser.add_argument(
+            "--threaded",
+            action="store_true",
+            default=False,
+            help="let the daemon handle every request in its own thread",
+        )
+        parser.add_argument(
+            "--journal",
+            help="file in which the daemon keeps its jobs, so they can be restored after a restart",
+        )
+        parser.add_argument(
+            "--slots",
+            default=1,
+            type=int,
+            help="number of jobs a worker runs at the same time",
+        )
+        parser.add_argument(
+            "--cpus",
+            type=int,
+            help="number of cpus the jobs of a worker may use, defaults to all. "
+            "With --max-workers, those of every started worker, defaults to an "
+            "even share of the machine",
+        )
+        parser.add_argument(
+            "--mem",
+            help="memory the jobs of a worker may use, i.e. 16G, defaults to all. "
+            "With --max-workers, that of every started worker, defaults to an "
+            "even share of the machine",
+        )
+        parser.add_argument(
+            "--pool",
+            action="store_true",
+            default=False,
+            help="let the worker run CallableJobs in a pool of warm processes",
+        )
+        parser.add_argument(
+            "--preload",
+            default="",
+            help="comma separated modules the pool of the worker imports up front",
+        )
+        parser.add_argument(
+            "--max-workers",
+            type=int,
+            help="let the daemon start and stop up to this many workers with --slots each, depending on the load",
+        )
+        parser.add_argument(
+            "--min-workers",
+            default=0,
+            type=int,
+            help="number of workers the daemon keeps running if --max-workers is given",
+        )
+        parser.add_argument(
+            "--scale-up-delay",
+            default=2.0,
+            type=float,
+            help="seconds the oldest pending job waits before workers are started",
+        )
+        parser.add_argument(
+            "--scale-down-delay",
+            default=30.0,
+            type=float,
+            help="seconds a started worker is idle before it is stopped",
+        )
+        parser.add_argument(
+            "--max-load",
+            default=90.0,
+            type=float,
+            help="cpu load of the host in percent above which no workers are started",
+        )
+        parser.add_argument(
+            "--scheduler",
+            default="priority",
+            choices=list(SCHEDULERS),
+            help="policy by which the daemon picks the next job",
+        )
+        parser.add_argument(
+            "--lease-timeout",
+            default=30,
+            type=float,
+            help="seconds without heartbeat until the jobs of a worker are requeued",
+        )
+        parser.add_argument(
+            "--result-dir",
+            help="directory the daemon keeps large results of jobs in, they are "
+            "kept across restarts. Defaults to a temporary directory",
+        )
+        parser.add_argument(
+            "--archive",
+            help="SQLite file the daemon moves old finished and failed jobs to. "
+            "Defaults to <journal>.archive with --journal, else a temporary file",
+        )
+        parser.add_argument(
+            "--keep-jobs",
+            default=10_000,
+            type=int,
+            help="number of finished and failed jobs the daemon keeps in memory",
+        )
+        parser.add_argument(
+            "--keep-hours",
+            type=float,
+            help="archive finished and failed jobs after this many hours",
+        )
+        parser.add_argument(
+            "--bind",
+            help="interface the daemon listens on, i.e. 0.0.0.0 to accept workers "
+            "of other hosts, defaults to the host of PYQUEUE_ADDRESS. WARNING: the "
+            "daemon unpickles what it is sent, so anyone who can connect to it can "
+            "run code as your user. Other interfaces than localhost therefore "
+            "require a shared secret in PYQUEUE_TOKEN, which the workers and "
+            "clients have to set as well. Only bind to trusted networks",
+        )
         args = parser.parse_args(sys.argv[2:])
         if args.service is None and not (args.worker or args.daemon):
             parser.print_help()
         if "daemon" == args.service or args.daemon:
             if not is_up(self.server):
-                daemon = StoppableServer()
+                transport, address = parse_address(self.address)
+                unix = isinstance(address, str)
+                daemon = make_server(
+                    port=None if unix else address[1],
+                    threaded=args.threaded,
+                    transport=transport,
+                    socket_path=address if unix else None,
+                    host=args.bind or (None if unix else address[0]),
+                    token=get_token(),
+                    journal_path=args.journal,
+                    scheduler=args.scheduler,
+                    lease_timeout=args.lease_timeout,
+                    result_dir=args.result_dir,
+                    archive_path=args.archive,
+                    keep_jobs=args.keep_jobs,
+                    keep_hours=args.keep_hours,
+                )
                 pid = os.fork()
                 if pid > 0:
                     if wait_until(is_up, server=self.server):
-                        print(f"A pyqueue daemon is listening on localhost:{8000}.")
+                        print(f"A pyqueue daemon is listening on {self.address}.")
                     else:
                         raise ConnectionRefusedError(f"Could not connect to daemon.")
                 else:
+                    daemon.instance.start_reaper()
+                    if args.max_workers:
+                        daemon.instance.start_autoscaler(
+                            self.address,
+                            min_workers=args.min_workers,
+                            max_workers=args.max_workers,
+                            slots=args.slots,
+                            cpus=args.cpus,
+                            mem=None if args.mem is None else parse_mem(args.mem),
+                            scale_up_delay=args.scale_up_delay,
+                            scale_down_delay=args.scale_down_delay,
+                            max_load=args.max_load,
+                        )
                     daemon.serve_forever()
 
         if "worker" == args.service or args.worker:
@@ -222,7 +523,16 @@ class QueueClient(object):
                 if pid > 0:
                     pass
                 else:
-                    worker = Worker()
+                    kwargs = {}
+                    if args.pool:
+                        kwargs["preload"] = [m for m in args.preload.split(",") if m]
+                    worker = (PoolWorker if args.pool else Worker)(
+                        slots=args.slots,
+                        address=self.address,
+                        cpus=args.cpus,
+                        mem=None if args.mem is None else parse_mem(args.mem),
+                        **kwargs,
+                    )
                     worker.register_with_queue_server(self.server)
                     print(f"Spawning a worker process with pid: {worker.pid}")
                     worker.start()
@@ -258,8 +568,7 @@ class QueueClient(object):
         parser.add_argument(
             "-i",
             "--id",
-            type=int,
-            help="process id of the worker in question.",
+            help="id of the worker in question, i.e. <host>:<pid>.",
         )
         parser.add_argument(
             "-w",
@@ -283,8 +592,14 @@ class QueueClient(object):
             help="stop all running workers and daemons",
         )
 
+        def shutdown():
+            try:
+                self.server.shutdown()
+            except ConnectionResetError:
+                pass  # the daemon exits before it can answer
+
         def try_daemon_shutdown():
-            if catch_connection_refused(self.server.shutdown):
+            if catch_connection_refused(shutdown):
                 print("Shutting down pyqueue daemon. This can take a few seconds.")
 
         args = parser.parse_args(sys.argv[2:])
@@ -321,12 +636,15 @@ class QueueClient(object):
                         print(
                             f"The worker you are trying to kill is still listed as busy. To stop the service use --force."
                         )
-                    if wait_until(lambda: not psutil.pid_exists(args.id), timeout=1):
+                    # remote workers stop with their next heartbeat
+                    if wait_until(
+                        lambda: not self.server.is_worker(args.id), timeout=10
+                    ):
                         print("The worker was successfully killed.")
                     else:
                         print("The worker could not be killed.")
                 else:
-                    print(f"There is currently no worker with pid {args.pid}")
+                    print(f"There is currently no worker with id {args.id}")
             except ConnectionRefusedError:
                 print("No daemon seems to be active.")
         if (
@@ -341,8 +659,9 @@ class QueueClient(object):
 
 
 def main():
-    server = xmlrpc.client.ServerProxy("http://localhost:8000", allow_none=True)
-    QueueClient(server)
+    address = os.environ.get("PYQUEUE_ADDRESS", DEFAULT_ADDRESS)
+    server = connect(address)
+    QueueClient(server, address)
     sys.exit(0)
 
 
@@ -1,33 +1,177 @@
 # This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
 # under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
 
+import functools
+import heapq
+import itertools
 import logging
 import signal
+import socket
 import sys
 import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from socketserver import ThreadingMixIn
 from typing import List
 from xmlrpc.client import DateTime as XMLRPCDateTime
 from xmlrpc.server import SimpleXMLRPCServer
 
-from pyqueue.helpers import dt2dict, timedeltastr
+from pyqueue.archive import Archive
+from pyqueue.autoscaler import Autoscaler
+from pyqueue.helpers import (
+    dt2dict,
+    parse_array,
+    parse_dependency,
+    parse_mem,
+    timedeltastr,
+)
 from pyqueue.jobs import *
+from pyqueue.journal import Journal
+from pyqueue.metrics import Metrics
+from pyqueue.results import CHUNK_SIZE, ResultStore, to_bytes
+from pyqueue.scheduler import (
+    SCHEDULING_ATTRS,
+    PriorityScheduler,
+    Scheduler,
+    WorkerIndex,
+    demand,
+    make_scheduler,
+)
+from pyqueue.transport import (
+    TOKEN_ENV,
+    BinaryServer,
+    KeepAliveXMLRPCRequestHandler,
+    UnixSocketMixin,
+    XMLRPCRequestHandler,
+    is_loopback,
+)
 from pyqueue.utils import check_pickle, fix_datetime, get_logger, try_unpickle
 
 log = get_logger("DAEMON")
 
 
+def synchronized(method):
+    """Run a CtlDaemon method while holding the daemon lock."""
+
+    @functools.wraps(method)
+    def wrapped_method(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapped_method
+
+
+# attributes Queue.query may sort jobs by, and the attribute each one sorts by
+SORT_KEYS = {
+    "id": "id",
+    "type": "type",
+    "name": "name",
+    "status": "status",
+    "owner": "owner",
+    "priority": "priority",
+    "submitted": "_created",
+}
+
+
+def sort_key(sort):
+    """Attribute, key function and direction of a sort order, i.e. "-priority"."""
+    attr = SORT_KEYS[sort.lstrip("-")]
+
+    def key(job):
+        value = getattr(job, attr)
+        return value is None, value  # jobs without a value last
+
+    return attr, key, sort.startswith("-")
+
+
 class Queue:
-    def __init__(self, jobs: List[Job] = None):
-        self.jobs = [] if jobs is None else jobs
+    """Collection of all jobs known to the daemon.
+
+    Jobs are stored in a map by id (in submission order). Besides that, the
+    queue keeps an index of jobs by status and passes pending jobs to a
+    scheduler (by default by priority, FIFO among equal priorities, see
+    pyqueue.scheduler), so that looking up and dispatching a job does not
+    depend on the size of the job history. Jobs are indexed by owner, name and
+    type as well, so that `query` only looks at the jobs it may return. Changes
+    to jobs should therefore go through `set_status` and `update`.
+
+    Failed jobs that wait for a retry ("retrying") are kept in a heap ordered
+    by the time they are due, and are moved back to pending by
+    `release_due_jobs`.
+
+    Jobs with dependencies are "blocked" until all of them have finished. The
+    queue keeps the dependency graph as a map from each job to the blocked
+    jobs that wait for it and a counter of unfinished dependencies per blocked
+    job, so that a finished job releases its dependents in O(out-degree). The
+    dependents of a failed or cancelled job can never run and fail as well.
+
+    If an archive is given, `archive_old_jobs` moves finished and failed jobs
+    to it, except for the latest `keep_jobs` of them and those that ended
+    within the last `keep_seconds`, so the memory of the daemon is bounded.
+    Archived jobs can still be looked up by `get_job`.
+
+    If a journal is given, every change is recorded in it, so that the queue
+    can be restored with `Queue.load` after the daemon was killed. The ids of
+    the last `max_changes` changed jobs are kept in a feed as well, numbered by
+    `change_seq`, so that clients can follow the queue with `changes_since`.
+    """
+
+    def __init__(
+        self,
+        jobs: List[Job] = None,
+        journal: Journal = None,
+        scheduler: Scheduler = None,
+        archive: Archive = None,
+        keep_jobs: int = 10_000,
+        keep_seconds: float = None,
+        archive_batch: int = 100,
+        max_changes: int = 100_000,
+    ):
+        self._jobs = {}  # id -> job
+        self._by_status = defaultdict(dict)  # status -> {id: job}
+        self._indexes = {attr: {} for attr in ["owner", "name", "type", "array_id"]}
+        self.scheduler = PriorityScheduler() if scheduler is None else scheduler
+        self._retry_heap = []  # entries (_retry_at, seq, job)
+        self._retry_seq = {}  # id -> seq of the valid heap entry of a retrying job
+        self._dependents = defaultdict(list)  # id -> ids of jobs blocked by it
+        self._indegree = {}  # id of a blocked job -> number of unfinished dependencies
+        self._ended = OrderedDict()  # id of a finished or failed job -> time.time()
+        # id of a pending or submitted job -> time.time() it last became pending
+        self._pending_since = {}
+        self.archive = archive
+        self.keep_jobs = keep_jobs
+        self.keep_seconds = keep_seconds
+        self.archive_batch = archive_batch  # jobs archived at least at once
+        self._seq = itertools.count()
+        self.change_seq = 0  # number of the last change
+        self._changes = deque(maxlen=max_changes)  # entries (change_seq, id)
+        self.journal = None
+        for job in [] if jobs is None else jobs:
+            self.append(job)
+        self.journal = journal
+
+    @property
+    def jobs(self):
+        return list(self._jobs.values())
 
     def get_jobs(self, status="any"):
         if status == "any" or status == "all":
             return self.jobs
         else:
-            return [job for job in self.jobs if job.status == status]
+            return list(self._by_status[status].values())
 
     def get_dict(self):
-        return {j.id: j for j in self.jobs}
+        return self._jobs
+
+    def get_job(self, id):
+        """A job in the queue or in the archive, raises KeyError if there is none."""
+        job = self._jobs.get(id)
+        if job is None and self.archive is not None:
+            job = self.archive.get(id)
+        if job is None:
+            raise KeyError(id)
+        return job
 
     def get_pending_jobs(self):
         return self.get_jobs("pending")
@@ -35,77 +179,489 @@ class Queue:
     def get_running_jobs(self):
         return self.get_jobs("running")
 
-    # def dump(self, path):
-    #     pass
+    def count(self, status):
+        return len(self._by_status[status])
 
-    # def load(self, path):
-    #     pass
+    def set_status(self, job, status):
+        self._set_status(job, status)
+        self._log("update", job.id, {"status": status})
 
-    def next_job(self):
-        pending_jobs = self.get_pending_jobs()
-        pending_jobs = sorted(pending_jobs, key=lambda x: x.priority, reverse=True)
-        job = pending_jobs.pop(0)
-        job.status = "submitted"
+    def update(self, id, attrs):
+        """Set attributes of a job, i.e. {"status": "running", "pid": 123}."""
+        job = self._jobs[id]
+        reindex = any(key in self._indexes for key in attrs)
+        if reindex:
+            self._unindex(job)
+        # the scheduler finds pending jobs by these attributes, i.e. their owner
+        reschedule = job.status == "pending" and any(
+            key in SCHEDULING_ATTRS for key in attrs
+        )
+        if reschedule:
+            self.scheduler.remove(job)
+        for key, val in attrs.items():
+            if key != "status":
+                setattr(job, key, val)
+        if reindex:
+            self._index(job)
+        if reschedule:
+            self.scheduler.add(job)
+        if "status" in attrs:  # last, the heaps are ordered by the other attrs
+            self._set_status(job, attrs["status"])
+        self._log("update", id, attrs)
+        return job
+
+    def _set_status(self, job, status):
+        old_status = self._move(job, status)
+        if status != old_status and status in ["finished", "failed"]:
+            self._resolve_dependents(job.id, status == "finished")
+
+    def _move(self, job, status):
+        old_status = job.status
+        if old_status in self._by_status:
+            self._by_status[old_status].pop(job.id, None)
+        job.status = sys.intern(status)  # shared by all jobs with the status
+        self._by_status[status][job.id] = job
+        if status != old_status:
+            self._unqueue(job, old_status)
+            self._push(job)  # if the job is queued again
+            if status in ["finished", "failed"]:
+                self._ended[job.id] = time.time()
+            else:
+                self._ended.pop(job.id, None)
+            if status == "pending":
+                self._pending_since[job.id] = time.time()
+            elif status != "submitted":
+                self._pending_since.pop(job.id, None)
+        return old_status
+
+    def _index(self, job):
+        for attr, index in self._indexes.items():
+            index.setdefault(getattr(job, attr, None), {})[job.id] = job
+
+    def _unindex(self, job):
+        for attr, index in self._indexes.items():
+            value = getattr(job, attr, None)  # i.e. only BashJobs have an array_id
+            jobs = index.get(value)
+            if jobs is not None:
+                jobs.pop(job.id, None)
+                if not jobs:
+                    del index[value]
+
+    def _block(self, job):
+        """Block a new job until its dependencies have finished.
+
+        Dependencies that are unknown to the queue are regarded as finished.
+        """
+        ids = dict.fromkeys(job.dependencies)
+        parents = [self._jobs[id] for id in ids if id in self._jobs]
+        parents = [parent for parent in parents if parent.status != "finished"]
+        archived = (
+            [] if self.archive is None else [id for id in ids if id not in self._jobs]
+        )
+        if any(parent.status == "failed" for parent in parents) or any(
+            self.archive.status(id) == "failed" for id in archived
+        ):
+            job.status = "failed"
+        elif not parents:
+            job.status = "pending"
+        else:
+            job.status = "blocked"
+            self._indegree[job.id] = len(parents)
+            for parent in parents:
+                self._dependents[parent.id].append(job.id)
+
+    def _resolve_dependents(self, id, ok):
+        """Release the jobs blocked by a finished job, or fail them if it failed.
+
+        Failures are passed down the graph iteratively, as pipelines may be far
+        deeper than the recursion limit.
+        """
+        stack = [(id, ok)]
+        while stack:
+            id, ok = stack.pop()
+            for dependent_id in self._dependents.pop(id, ()):
+                if dependent_id not in self._indegree:
+                    continue  # cancelled, or failed by another dependency
+                if ok:
+                    self._indegree[dependent_id] -= 1
+                    if self._indegree[dependent_id] > 0:
+                        continue
+                del self._indegree[dependent_id]
+                status = "pending" if ok else "failed"
+                self._move(self._jobs[dependent_id], status)
+                self._log("update", dependent_id, {"status": status})
+                if not ok:
+                    stack.append((dependent_id, False))
+
+    def get_dependents(self, id):
+        """Jobs that are blocked by the job `id`."""
+        return [self._jobs[i] for i in self._dependents.get(id, ()) if i in self._jobs]
+
+    def _push(self, job):
+        if job.status == "pending":
+            self.scheduler.add(job)
+        elif job.status == "retrying":
+            seq = next(self._seq)
+            self._retry_seq[job.id] = seq
+            heapq.heappush(self._retry_heap, (job._retry_at, seq, job))
+
+    def _unqueue(self, job, status):
+        if status == "pending":
+            self.scheduler.remove(job)
+        self._retry_seq.pop(job.id, None)
+
+    def _log(self, action, *args):
+        self.change_seq += 1
+        self._changes.append(
+            (self.change_seq, args[0].id if action == "append" else args[0])
+        )
+        if self.journal is None:
+            return
+        getattr(self.journal, f"log_{action}")(*args)
+        if self.journal.needs_compaction():
+            self.journal.compact(self._jobs.values())
+
+    def changes_since(self, seq):
+        """Ids of the jobs that changed after change `seq`.
+
+        Returns:
+            list of ids, None if changes after `seq` are no longer in the feed
+        """
+        oldest = self._changes[0][0] if self._changes else self.change_seq + 1
+        if seq < oldest - 1 or seq > self.change_seq:
+            return None
+        ids = {}
+        for change_seq, id in reversed(self._changes):
+            if change_seq <= seq:
+                break
+            ids[id] = None
+        return list(ids)
+
+    @classmethod
+    def load(cls, journal: Journal, scheduler: Scheduler = None, **kwargs):
+        """Restore a queue from its journal and continue recording changes."""
+        queue = cls(journal.replay(), journal=journal, scheduler=scheduler, **kwargs)
+        if journal.needs_compaction():
+            journal.compact(queue._jobs.values())  # so the next replay is quick
+        return queue
+
+    def release_due_jobs(self, now=None):
+        """Move retrying jobs whose delay has passed back to pending.
+
+        Returns:
+            number of released jobs
+        """
+        now = time.time() if now is None else now
+        released = 0
+        while self._retry_heap and self._retry_heap[0][0] <= now:
+            _, seq, job = heapq.heappop(self._retry_heap)
+            if self._retry_seq.get(job.id) == seq:
+                self.set_status(job, "pending")
+                released += 1
+        return released
+
+    def next_retry_time(self):
+        """time.time() at which the next retrying job is due, None if there is none."""
+        while self._retry_heap:
+            t_retry, seq, job = self._retry_heap[0]
+            if self._retry_seq.get(job.id) == seq:
+                return t_retry
+            heapq.heappop(self._retry_heap)  # stale entry
+        return None
+
+    def next_job(self, resources=None):
+        """Dispatch the job chosen by the scheduler.
+
+        Args:
+            resources: free resources of the worker, i.e. {"cpus": 4}.
+
+        Raises:
+            IndexError: if no job is pending or none may run with `resources`.
+        """
+        self.release_due_jobs()
+        job = self.scheduler.pop(resources)
+        self.set_status(job, "submitted")
         return job
 
     def remove(self, id):
-        job_idx = [job.id for job in self.jobs].index(id)
-        return self.jobs.pop(job_idx)
+        job = self._jobs.pop(id)
+        self._by_status[job.status].pop(job.id, None)
+        self._unindex(job)
+        self._unqueue(job, job.status)
+        self._indegree.pop(id, None)
+        self._ended.pop(id, None)
+        self._pending_since.pop(id, None)
+        self._log("remove", id)
+        if job.status != "finished":
+            self._resolve_dependents(id, False)
+        return job
 
     def append(self, job):
-        self.jobs.append(job)
+        if job.dependencies and job.status in ["pending", "blocked"]:
+            self._block(job)
+        self._jobs[job.id] = job
+        self._by_status[job.status][job.id] = job
+        self._index(job)
+        self._push(job)
+        if job.status in ["finished", "failed"]:
+            self._ended[job.id] = job._ended or time.time()
+        elif job.status == "pending":
+            self._pending_since[job.id] = time.time()
+        self._log("append", job)
+
+    def extend(self, jobs):
+        for job in jobs:
+            self.append(job)
+
+    def archive_old_jobs(self, now=None):
+        """Move finished and failed jobs beyond the retention to the archive.
+
+        Jobs are archived at least `archive_batch` at a time, unless they are
+        older than `keep_seconds`, so that the archive is written in few
+        transactions.
+
+        Returns:
+            ids of the archived jobs
+        """
+        if self.archive is None:
+            return []
+        now = time.time() if now is None else now
+        excess = len(self._ended) - self.keep_jobs
+        excess = excess if excess >= self.archive_batch else 0
+        ids = []
+        for id, t_end in self._ended.items():  # the jobs that ended first
+            expired = self.keep_seconds is not None and now - t_end > self.keep_seconds
+            if len(ids) >= excess and not expired:
+                break
+            ids.append(id)
+        if not ids:
+            return []
+
+        self.archive.add([self._jobs[id] for id in ids])
+        for id in ids:
+            job = self._jobs.pop(id)
+            self._by_status[job.status].pop(id)
+            self._unindex(job)
+            del self._ended[id]
+            self._log("remove", id)
+        return ids
+
+    def pending_since(self, id):
+        """time.time() when a pending or submitted job last became pending.
+
+        That is when it was submitted, its retry delay passed, its dependencies
+        finished or it was requeued, i.e. because the lease of its worker expired.
+        """
+        return self._pending_since.get(id)
+
+    def oldest(self, status):
+        """Job that has had `status` for the longest time, None if there is none."""
+        return next(iter(self._by_status[status].values()), None)
 
     def has_alive(self):
-        return len(self.running_jobs) > 0
+        return self.count("running") > 0
 
     def __getitem__(self, i):
         return self.jobs[i]
 
+    def __iter__(self):
+        return iter(self._jobs.values())
+
     def __call__(self):
         return self.jobs
 
     def __contains__(self, o):
-        return o in self.jobs
+        return o.id in self._jobs and self._jobs[o.id] == o
 
     def __len__(self):
-        return len(self.get_pending_jobs())
+        return self.count("pending")
 
-    def __str__(self, filter={"finished": False}):
-        jobs = self.jobs.copy()
-        for key, value in filter.items():
-            if key == "finished" and not value:
-                jobs = [job for job in jobs if job.status != "finished"]
-            elif key == "finished" and value:
-                pass
+    def query(self, filter={}, sort=None, offset=0, limit=None):
+        """Jobs with the attribute values in `filter`, i.e. {"owner": "me"}.
+
+        Only the jobs in the smallest index that matches the filter (by id,
+        status, owner, name, type or array_id) are looked at. {"finished":
+        False} leaves out finished jobs. The jobs are sorted by `sort` (see
+        SORT_KEYS, i.e. "-priority" for the highest priority first) or in the
+        order they were submitted, and paginated by `offset` and `limit`.
+
+        Returns:
+            number of matching jobs, list of the jobs from `offset` to `limit`
+        """
+        filter = dict(filter)
+        finished = filter.pop("finished", True)
+        if "id" in filter:
+            jobs = [self._jobs[filter["id"]]] if filter["id"] in self._jobs else []
+        else:
+            indexes = {"status": self._by_status, **self._indexes}
+            candidates = [
+                index.get(filter[attr], {})
+                for attr, index in indexes.items()
+                if attr in filter
+            ]
+            if candidates:
+                jobs = min(candidates, key=len).values()
+                sort = sort or "submitted"  # the order of the index may differ
             else:
-                jobs = [job for job in jobs if job.__dict__[key] == value]
-        return "\n".join([f"{i}; " + job.__str__() for i, job in enumerate(jobs)])
+                jobs = self._jobs.values()
+        end = None if limit is None else offset + limit
+        if not filter:  # the total is known from the index, jobs are not copied
+            total = len(self._jobs) - (0 if finished else self.count("finished"))
+            if not finished:
+                jobs = (job for job in jobs if job.status != "finished")
+            if sort is None:
+                return total, list(itertools.islice(jobs, offset, end))
+        else:
+            jobs = [
+                job
+                for job in jobs
+                if (finished or job.status != "finished")
+                and all(
+                    getattr(job, key, None) == value for key, value in filter.items()
+                )
+            ]
+            total = len(jobs)
+
+        if sort is None:
+            return total, jobs[offset:end]
+        _, key, reverse = sort_key(sort)
+        if end is None:
+            return total, sorted(jobs, key=key, reverse=reverse)[offset:]
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        return total, select(end, jobs, key=key)[offset:]
+
+    def filter(self, filter={"finished": False}):
+        return self.query(filter)[1]
+
+    def __str__(self, filter={"finished": False}):
+        return format_jobs(self.filter(filter))
+
 
+def format_jobs(jobs):
+    return "\n".join([f"{i}; " + job.__str__() for i, job in enumerate(jobs)])
 
-class StoppableServer(SimpleXMLRPCServer):
-    def __init__(self, port=8000):
+
+class StoppableServer(UnixSocketMixin, SimpleXMLRPCServer):
+    """XML-RPC server exposing a CtlDaemon. Handles one request at a time.
+
+    Listens on `host`:`port` or on a unix socket if `socket_path` is given.
+    Workers on other machines can connect if `host` is i.e. "0.0.0.0". Only
+    requests with the `token` of the server are answered, see check_token.
+    """
+
+    request_queue_size = 128  # allow many clients to connect at once
+    allow_blocking = False  # blocking calls would stall all other requests
+    request_handler = XMLRPCRequestHandler
+
+    def __init__(
+        self, port=8000, socket_path=None, host="localhost", token=None, **daemon_kwargs
+    ):
+        address = (host, port) if socket_path is None else socket_path
+        self.token = token
+        try:
+            super().__init__(
+                address,
+                requestHandler=self.request_handler,
+                allow_none=True,
+                logRequests=False,
+            )
+        except OSError:
+            raise OSError(f"Another server is already listening on {address}")
+        register_daemon(self, **daemon_kwargs)
+
+
+def register_daemon(server, **daemon_kwargs):
+    """Expose a new CtlDaemon and a shutdown function on `server`."""
+
+    def shutdown(kill_thread=True):
+        daemon.close()
+        server.server_close()
+        # sys.exit() produces error and leaves thread running, hence kill option
+        if kill_thread:
+            os.kill(os.getpid(), signal.SIGTERM)
+        sys.exit()
+
+    daemon = CtlDaemon(allow_blocking=server.allow_blocking, **daemon_kwargs)
+    server.register_instance(daemon)
+    server.register_function(shutdown)
+
+
+class ThreadedStoppableServer(ThreadingMixIn, StoppableServer):
+    """StoppableServer that handles every request in its own thread.
+
+    Concurrent access to the queue and the workers is serialized by the lock of
+    the CtlDaemon, so slow requests only block requests that need the same state.
+    Connections are kept open between requests (HTTP keep-alive).
+    """
+
+    daemon_threads = True
+    allow_blocking = True
+    request_handler = KeepAliveXMLRPCRequestHandler
+
+
+class BinaryStoppableServer(BinaryServer):
+    """Server exposing a CtlDaemon over the binary protocol of pyqueue.transport.
+
+    Jobs are sent as plain pickles over persistent connections, each handled in
+    its own thread.
+    """
+
+    allow_blocking = True
+
+    def __init__(
+        self, port=8000, socket_path=None, host="localhost", token=None, **daemon_kwargs
+    ):
+        address = (host, port) if socket_path is None else socket_path
         try:
-            super().__init__(("localhost", port), allow_none=True, logRequests=False)
+            super().__init__(address, token=token)
         except OSError:
-            raise OSError(f"Another server is already listening on port {port}")
+            raise OSError(f"Another server is already listening on {address}")
+        register_daemon(self, **daemon_kwargs)
+
 
-        def shutdown(kill_thread=True):
-            self.server.server_close()
-            # sys.exit() produces error and leaves thread running, hence kill option
-            if kill_thread:
-                os.kill(os.getpid(), signal.SIGTERM)
-            sys.exit()
+def make_server(
+    port=8000,
+    threaded=False,
+    transport="http",
+    socket_path=None,
+    host="localhost",
+    token=None,
+    **daemon_kwargs,
+):
+    """Create a daemon server.
 
-        self.register_instance(CtlDaemon())
-        self.register_function(shutdown)
+    Args:
+        port: port to listen on.
+        threaded: handle XML-RPC requests in parallel (binary servers always do).
+        transport: "http" for XML-RPC, "pyq" for the binary protocol.
+        socket_path: listen on this unix socket instead of `port`.
+        host: interface to listen on, "0.0.0.0" for all of them.
+        token: shared secret that clients have to send, required unless the
+            server only listens on the loopback interface or a unix socket,
+            since the daemon unpickles what it is sent.
+    """
+    if socket_path is None and token is None and not is_loopback(host):
+        raise ValueError(
+            f"Listening on {host} lets anyone who can reach it run code as this "
+            f"user, set {TOKEN_ENV} to a shared secret of the daemon and workers"
+        )
+    if transport == "pyq":
+        server = BinaryStoppableServer
+    elif threaded:
+        server = ThreadedStoppableServer
+    else:
+        server = StoppableServer
+    return server(port, socket_path, host, token, **daemon_kwargs)
 
 
 class StoppableServerThread(threading.Thread):
     """Thread class with a stop() method. The thread itself has to check
     regularly for the stopped() condition."""
 
-    def __init__(self, port=8000, as_daemon=True):
-        self.server = StoppableServer(port)
+    def __init__(
+        self, port=8000, as_daemon=True, threaded=False, transport="http", **kwargs
+    ):
+        self.server = make_server(port, threaded, transport, **kwargs)
         self.port = port
 
         super(StoppableServerThread, self).__init__(
@@ -113,6 +669,8 @@ class StoppableServerThread(threading.Thread):
         )
 
     def stop(self):
+        if self.is_alive():
+            self.server.shutdown()  # wait for serve_forever to return
         self.server.server_close()
 
     def stopped(self):
@@ -120,95 +678,664 @@ class StoppableServerThread(threading.Thread):
 
 
 class CtlDaemon:
-    def __init__(self):
-        self.queue = Queue()
+    def __init__(
+        self,
+        allow_blocking=False,
+        journal_path=None,
+        scheduler=None,
+        lease_timeout=30,
+        result_dir=None,
+        archive_path=None,
+        keep_jobs=10_000,
+        keep_hours=None,
+    ):
+        if isinstance(scheduler, str):
+            scheduler = make_scheduler(scheduler)
+        if archive_path is None and journal_path is not None:
+            archive_path = journal_path + ".archive"  # outlives the daemon as well
+        retention = {
+            "archive": Archive(archive_path),
+            "keep_jobs": keep_jobs,
+            "keep_seconds": None if keep_hours is None else keep_hours * 3600,
+        }
+        if journal_path is None:
+            self.queue = Queue(scheduler=scheduler, **retention)
+        else:
+            self.queue = Queue.load(Journal(journal_path), scheduler, **retention)
+            log.info(f"Restored {len(self.queue.jobs)} jobs from {journal_path}")
         self.workers = {}
+        self.worker_index = WorkerIndex()  # free resources of the workers
+        self.allow_blocking = allow_blocking  # whether calls may long-poll
+        self._lock = threading.RLock()  # guards queue and workers
+        self._job_available = threading.Condition(self._lock)
+        self._waiting = {}  # worker id -> condition of a worker waiting for a job
+        self.autoscaler = None
+        # workers that were not heard of for this many seconds are considered dead
+        self.lease_timeout = lease_timeout
+        self._reaper_stopped = threading.Event()
+        # results are written without holding the lock of queue and workers
+        self.results = ResultStore(result_dir)
+        self._results_lock = threading.Lock()
+        # tells the change feeds of restarted daemons apart, see get_changes
+        self.epoch = uuid.uuid4().hex[:8]
+        # histograms of the timings of jobs since the daemon was started
+        self.metrics = Metrics()
+        self._dispatched_at = {}  # job id -> time.monotonic() when it was acquired
+        # jobs that were dispatched before a restart are requeued, unless their
+        # worker registers again within lease_timeout seconds
+        self._restored = {
+            job.id
+            for status in ["submitted", "running"]
+            for job in self.queue.get_jobs(status)
+        }
+        self._restored_at = time.monotonic()
 
+    @synchronized
     def get_num_pending_jobs(self):
         return len(self.queue)
 
+    @synchronized
     def get_num_running_jobs(self):
-        return len(self.get_running_ids())
+        return self.queue.count("running")
 
+    @synchronized
     def get_num_workers(self):
         return len(self.workers)
 
+    @synchronized
     def get_running_ids(self):
-        return [job.id for job in self.queue if job.status == "running"]
+        return [job.id for job in self.queue.get_running_jobs()]
 
+    @synchronized
     def show_workers(self):
         msg = ""
         if self.get_num_workers() > 0:
-            msg += "pid; uptime; status; current job\n"
+            msg += "id; uptime; status; slots; cpus; mem; current jobs\n"
         for worker_id, status in self.workers.items():
-            msg += f"{worker_id}; "
-            values = list(status.values())
-            uptime = dt2dict(datetime.datetime.now() - fix_datetime(values[0]))
-            values[0] = timedeltastr(uptime)
-            values[-1] = " - " if values[-1] is None else values[-1]
+            uptime = dt2dict(datetime.datetime.now() - fix_datetime(status["t_up"]))
+            job_ids = [id for id in status["slots"] if id is not None]
+            free = self.worker_index.free(worker_id)
+            values = [
+                str(worker_id),
+                timedeltastr(uptime),
+                status["status"],
+                f"{len(job_ids)}/{len(status['slots'])}",
+                f"{status['cpus'] - free['cpus']}/{status['cpus']}",
+                f"{status['mem'] - free['mem']}/{status['mem']}M",
+                ", ".join(job_ids) if job_ids else " - ",
+            ]
             msg += "; ".join(values) + "\n"
         return msg
 
+    def wait_for_jobs(self, timeout=0):
+        """Block until a job is pending or `timeout` seconds have passed.
+
+        Returns immediately if the daemon does not allow blocking calls.
+
+        Returns:
+            number of pending jobs
+        """
+        timeout = timeout if self.allow_blocking else 0
+        with self._job_available:
+            self._wait_for_pending(timeout)
+            return len(self.queue)
+
+    def _wait_for_pending(self, timeout, worker_id=None):
+        """Wait until a job is pending, also for retrying jobs to become due.
+
+        Has to be called while holding the daemon lock. Registered workers
+        wait on their own condition, so that a new job wakes up the worker it
+        fits best (see `_notify_workers`).
+
+        Returns:
+            False if no job became pending within `timeout` seconds
+        """
+        deadline = time.time() + timeout
+        while True:
+            self.queue.release_due_jobs()
+            if len(self.queue) > 0:
+                return True
+            now = time.time()
+            if now >= deadline:
+                return False
+            t_retry = self.queue.next_retry_time()
+            t_wake = deadline if t_retry is None else min(deadline, t_retry)
+            if worker_id in self.worker_index:
+                condition = threading.Condition(self._lock)
+                self._waiting[worker_id] = condition
+                condition.wait(t_wake - now)
+                self._waiting.pop(worker_id, None)
+            else:
+                self._job_available.wait(t_wake - now)
+
+    def _notify_workers(self, jobs):
+        """Wake up the waiting worker that fits each job best (best-fit packing)."""
+        for job in jobs:
+            worker_id = self.worker_index.best_fit(job, self._waiting)
+            if worker_id is not None:
+                self._waiting.pop(worker_id).notify()
+            else:
+                self._job_available.notify()
+
     @check_pickle
-    def acquire_job(self):
-        job = self.queue.next_job()
-        job.status = "submitted"
-        log.info(f"submitted job [ID:{job.id}]")
+    @synchronized
+    def acquire_job(self, resources=None):
+        job = self.queue.next_job(resources)
+        self._record_dispatch(job)
+        log.debug(f"submitted job [ID:{job.id}]")
         return job
 
+    @check_pickle
+    def try_acquire_job(self, timeout=0, resources=None, worker_id=None):
+        """Atomically wait for and acquire the next job.
+
+        Unlike `acquire_job`, this does not raise if another worker took the
+        last pending job, but returns None.
+
+        Args:
+            timeout: seconds to wait for a pending job.
+            resources: free resources of the worker, i.e. {"cpus": 4}. Defaults
+                to the free resources of the registered worker `worker_id`.
+            worker_id: id of the worker that asks for a job. Workers that are
+                not registered (anymore) do not get jobs.
+
+        Returns:
+            next job or None if no job became available within `timeout` seconds
+            or the scheduler did not choose any job to run with `resources`
+        """
+        timeout = timeout if self.allow_blocking else 0
+        with self._job_available:
+            if worker_id is not None and not self._renew_lease(worker_id):
+                return None
+            if not self._wait_for_pending(timeout, worker_id):
+                return None
+            if worker_id is not None and not self._renew_lease(worker_id):
+                return None  # was removed while waiting
+            if resources is None and worker_id in self.worker_index:
+                resources = self.worker_index.free(worker_id)
+            try:
+                job = self.queue.next_job(resources)
+            except IndexError:
+                return None
+            self._record_dispatch(job)
+            self._assign(worker_id, job)
+        log.debug(f"submitted job [ID:{job.id}]")
+        return job
+
+    @synchronized
     def update_job_status(self, job_id, kwargs):
-        job = self.queue.get_dict()[job_id]
-        for key, val in kwargs.items():
-            if isinstance(val, XMLRPCDateTime):
-                job.__dict__[key] = fix_datetime(val)
-            else:
-                job.__dict__[key] = val
+        kwargs = {
+            key: fix_datetime(val) if isinstance(val, XMLRPCDateTime) else val
+            for key, val in kwargs.items()
+        }
+        job = self.queue.update(job_id, kwargs)
+        if kwargs.get("status") == "pending":
+            self._notify_workers([job])
         log.info(f"Updated {list(kwargs.keys())} for job [ID:{job_id}]")
 
-    def update_worker_status(self, pid, kwargs):
+    @synchronized
+    def job_started(self, job_id, pid, worker_id):
+        """Mark a job as running in process `pid`, started by worker `worker_id`.
+
+        Reports of workers that lost the job in the meantime (i.e. because
+        their lease expired and the job was requeued) are ignored.
+        """
+        self._renew_lease(worker_id)
+        job = self.queue.get_dict().get(job_id)  # None if it was cancelled
+        if (
+            job is None
+            or job.status != "submitted"
+            or job.worker not in [None, worker_id]
+        ):
+            log.warning(
+                f"Ignored start of job [ID:{job_id}] by worker [ID:{worker_id}]"
+            )
+            return
+        self.queue.update(
+            job_id,
+            {
+                "status": "running",
+                "pid": pid,
+                "worker": worker_id,
+                "_start_time": datetime.datetime.now(),
+            },
+        )
+        self._assign(worker_id, job)
+        dispatched_at = self._dispatched_at.pop(job_id, None)
+        if dispatched_at is not None:
+            self.metrics.record("dispatch", time.monotonic() - dispatched_at, job)
+        log.debug(f"Job [ID:{job_id}] is running [PID:{pid}]")
+
+    @synchronized
+    def job_finished(self, job_id, exit_code, worker_id):
+        """Record the exit code of a job and free the slot of its worker.
+
+        Jobs with a non-zero exit code fail. If they have retries left, they
+        are queued again with a lower priority after an exponential backoff.
+        The daemon keeps the job, so it is not sent again by the worker.
+        Reports of workers that lost the job in the meantime are ignored.
+        """
+        self._renew_lease(worker_id)
+        job = self.queue.get_dict().get(job_id)  # None if it was cancelled
+        if (
+            job is None
+            or job.status not in ["submitted", "running"]
+            or (worker_id is not None and job.worker != worker_id)
+        ):
+            log.warning(f"Ignored end of job [ID:{job_id}] by worker [ID:{worker_id}]")
+            return
+        attrs = {"_exit": exit_code, "_end_time": datetime.datetime.now()}
+        if exit_code == 0:
+            attrs["status"] = "finished"
+        elif job.can_retry():
+            delay = job.next_retry_delay()
+            attrs.update(
+                {
+                    "status": "retrying",
+                    "retries": job.retries + 1,
+                    "priority": job.priority - 1,
+                    "_retry_at": time.time() + delay,
+                    "worker": None,
+                }
+            )
+            self._notify_workers([job])  # so a waiting worker wakes up on time
+            log.info(f"Retrying job [ID:{job_id}] in {delay}s")
+        else:
+            attrs["status"] = "failed"
+        dependents = self.queue.get_dependents(job_id)
+        self.queue.update(job_id, attrs)
+        self._dispatched_at.pop(job_id, None)
+        self._restored.discard(job_id)  # i.e. it may be retried by another worker
+        if job._started is not None:
+            self.metrics.record("runtime", job._ended - job._started, job)
+        self._release(worker_id, job)
+        self._notify_workers([j for j in dependents if j.status == "pending"])
+        self._archive_old_jobs()
+        log.info(f"Job [ID:{job_id}] {attrs['status']} with exit code {exit_code}")
+
+    def _archive_old_jobs(self):
+        """Archive old jobs, see Queue.archive_old_jobs, and remove their results."""
+        archived = self.queue.archive_old_jobs()
+        if archived:
+            with self._results_lock:
+                for id in archived:
+                    self.results.remove(id)
+
+    def _record_dispatch(self, job):
+        """Record how long a job was pending, until it was acquired."""
+        queued_at = self.queue.pending_since(job.id) or job._created
+        self.metrics.record("wait", time.time() - queued_at, job)
+        self._dispatched_at[job.id] = time.monotonic()
+
+    def _assign(self, worker_id, job):
+        """Reserve a slot and the resources of a worker for a job."""
+        worker = self.workers.get(worker_id)
+        if worker is None or job.id in worker["slots"]:
+            return  # reserved when the job was acquired
+        if self._fill_slot(worker_id, None, job.id):
+            self.worker_index.add(worker_id, -job.cpus, -job.mem)
+            if job.worker != worker_id:
+                self.queue.update(job.id, {"worker": worker_id})
+
+    def _release(self, worker_id, job):
+        if self._fill_slot(worker_id, job.id, None):
+            self.worker_index.add(worker_id, job.cpus, job.mem)
+
+    def _fill_slot(self, worker_id, old_job_id, new_job_id):
+        """Replace a job in the slots of a worker, returns False if it has none."""
+        worker = self.workers.get(worker_id)
+        if worker is None or old_job_id not in worker["slots"]:
+            return False
+        slots = worker["slots"]
+        slots[slots.index(old_job_id)] = new_job_id
+        worker["status"] = "idle" if all(id is None for id in slots) else "busy"
+        return True
+
+    @synchronized
+    def update_worker_status(self, worker_id, kwargs):
+        self._renew_lease(worker_id)
         for key, val in kwargs.items():
             if isinstance(val, XMLRPCDateTime):
-                self.workers[pid][key] = fix_datetime(val)
+                self.workers[worker_id][key] = fix_datetime(val)
             else:
-                self.workers[pid][key] = val
-        log.info(f"Updated {list(kwargs.keys())} for worker [PID:{pid}]")
+                self.workers[worker_id][key] = val
+        log.info(f"Updated {list(kwargs.keys())} for worker [ID:{worker_id}]")
 
     @check_pickle  # pickle & unpickle so it can be sent or received.
     def submit_job(self, job: Job or str):
         job = try_unpickle(job)
         assert isinstance(job, Job)
-        self.queue.append(job)
+        with self._lock:
+            self._check_fit([job])
+            self.queue.append(job)
+            self._notify_workers([job])
         log.info(f"Added job [ID:{job.id}] to the queue")
 
+    def submit_jobs(self, jobs: List[Job] or str):
+        """Add many jobs to the queue with a single call.
+
+        Accepts a list of (pickled) jobs or a single pickled list of jobs.
+        """
+        jobs = [try_unpickle(job) for job in try_unpickle(jobs)]
+        assert all(isinstance(job, Job) for job in jobs)
+        with self._lock:
+            self._check_fit(jobs)
+            self.queue.extend(jobs)
+            self._notify_workers(jobs)
+        log.info(f"Added {len(jobs)} jobs to the queue")
+
+    def _check_fit(self, jobs):
+        """Raise a ValueError if a job needs more than any registered worker has.
+
+        Without registered workers (i.e. before the first one started) all
+        jobs are accepted.
+        """
+        scheduler = self.queue.scheduler
+        for job in {(job.cpus, job.mem): job for job in jobs}.values():
+            if not scheduler.fits_any_worker(demand(job)):
+                raise ValueError(
+                    f"Job [ID:{job.id}] needs {job.cpus} cpus and {job.mem} MB"
+                    " of memory, more than any worker has"
+                )
+
+    def _update_capacities(self):
+        """Tell the scheduler the resources of the workers, see fits_any_worker."""
+        capacities = [
+            {"cpus": worker["cpus"], "mem": worker["mem"]}
+            for worker in self.workers.values()
+        ]
+        self.queue.scheduler.set_capacities(capacities or None)
+
+    @synchronized
     def check_alive(self, id):
-        job = self.queue.get_dict()[id]
-        return job.check_alive()
+        """Whether a job is running on a worker that is alive.
+
+        Workers may run on other hosts, so this relies on the heartbeats of
+        the workers instead of looking for the process of the job.
+        """
+        job = self.queue.get_job(id)
+        return job.status == "running" and job.worker in self.workers
 
-    def check_busy(self, pid):
-        worker = self.workers[pid]
+    @synchronized
+    def check_busy(self, worker_id):
+        worker = self.workers[worker_id]
         return worker["status"] == "busy"
 
-    def is_worker(self, pid):
-        return pid in self.workers
+    @synchronized
+    def is_worker(self, worker_id):
+        return worker_id in self.workers
 
+    @synchronized
     def get_job_pid(self, id):
-        return self.queue.get_dict()[id].pid
+        return self.queue.get_job(id).pid
+
+    def put_result(self, job_id, index, data, worker_id=None):
+        """Store the `index`th chunk of the result of a job.
+
+        Workers upload the result (i.e. the output of a BashJob or the pickled
+        return value of a CallableJob) in chunks of CHUNK_SIZE bytes before
+        they report the end of the job. Chunk 0 replaces a previous result.
+
+        Returns:
+            False if the job was cancelled or is run by another worker
+        """
+        with self._lock:
+            job = self.queue.get_dict().get(job_id)
+            if job is None or (worker_id is not None and job.worker != worker_id):
+                log.warning(f"Ignored result of job [ID:{job_id}]")
+                return False
+        with self._results_lock:
+            self.results.write(job_id, to_bytes(data), index * CHUNK_SIZE)
+        return True
+
+    def get_result(self, id, index=0):
+        """The `index`th chunk of CHUNK_SIZE bytes of a result, empty at its end.
+
+        Large results are read from their file chunk by chunk, so that they are
+        never loaded into memory as a whole.
+        """
+        with self._results_lock:
+            return self.results.read(id, index * CHUNK_SIZE, CHUNK_SIZE)
+
+    def get_result_info(self, id):
+        """Number of "chunks" and "type" of the job of a result, None if there is none."""
+        with self._lock:
+            try:
+                job = self.queue.get_job(id)
+            except KeyError:
+                job = None
+        with self._results_lock:
+            if job is None or id not in self.results:
+                return None
+            return {
+                "chunks": -(-self.results.size(id) // CHUNK_SIZE),
+                "type": job.type,
+            }
 
     def remove_killed_workers(self):
-        tracked_workers = self.workers.copy()
-        for pid in tracked_workers:
-            None if psutil.pid_exists(pid) else self.workers.pop(pid)
-        log.info("Removed dead workers from tracking")
+        """Remove workers whose process does not exist on this host anymore.
+
+        Their jobs are requeued right away, instead of once the lease expired,
+        like those of workers on other hosts.
+
+        Returns:
+            ids of the removed workers
+        """
+        with self._lock:
+            local_workers = {
+                worker_id: worker["pid"]
+                for worker_id, worker in self.workers.items()
+                if self._is_local(worker)
+            }
+        dead_workers = [
+            worker_id
+            for worker_id, pid in local_workers.items()
+            if not psutil.pid_exists(pid)
+        ]
+        with self._lock:
+            for worker_id in dead_workers:
+                if worker_id in self.workers:
+                    log.warning(f"Process of worker [ID:{worker_id}] is gone")
+                    self._remove_worker(worker_id)
+        return dead_workers
+
+    @staticmethod
+    def _is_local(worker):
+        return worker.get("host") == socket.gethostname() and "pid" in worker
+
+    @synchronized
+    def heartbeat(self, worker_id):
+        """Renew the lease of a worker and hand over the orders for it.
+
+        Returns:
+            {"registered": False} if the worker is not registered, i.e. because
+            its lease expired. Otherwise also the ids of the jobs the worker
+            has to "cancel" and whether it has to "stop".
+        """
+        if not self._renew_lease(worker_id):
+            return {"registered": False}
+        worker = self.workers[worker_id]
+        orders = {
+            "registered": True,
+            "cancel": worker["cancel"],
+            "stop": worker["stop"],
+        }
+        worker["cancel"] = []
+        return orders
+
+    def _renew_lease(self, worker_id):
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            return False
+        worker["t_heartbeat"] = time.monotonic()
+        return True
+
+    @synchronized
+    def reap_dead_workers(self, now=None):
+        """Remove the workers whose lease expired and requeue their jobs.
+
+        Returns:
+            ids of the removed workers
+        """
+        now = time.monotonic() if now is None else now
+        dead_workers = [
+            worker_id
+            for worker_id, worker in self.workers.items()
+            if now - worker["t_heartbeat"] > self.lease_timeout
+        ]
+        for worker_id in dead_workers:
+            log.warning(f"Lease of worker [ID:{worker_id}] expired")
+            self._remove_worker(worker_id)
+        if self._restored and now - self._restored_at > self.lease_timeout:
+            requeued = self._requeue(self._restored)
+            self._restored.clear()
+            if requeued:
+                log.warning(f"Requeued {len(requeued)} jobs of workers that are gone")
+        return dead_workers
+
+    def _reap_forever(self):
+        while not self._reaper_stopped.wait(self.lease_timeout / 3):
+            self.remove_killed_workers()
+            self.reap_dead_workers()
+            with self._lock:
+                self._archive_old_jobs()  # also jobs older than keep_hours
+
+    def start_reaper(self):
+        """Check the leases of the workers in a background thread.
+
+        Has to be called in the process that serves the daemon, threads do not
+        survive a fork.
+        """
+        threading.Thread(target=self._reap_forever, daemon=True).start()
+
+    def _remove_worker(self, worker_id):
+        """Stop tracking a worker and requeue the jobs it holds."""
+        worker = self.workers.pop(worker_id)
+        self.worker_index.remove(worker_id)
+        self._update_capacities()
+        requeued = self._requeue(worker["slots"])
+        if requeued:
+            log.info(f"Requeued {len(requeued)} jobs of worker [ID:{worker_id}]")
+
+    def _requeue(self, job_ids):
+        """Queue the dispatched jobs of a lost worker again."""
+        requeued = []
+        for job_id in job_ids:
+            job = self.queue.get_dict().get(job_id)  # None if it was cancelled
+            if job is not None and job.status in ["submitted", "running"]:
+                attrs = {"pid": None, "worker": None, "_start_time": None}
+                requeued.append(
+                    self.queue.update(job_id, {**attrs, "status": "pending"})
+                )
+                self._dispatched_at.pop(job_id, None)
+        self._notify_workers(requeued)
+        return requeued
+
+    @synchronized
+    def retire_idle_worker(self, worker_id, force=False):
+        """Deregister a worker if it has no jobs, so it can be stopped safely.
+
+        Returns:
+            True if the worker was deregistered
+        """
+        worker = self.workers.get(worker_id)
+        if worker is None or (not force and any(worker["slots"])):
+            return False
+        self.deregister_worker(worker_id)
+        return True
+
+    @synchronized
+    def get_scaling_stats(self):
+        """Load of the daemon, by which the autoscaler starts and stops workers."""
+        oldest = self.queue.oldest("pending")
+        if oldest is None:
+            backlog_age = 0
+        else:
+            backlog_age = (datetime.datetime.now() - oldest.created_at).total_seconds()
+        return {
+            "pending": len(self.queue),
+            "free_slots": sum(w["slots"].count(None) for w in self.workers.values()),
+            "backlog_age": backlog_age,
+            "workers": {
+                worker_id: worker["status"]
+                for worker_id, worker in self.workers.items()
+            },
+        }
+
+    def start_autoscaler(self, address, **kwargs):
+        """Start and stop workers that connect to `address` (see Autoscaler)."""
+        self.autoscaler = Autoscaler(self, address, **kwargs)
+        self.autoscaler.start()
+
+    def close(self):
+        """Stop the started workers and write all changes to the journal."""
+        self._reaper_stopped.set()
+        if self.autoscaler is not None:
+            self.autoscaler.stop()
+        with self._lock:
+            if self.queue.journal is not None:
+                self.queue.journal.close()
+            self.queue.archive.close()
+        with self._results_lock:
+            self.results.close()
 
     # ------------------ CLIENT FUNCTIONALITY -------------------
     def sbatch(self, cmd, kwargs):
-        job = BashJob(cmd)
-        job.owner = kwargs["owner"] if "owner" in kwargs else None
-        self.submit_job(job)
-        log.info(f"Submitted batch job [ID:{job.id}] to queue")
+        """Submit a BashJob or a job array, returns the id of the job or array."""
+        job_kwargs = {
+            "priority": int(kwargs.get("priority") or 0),
+            "max_retries": int(kwargs.get("retries") or 0),
+            "cpus": int(kwargs.get("cpus") or 1),
+            "mem": parse_mem(kwargs.get("mem") or 0),
+        }
+        if kwargs.get("retry_delay") is not None:
+            job_kwargs["retry_delay"] = float(kwargs["retry_delay"])
+        if kwargs.get("array") is not None:
+            jobs = BashJob.array(cmd, parse_array(kwargs["array"]), **job_kwargs)
+        else:
+            jobs = [BashJob(cmd, **job_kwargs)]
+        dependencies = []
+        if kwargs.get("dependency"):
+            dependencies = self._expand_dependencies(
+                parse_dependency(kwargs["dependency"])
+            )
+        for job in jobs:
+            job.owner = kwargs["owner"] if "owner" in kwargs else None
+            job.dependencies = dependencies
+        self.submit_jobs(jobs)
+        job_id = jobs[0].array_id or jobs[0].id
+        log.info(f"Submitted batch job [ID:{job_id}] to queue")
+        return job_id
+
+    @synchronized
+    def _expand_dependencies(self, ids):
+        """Replace the ids of job arrays by the ids of their jobs."""
+        jobs = self.queue.get_dict()
+        expanded = []
+        for id in ids:
+            if id in jobs or id in self.queue.archive:
+                expanded.append(id)
+                continue
+            _, array = self.queue.query({"array_id": id})
+            array = self.queue.archive.ids({"array_id": id}) + [j.id for j in array]
+            if not array:
+                raise ValueError(f"Unknown dependency [ID:{id}]")
+            expanded += array
+        return expanded
         # if len(queue) > 1, and no active, worker -> register new worker
 
-    def squeue(self, user_name, filter={"me": False}):
+    def squeue(self, user_name, filter={"me": False}, limit=None, offset=0, sort=None):
+        """Rows of the jobs in the queue (see Job.row), to be formatted by the client.
+
+        Jobs are filtered, sorted by `sort` (see SORT_KEYS) and paginated by
+        `offset` and `limit` by the daemon, so that only the requested rows are
+        built and sent. With {"finished": True}, the archived jobs are included
+        (before all others, if not sorted).
+
+        Returns:
+            {"total": number of matching jobs, "jobs": rows from `offset` to
+            `limit`, "seq": position in the change feed, see `get_changes`}
+        """
         if filter["me"]:
             filter["user"] = user_name
         filter.pop("me")
@@ -218,36 +1345,101 @@ class CtlDaemon:
         # remove all flags that were not set.
         filter = {k: v for k, v in filter.items() if v is not None}
 
-        header = (
-            "; ".join(
-                [
-                    "idx",
-                    "type",
-                    "id",
-                    "name",
-                    "status",
-                    "owner",
-                    "priority",
-                    "submitted",
-                    "time",
-                ]
-            )
-            + "\n"
-        )
-        return header + self.queue.__str__(filter=filter)
+        end = None if limit is None else offset + limit
+        with self._lock:
+            total, jobs = self.queue.query(filter, sort, 0, end)
+            if filter.pop("finished", False):
+                archive = self.queue.archive
+                if sort is None:
+                    archived = archive.query(filter, None, 0, end)
+                    jobs = archived + jobs
+                else:
+                    attr, key, reverse = sort_key(sort)
+                    archived = archive.query(filter, "-" * reverse + attr, 0, end)
+                    jobs = list(heapq.merge(archived, jobs, key=key, reverse=reverse))
+                total += archive.count(filter)
+            now = time.time()
+            rows = [job.row(now) for job in jobs[offset:end]]
+            seq = self._change_cursor()
+        return {"total": total, "jobs": rows, "seq": seq}
+
+    def _change_cursor(self):
+        # a string, as XML-RPC only supports 32 bit ints
+        return f"{self.epoch}:{self.queue.change_seq}"
+
+    @synchronized
+    def get_changes(self, since_seq):
+        """Rows of the jobs that changed since `since_seq`, to follow the queue.
+
+        `since_seq` is the "seq" returned by `squeue` or a previous call. If
+        the changes since then are no longer known, i.e. the daemon was
+        restarted or too many jobs changed in between, "reset" is True and
+        the client has to call `squeue` again.
+
+        Returns:
+            {"seq": position in the change feed, "reset": bool, "jobs": rows
+            of the changed jobs, "removed": ids of cancelled or archived jobs}
+        """
+        epoch, _, seq = str(since_seq).rpartition(":")
+        ids = self.queue.changes_since(int(seq)) if epoch == self.epoch else None
+        rows, removed = [], []
+        now = time.time()
+        for id in ids or []:
+            job = self.queue.get_dict().get(id)
+            if job is None:
+                removed.append(id)
+            else:
+                rows.append(job.row(now))
+        return {
+            "seq": self._change_cursor(),
+            "reset": ids is None,
+            "jobs": rows,
+            "removed": removed,
+        }
+
+    @synchronized
+    def get_stats(self, by=()):
+        """Percentiles of the timings of jobs since the daemon was started.
+
+        See `pyqueue.metrics.METRICS` for the timings that are recorded.
+
+        Args:
+            by: attributes to group the jobs by, "owner" and/or "type"
+
+        Returns:
+            {metric: {group: {"count", "mean", "p50", "p90", "p99", "max"}}},
+            durations in seconds
+        """
+        return self.metrics.summary(by)
 
     def scancel(self, id):
-        if self.queue.get_dict()[id] == "running":
-            for ppid, status in self.workers.items():
-                job_id = status["current_work"]
-                pid = self.get_job_pid(job_id)
+        """Remove a job, its worker kills it with the next heartbeat.
 
-                p = psutil.Process(pid)
-                p.terminate()  # or p.kill()
-        self.queue.remove(id)
+        Workers that are not registered (i.e. after the daemon restarted) are
+        told to kill it when they register again. Only jobs of workers on the
+        host of the daemon are killed right away.
+        """
+        with self._lock:
+            job = self.queue.remove(id)
+            self._dispatched_at.pop(id, None)
+            with self._results_lock:
+                self.results.remove(id)
+            worker = self.workers.get(job.worker)
+            if worker is not None and job.status in ["submitted", "running"]:
+                worker["cancel"].append(job.id)
+                self._release(job.worker, job)
+                return
+        if (
+            job.status == "running"
+            and job.pid is not None
+            and str(job.worker).rpartition(":")[0] == socket.gethostname()
+        ):
+            try:
+                psutil.Process(job.pid).terminate()
+            except psutil.NoSuchProcess:
+                pass
 
     def sinfo(self):
-        self.remove_killed_workers()
         msg = "Queue daemon is currently running.\n\n"
         msg += f"{self.get_num_workers()} active workers:" + "\n"
         msg += self.show_workers() + "\n"
@@ -258,21 +1450,65 @@ class CtlDaemon:
         msg += "Ready to accept jobs."
         return msg
 
-    def register_worker(self, pid, kwargs):
-        self.workers.update({pid: kwargs})
-        log.info(f"Worker process [PID {pid}] was registered with pyqueue.")
-
-    def deregister_worker(self, pid):
-        self.workers.pop(pid)
-        log.info(f"Worker process [PID {pid}] was deregistered with pyqueue.")
-
-    def kill_worker(self, pid):
-        # # remove worker from self.workers
-        data = self.workers.pop(pid)
-        # send interupt signal to pid of worker process
-        p = psutil.Process(pid)
-        p.terminate()  # or p.kill()
-        log.info(f"Worker process [PID:{pid}] was killed.")
+    @synchronized
+    def register_worker(self, worker_id, kwargs):
+        """Track a worker, `kwargs` has to contain its capacity "cpus" and "mem".
+
+        The worker has to renew its lease every `lease_timeout` seconds with a
+        `heartbeat` (or any other call), or it is considered dead.
+
+        Workers on other hosts are told by id, i.e. "<host>:<pid>". If `kwargs`
+        contains the "host" and "pid" of a worker on the host of the daemon,
+        `remove_killed_workers` can check for its process.
+
+        A worker that registers again (i.e. after the daemon restarted) keeps
+        the jobs in its "slots" that the daemon still knows to run on it. It
+        has to cancel the others, i.e. those requeued when its lease expired.
+
+        Returns:
+            the lease timeout in seconds
+        """
+        slots = list(kwargs["slots"])
+        worker = self.workers[worker_id] = {
+            **kwargs,
+            "slots": slots,
+            "t_heartbeat": time.monotonic(),
+            "cancel": [],  # ids of jobs the worker has to kill
+            "stop": False,  # whether the worker has to shut down
+        }
+        self.worker_index.update(worker_id, kwargs["cpus"], kwargs["mem"])
+        self._update_capacities()
+        for i, job_id in enumerate(slots):
+            if job_id is None:
+                continue
+            job = self.queue.get_dict().get(job_id)
+            if (
+                job is not None
+                and job.status in ["submitted", "running"]
+                and job.worker == worker_id
+            ):
+                self._restored.discard(job_id)
+                self.worker_index.add(worker_id, -job.cpus, -job.mem)
+            else:
+                slots[i] = None
+                worker["cancel"].append(job_id)
+        worker["status"] = "idle" if all(id is None for id in slots) else "busy"
+        log.info(f"Worker [ID:{worker_id}] was registered with pyqueue.")
+        return self.lease_timeout
+
+    @synchronized
+    def deregister_worker(self, worker_id):
+        self._remove_worker(worker_id)
+        log.info(f"Worker [ID:{worker_id}] was deregistered with pyqueue.")
+
+    @synchronized
+    def kill_worker(self, worker_id):
+        """Stop a worker with its next heartbeat, its jobs are queued again.
+
+        The worker kills its jobs itself, as it may run on another host.
+        """
+        self.workers[worker_id]["stop"] = True
+        log.info(f"Worker [ID:{worker_id}] was asked to stop.")
 
 
 def main():
@@ -1,6 +1,8 @@
 # This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
 # under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
 
+import datetime
+
 
 def dt2dict(dt):
     d = {"days": dt.days}
@@ -29,3 +31,88 @@ def timedeltastr(dict):
     return "{}-{:02d}:{:02d}:{:02d}".format(
         dict["days"], dict["hours"], dict["minutes"], dict["seconds"]
     )
+
+
+def parse_array(spec):
+    """Parse a slurm style job array specification into a list of indices.
+
+    Supports comma separated indices and ranges with optional step size,
+    i.e. "0-9", "1,3,5" or "0-20:5,42".
+    """
+    indices = []
+    for part in spec.split(","):
+        part, _, step = part.partition(":")
+        start, _, stop = part.partition("-")
+        start = int(start)
+        stop = int(stop) if stop else start
+        indices += range(start, stop + 1, int(step) if step else 1)
+    return indices
+
+
+def parse_dependency(spec):
+    """Parse a slurm style dependency into a list of job ids.
+
+    Only "afterok" is supported, i.e. "afterok:<id>:<id>" or
+    "afterok:<id>,afterok:<id>".
+    """
+    ids = []
+    for part in spec.split(","):
+        kind, *part_ids = part.split(":")
+        if kind != "afterok" or not part_ids:
+            raise ValueError(f"Unsupported dependency {part!r}, use afterok:<id>")
+        ids += part_ids
+    return ids
+
+
+def parse_mem(spec):
+    """Parse a slurm style memory size into MB, i.e. "512", "512M" or "4G"."""
+    spec = str(spec).strip().upper()
+    units = {"K": 2**-10, "M": 1, "G": 2**10, "T": 2**20}
+    if spec[-1] in units:
+        return int(float(spec[:-1]) * units[spec[-1]])
+    return int(spec)
+
+
+def format_job_rows(rows, offset=0):
+    """Format the rows of jobs returned by squeue as a ';' separated table."""
+    columns = ["type", "id", "name", "status", "owner", "priority"]
+    lines = ["; ".join(["idx", *columns, "submitted", "time"])]
+    for i, row in enumerate(rows, offset):
+        items = [row[column] for column in columns]
+        items.append(
+            datetime.datetime.fromtimestamp(row["submitted"]).strftime(
+                "%H:%M:%S, %d.%m.%Y"
+            )
+        )
+        if row["runtime"] is not None:
+            items.append(
+                timedeltastr(dt2dict(datetime.timedelta(seconds=row["runtime"])))
+            )
+        else:
+            items.append(None)
+        lines.append("; ".join(str(x) if x is not None else " - " for x in [i, *items]))
+    return "\n".join(lines)
+
+
+def format_seconds(seconds):
+    """Format a duration, i.e. "850us", "12.3ms", "4.56s" or "0-01:02:03"."""
+    if seconds is None:
+        return " - "
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.0f}us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.1f}ms"
+    if seconds < 60:
+        return f"{seconds:.2f}s"
+    return timedeltastr(dt2dict(datetime.timedelta(seconds=seconds)))
+
+
+def format_stats(stats):
+    """Format the timings of jobs returned by get_stats as a ';' separated table."""
+    columns = ["mean", "p50", "p90", "p99", "max"]
+    lines = ["; ".join(["metric", "group", "count", *columns])]
+    for metric, groups in stats.items():
+        for group, summary in groups.items():
+            items = [format_seconds(summary[column]) for column in columns]
+            lines.append("; ".join([metric, group, str(summary["count"]), *items]))
+    return "\n".join(lines)
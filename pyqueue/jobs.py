@@ -1,10 +1,15 @@
 # This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
 # under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
 
+import copy
 import datetime
 import os
+import pickle
 import re
 import subprocess
+import sys
+import time
+import traceback
 from abc import ABC, abstractmethod
 from uuid import uuid4
 
@@ -13,23 +18,157 @@ import psutil
 from pyqueue.helpers import timedelta2dict
 
 
+def _to_timestamp(t):
+    """Times are stored as time.time() floats, but may be set as datetimes."""
+    return t.timestamp() if isinstance(t, datetime.datetime) else t
+
+
+def _to_datetime(t):
+    return None if t is None else datetime.datetime.fromtimestamp(t)
+
+
 class Job(ABC):
-    def __init__(self, id=None, priority: int = 0):
+    """Base class of all jobs.
+
+    The daemon may hold millions of jobs, so they are kept compact: attributes
+    are stored in `__slots__`, times as floats (the datetime attributes like
+    `created_at` are properties) and repeated strings are interned. Jobs are
+    pickled as a dict of their attributes.
+    """
+
+    __slots__ = (
+        "id",
+        "status",
+        "owner",
+        "name",
+        "priority",
+        "cpus",
+        "mem",
+        "_created",
+        "_started",
+        "_ended",
+        "pid",
+        "ppid",
+        "worker",
+        "dependencies",
+        "max_retries",
+        "retry_delay",
+        "retries",
+        "_retry_at",
+        "_exit",
+        "_out_path",
+        "_err_path",
+    )
+    _interned = ("status", "owner", "name", "worker")
+
+    def __init__(
+        self,
+        id=None,
+        priority: int = 0,
+        max_retries: int = 0,
+        retry_delay: float = 10,
+        cpus: int = 1,
+        mem: int = 0,
+    ):
         super().__init__()
         self.id = (
             id if id is not None else str(uuid4())[:13]
         )  # numbering the jobs would be preferable
-        self.status = None  # pending, running, finished, (stopped, paused), submitted
+        self.status = None  # blocked/pending/submitted/running/finished/failed/retrying
         self.owner = None  # the user that has created the job
         self.name = None  # a name that can be given to the job
         self.priority = priority  # higher priority jobs are submitted first
-        self.created_at = datetime.datetime.now()  # instantiation time of job
-        self._start_time = None  # time when the job was started
-        self._end_time = None  # time when the job finished
-        self._exit = None  # exit status of the job (0/1)
-        self._out = None  # path to output file
-        self._err = None  # path to err file
-        self.type = self.__class__.__name__  # to identify type of job
+        self.cpus = cpus  # number of cpus the job needs
+        self.mem = mem  # memory the job needs in MB
+        self._created = time.time()  # instantiation time of job
+        self._started = None  # time when the job was started
+        self._ended = None  # time when the job finished
+        self.pid = None  # process id
+        self.ppid = None  # parent process id
+        self.worker = None  # id of the worker that runs the job
+        self.dependencies = ()  # ids of jobs that have to finish first (afterok)
+        self.max_retries = max_retries  # how often a failed job is rerun
+        self.retry_delay = retry_delay  # seconds before the first retry, doubles
+        self.retries = 0  # how often the job was rerun so far
+        self._retry_at = None  # time.time() when a retrying job is pending again
+        self._exit = None  # exit code of the job, -signal if it was killed
+        self._out_path = None  # path to output file, if not derived from the job
+        self._err_path = None  # path to err file, if not derived from the job
+
+    @property
+    def type(self):
+        """Name of the class of the job, to identify the type of job."""
+        return self.__class__.__name__
+
+    @property
+    def created_at(self):
+        return _to_datetime(self._created)
+
+    @created_at.setter
+    def created_at(self, t):
+        self._created = _to_timestamp(t)
+
+    @property
+    def _start_time(self):
+        return _to_datetime(self._started)
+
+    @_start_time.setter
+    def _start_time(self, t):
+        self._started = _to_timestamp(t)
+
+    @property
+    def _end_time(self):
+        return _to_datetime(self._ended)
+
+    @_end_time.setter
+    def _end_time(self, t):
+        self._ended = _to_timestamp(t)
+
+    @property
+    def _out(self):
+        """Path to the output file."""
+        return self._out_path if self._out_path is not None else self._io_path("out")
+
+    @_out.setter
+    def _out(self, path):
+        self._out_path = path
+
+    @property
+    def _err(self):
+        """Path to the err file."""
+        return self._err_path if self._err_path is not None else self._io_path("err")
+
+    @_err.setter
+    def _err(self, path):
+        self._err_path = path
+
+    def _io_path(self, ext):
+        return None
+
+    @classmethod
+    def _slot_names(cls):
+        names = cls.__dict__.get("_all_slots")
+        if names is None:
+            names = [
+                name
+                for klass in reversed(cls.__mro__)
+                for name in klass.__dict__.get("__slots__", ())
+            ]
+            cls._all_slots = names
+        return names
+
+    def __getstate__(self):
+        state = {n: getattr(self, n) for n in self._slot_names() if hasattr(self, n)}
+        state.update(getattr(self, "__dict__", {}))  # attributes of subclasses
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            if key == "type":  # stored by jobs pickled before they had slots
+                continue
+            if key in self._interned and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, key, value)
 
     @abstractmethod
     def run(self):
@@ -50,10 +189,12 @@ class Job(ABC):
         """Return True if the cmd/script/function is still being run."""
         pass
 
-    # TODO: For requing, retrying jobs
-    # @property
-    # def is_finished(self):
-    #     return self._exit == 0 and not self.is_alive
+    def can_retry(self):
+        return self.retries < self.max_retries
+
+    def next_retry_delay(self):
+        """Exponential backoff: retry_delay, 2 * retry_delay, 4 * retry_delay..."""
+        return self.retry_delay * 2**self.retries
 
     def __str__(self):
         """List public job attributes as a ';' seperated list."""
@@ -71,25 +212,48 @@ class Job(ABC):
         items += [f"{t_run[0]}-{t_run[1]:02d}:{t_run[2]:02d}:{t_run[3]:02d}"]
         return "; ".join(items)
 
+    def row(self, now=None):
+        """Public job attributes for squeue, times in seconds, runtime None if unknown."""
+        if self._started is None:
+            runtime = 0.0
+        elif self._ended is not None:
+            runtime = self._ended - self._started
+        elif self.status == "running":
+            runtime = (time.time() if now is None else now) - self._started
+        else:
+            runtime = None
+        return {
+            "type": self.type,
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "owner": self.owner,
+            "priority": self.priority,
+            "submitted": self._created,
+            "runtime": runtime,
+        }
+
     @timedelta2dict
     def _get_runtime(self):
-        t0 = self._start_time
-        tfin = self._end_time
+        t0 = self._started
+        tfin = self._ended
         if t0 is None:
             return datetime.timedelta(0)
         elif tfin is None:
             if self.status == "running":
-                return datetime.datetime.now() - t0
+                return datetime.timedelta(seconds=time.time() - t0)
             else:
                 return float("nan")
         else:
-            return tfin - t0
+            return datetime.timedelta(seconds=tfin - t0)
 
     def __eq__(self, o: object) -> bool:
-        return self.__dict__ == o.__dict__
+        return type(self) is type(o) and self.__getstate__() == o.__getstate__()
 
 
 class BashJob(Job):
+    __slots__ = ("_cmd", "array_id", "array_index", "output_dir")
+
     def __init__(
         self,
         cmd="echo no cmd provided",
@@ -97,17 +261,52 @@ class BashJob(Job):
         priority: int = 0,
         name: str = None,
         output_dir: str = "./outputs",
+        max_retries: int = 0,
+        retry_delay: float = 10,
+        cpus: int = 1,
+        mem: int = 0,
     ):
-        super().__init__(id, priority)
+        super().__init__(id, priority, max_retries, retry_delay, cpus, mem)
         self.cmd = cmd
         self.status = "pending"
         self.name = name if name != None else self.get_script_name(cmd)
-        self.pid = None  # process id
-        self.ppid = None  # parent process id
+        self.array_id = None  # id of the job array the job is part of
+        self.array_index = None  # index of the job within its array
+        self.output_dir = output_dir
 
         os.makedirs(output_dir, exist_ok=True)
-        self._out = os.path.join(output_dir, f"{self.name}_{self.id}.out")
-        self._err = os.path.join(output_dir, f"{self.name}_{self.id}.err")
+
+    @property
+    def cmd(self):
+        """Command of the job, jobs of an array share the command of the array."""
+        if self.array_index is None:
+            return self._cmd
+        return self._cmd.replace("{idx}", str(self.array_index))
+
+    @cmd.setter
+    def cmd(self, cmd):
+        self._cmd = cmd
+
+    def _io_path(self, ext):
+        return os.path.join(self.output_dir, f"{self.name}_{self.id}.{ext}")
+
+    @classmethod
+    def array(cls, cmd, indices, **kwargs):
+        """Create a job array, one job per index.
+
+        The placeholder "{idx}" in `cmd` is replaced with the index of each job.
+        Jobs are copied from one template, so that large arrays can be created
+        quickly. Their ids have the form "<array_id>_<index>".
+        """
+        template = cls(cmd, **kwargs)
+        template.array_id = template.id
+        jobs = []
+        for idx in indices:
+            job = copy.copy(template)
+            job.id = f"{template.id}_{idx}"
+            job.array_index = idx
+            jobs.append(job)
+        return jobs
 
     def _byte2str(self, byte):
         try:
@@ -153,3 +352,56 @@ class BashJob(Job):
         return (
             psutil.pid_exists(self.pid) and psutil.Process(self.pid).ppid() == self.ppid
         )
+
+
+class CallableJob(Job):
+    """Job that calls a python function, i.e. CallableJob(math.sqrt, (2,)).
+
+    `func` and its arguments are pickled when the job is created and only
+    unpickled where the job runs, so the daemon does not need to import the
+    module of `func`. The return value of `func` is stored in `result`.
+    Workers send the pickled return value to the daemon as the result of the
+    job, a PoolWorker runs these jobs in warm processes.
+    """
+
+    __slots__ = ("_payload", "result")
+
+    def __init__(
+        self,
+        func=print,
+        args=("no function provided",),
+        kwargs=None,
+        id=None,
+        priority: int = 0,
+        name: str = None,
+        max_retries: int = 0,
+        retry_delay: float = 10,
+        cpus: int = 1,
+        mem: int = 0,
+    ):
+        super().__init__(id, priority, max_retries, retry_delay, cpus, mem)
+        self.status = "pending"
+        self.name = name if name is not None else func.__qualname__
+        self._payload = pickle.dumps((func, tuple(args), kwargs or {}))
+        self.result = None  # return value of func, where the job was run
+
+    def run(self):
+        func, args, kwargs = pickle.loads(self._payload)
+        try:
+            self.result = func(*args, **kwargs)
+        except Exception:
+            self._exit = 1
+            return 1, None, traceback.format_exc()
+        self._exit = 0
+        return 0, self.result, None
+
+    def kill(self):
+        # jobs run by a pool share their process with other jobs, i.e. they
+        # have no pid and can not be killed, their result is ignored instead
+        if self.pid is not None:
+            psutil.Process(self.pid).kill()
+
+    def check_alive(self):
+        if self.pid is None:
+            return self.status == "running"
+        return psutil.pid_exists(self.pid)
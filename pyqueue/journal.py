@@ -0,0 +1,127 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import gc
+import os
+import pickle
+import time
+
+from pyqueue.utils import get_logger
+
+log = get_logger("JOURNAL")
+
+
+class Journal:
+    """Append-only write-ahead log of all changes made to a Queue.
+
+    Every change is written as a pickled record ("append", job),
+    ("update", id, attrs) or ("remove", id) to `path`. Records are flushed
+    right away, but only fsynced every `sync_every` records or `sync_interval`
+    seconds. Once `compact_every` records were written, the journal is
+    compacted: all current jobs are written to a snapshot at
+    `path + ".snapshot"` and the journal is truncated.
+    """
+
+    def __init__(self, path, sync_every=100, sync_interval=1.0, compact_every=100_000):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.num_records = 0  # records written since the last compaction
+        self._unsynced = 0
+        self._t_sync = time.time()
+        self._file = open(self.path, "ab")
+
+    def log_append(self, job):
+        self._write(("append", job))
+
+    def log_update(self, id, attrs):
+        self._write(("update", id, attrs))
+
+    def log_remove(self, id):
+        self._write(("remove", id))
+
+    def _write(self, record):
+        pickle.dump(record, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+        self.num_records += 1
+        self._unsynced += 1
+        if (
+            self._unsynced >= self.sync_every
+            or time.time() - self._t_sync > self.sync_interval
+        ):
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._t_sync = time.time()
+
+    def needs_compaction(self):
+        return self.num_records >= self.compact_every
+
+    def compact(self, jobs):
+        """Write `jobs` to a new snapshot and truncate the journal."""
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(list(jobs), f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)  # atomic, old snapshot stays valid
+
+        self._file.close()
+        self._file = open(self.path, "wb")
+        self.sync()
+        self.num_records = 0
+        log.info(f"Compacted journal {self.path}")
+
+    def replay(self):
+        """Rebuild the jobs from the last snapshot and the journal.
+
+        Returns:
+            list of jobs in submission order
+        """
+        # the garbage collector would repeatedly scan all the objects that are
+        # created while loading, which more than doubles the time to replay
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._replay()
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def _replay(self):
+        jobs = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                jobs = {job.id: job for job in pickle.load(f)}
+
+        num_records = 0
+        with open(self.path, "rb") as f:
+            unpickler = pickle.Unpickler(f)
+            while True:
+                try:
+                    record = unpickler.load()
+                except EOFError:
+                    break
+                except pickle.UnpicklingError:
+                    log.warning(f"Journal {self.path} ends with a truncated record")
+                    break
+                num_records += 1
+                if record[0] == "append":
+                    jobs[record[1].id] = record[1]
+                elif record[0] == "update" and record[1] in jobs:
+                    for key, value in record[2].items():
+                        setattr(jobs[record[1]], key, value)
+                elif record[0] == "remove":
+                    jobs.pop(record[1], None)
+        self.num_records = num_records
+        log.info(f"Replayed {len(jobs)} jobs from {num_records} journal records")
+        return list(jobs.values())
+
+    def close(self):
+        self.sync()
+        self._file.close()
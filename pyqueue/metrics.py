@@ -0,0 +1,112 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import math
+
+# timings of jobs recorded by the daemon, in seconds
+METRICS = {
+    "wait": "from the time the job last became pending until a worker got it",
+    "dispatch": "from a worker getting the job until it reported the job as running",
+    "runtime": "from the start until the end of the job",
+}
+
+
+class Histogram:
+    """Streaming histogram of durations in log spaced buckets.
+
+    The first bucket counts values below `lowest`, bucket i > 0 those in
+    [lowest * growth**(i - 1), lowest * growth**i) and the last one also all
+    values above `highest`. Recording a value takes constant time and memory,
+    percentiles are exact up to a factor of `growth` (about 9% by default).
+    """
+
+    def __init__(self, lowest=1e-4, highest=1e6, growth=2 ** (1 / 8)):
+        self.lowest = lowest
+        self.growth = growth
+        self._per_octave = 1 / math.log2(growth)
+        self.counts = [0] * (self._index(highest) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def _index(self, value):
+        if value < self.lowest:
+            return 0
+        return int(math.log2(value / self.lowest) * self._per_octave) + 1
+
+    def record(self, value):
+        value = max(value, 0.0)  # i.e. clocks of workers and daemon differ
+        self.counts[min(self._index(value), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Add the counts of a histogram with the same buckets."""
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Upper bound of the bucket of the `p`th percentile, None if empty."""
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.lowest * self.growth**i, self.max)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            **{f"p{p}": self.percentile(p) for p in [50, 90, 99]},
+            "max": self.max,
+        }
+
+
+class Metrics:
+    """Histograms of the timings of jobs, by owner and type of the jobs."""
+
+    def __init__(self):
+        self._histograms = {}  # (metric, owner, type) -> Histogram
+
+    def record(self, metric, seconds, job):
+        key = (metric, job.owner, job.type)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.record(seconds)
+
+    def summary(self, by=()):
+        """Count, mean, percentiles and max of each metric, i.e. for each owner.
+
+        Args:
+            by: attributes to group by, "owner" and/or "type". Groups are named
+                by their values joined by "/", all jobs are in the group "all".
+
+        Returns:
+            {metric: {group: summary of the histogram}}
+        """
+        unknown = set(by) - {"owner", "type"}
+        if unknown:
+            raise ValueError(f"Can not group timings by {sorted(unknown)}")
+        merged = {}
+        for (metric, owner, type), histogram in self._histograms.items():
+            values = {"owner": owner, "type": type}
+            group = "/".join(str(values[attr]) for attr in by) or "all"
+            groups = merged.setdefault(metric, {})
+            if group not in groups:
+                groups[group] = Histogram()
+            groups[group].merge(histogram)
+        return {
+            metric: {
+                group: histogram.summary()
+                for group, histogram in sorted(merged[metric].items())
+            }
+            for metric in METRICS
+            if metric in merged
+        }
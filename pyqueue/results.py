@@ -0,0 +1,114 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import mmap
+import os
+import shutil
+import tempfile
+import xmlrpc.client
+from collections import OrderedDict
+
+CHUNK_SIZE = 2**20  # bytes sent per call when results are up- or downloaded
+
+
+def to_bytes(data):
+    """Bytes sent over XML-RPC arrive as xmlrpc.client.Binary."""
+    if isinstance(data, xmlrpc.client.Binary):
+        return data.data
+    return bytes(data)
+
+
+class ResultStore:
+    """Results of jobs as bytes, kept in memory or spilled to files.
+
+    Results of up to `inline_limit` bytes are kept in memory, as long as all
+    of them together take at most `max_inline` bytes. Beyond that, the least
+    recently used are written to files in `spill_dir`. Larger results are
+    written to a file while they are uploaded and are read back in chunks
+    through mmap, so they are never loaded into memory as a whole. Without a
+    `spill_dir`, a temporary one is created once a result is spilled.
+    """
+
+    def __init__(self, spill_dir=None, inline_limit=CHUNK_SIZE, max_inline=2**26):
+        self._tmp_dir = spill_dir is None  # removed on close
+        self.spill_dir = spill_dir
+        self.inline_limit = inline_limit
+        self.max_inline = max_inline
+        self._inline = OrderedDict()  # job id -> bytearray, least recently used first
+        self._inline_size = 0
+        self._spilled = {}  # job id -> size of the file
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            for name in os.listdir(spill_dir):  # results of a previous daemon
+                job_id, ext = os.path.splitext(name)
+                if ext == ".result":
+                    self._spilled[job_id] = os.path.getsize(self._path(job_id))
+
+    def _path(self, job_id):
+        return os.path.join(self.spill_dir, f"{job_id}.result")
+
+    def __contains__(self, job_id):
+        return job_id in self._inline or job_id in self._spilled
+
+    def __len__(self):
+        return len(self._inline) + len(self._spilled)
+
+    def size(self, job_id):
+        if job_id in self._inline:
+            return len(self._inline[job_id])
+        return self._spilled[job_id]
+
+    def write(self, job_id, data, offset=0):
+        """Write a chunk of a result, a chunk at offset 0 starts a new result."""
+        if offset == 0:
+            self.remove(job_id)
+            self._inline[job_id] = bytearray()
+        elif offset != self.size(job_id):
+            raise ValueError(f"Expected the chunk at {self.size(job_id)}, not {offset}")
+
+        if job_id in self._inline:
+            if len(self._inline[job_id]) + len(data) <= self.inline_limit:
+                self._inline[job_id] += data
+                self._inline_size += len(data)
+                self._inline.move_to_end(job_id)
+                self._evict()
+                return
+            self._spill(job_id)
+        with open(self._path(job_id), "ab") as f:
+            f.write(data)
+        self._spilled[job_id] += len(data)
+
+    def read(self, job_id, offset=0, size=CHUNK_SIZE):
+        """Read a chunk of a result, empty once `offset` reaches its end."""
+        if job_id in self._inline:
+            self._inline.move_to_end(job_id)
+            return bytes(self._inline[job_id][offset : offset + size])
+        if offset >= self._spilled[job_id]:
+            return b""
+        with open(self._path(job_id), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return m[offset : offset + size]
+
+    def remove(self, job_id):
+        data = self._inline.pop(job_id, None)
+        if data is not None:
+            self._inline_size -= len(data)
+        if self._spilled.pop(job_id, None) is not None:
+            os.remove(self._path(job_id))
+
+    def _spill(self, job_id):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="pyqueue_results_")
+        data = self._inline.pop(job_id)
+        self._inline_size -= len(data)
+        with open(self._path(job_id), "wb") as f:
+            f.write(data)
+        self._spilled[job_id] = len(data)
+
+    def _evict(self):
+        while self._inline_size > self.max_inline:
+            self._spill(next(iter(self._inline)))
+
+    def close(self):
+        if self._tmp_dir and self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -0,0 +1,368 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import bisect
+import heapq
+import itertools
+from abc import ABC, abstractmethod
+from collections import defaultdict
+
+# tie-breaker for heap entries, shared so that entries of different heaps
+# compare in submission order (first come, first served)
+_seq = itertools.count()
+
+# attributes of jobs that schedulers order or group pending jobs by
+SCHEDULING_ATTRS = ["priority", "owner", "cpus", "mem"]
+
+
+def demand(job):
+    """Resources a job needs to run."""
+    return {"cpus": job.cpus, "mem": job.mem}
+
+
+def fits(job, resources=None):
+    """Whether `job` can run with the free `resources` of a worker (None: any)."""
+    return fits_demand(demand(job), resources)
+
+
+def fits_demand(need, resources=None):
+    if resources is None:
+        return True
+    return all(
+        amount <= resources.get(key, float("inf")) for key, amount in need.items()
+    )
+
+
+class Scheduler(ABC):
+    """Decides which of the pending jobs of a Queue is dispatched next.
+
+    The queue adds every job that becomes pending and removes jobs that stop
+    being pending without being dispatched (i.e. cancelled jobs). Jobs that
+    need more resources than any worker has must not hold up the others.
+    """
+
+    capacities = None  # resources of each registered worker, None if unknown
+
+    def set_capacities(self, capacities):
+        """Tell the scheduler the resources of the workers, i.e. [{"cpus": 8}]."""
+        self.capacities = capacities
+
+    def fits_any_worker(self, need):
+        """Whether some worker could run a job that needs `need`, True if unknown."""
+        return self.capacities is None or any(
+            fits_demand(need, capacity) for capacity in self.capacities
+        )
+
+    @abstractmethod
+    def add(self, job):
+        pass
+
+    @abstractmethod
+    def remove(self, job):
+        """Forget a job, does nothing if the job was already dispatched."""
+        pass
+
+    @abstractmethod
+    def pop(self, resources=None):
+        """Remove and return the next job to run with the free `resources`.
+
+        Raises:
+            IndexError: if there is no job, or no job that may run now.
+        """
+        pass
+
+    @abstractmethod
+    def __len__(self):
+        """Number of pending jobs."""
+        pass
+
+
+class PriorityScheduler(Scheduler):
+    """Highest priority first, first come first served among equal priorities.
+
+    Jobs are kept in a heap. Removed jobs stay in the heap until they reach its
+    top, so every operation takes O(log n). The next job is only dispatched if
+    it fits the given resources, lower priority jobs are never run before it.
+    Jobs that fit none of the workers are set aside until the workers change.
+    """
+
+    def __init__(self):
+        self._heap = []  # entries (key, seq, job)
+        self._valid = {}  # id -> seq of the valid heap entry of a job
+        self._parked = {}  # id -> heap entry of a valid job that fits no worker
+
+    def set_capacities(self, capacities):
+        super().set_capacities(capacities)
+        for entry in self._parked.values():  # parked again if they still do not fit
+            heapq.heappush(self._heap, entry)
+        self._parked.clear()
+
+    def key(self, job):
+        """Jobs with the smallest key are dispatched first."""
+        return -job.priority
+
+    def add(self, job):
+        seq = next(_seq)
+        self._valid[job.id] = seq
+        heapq.heappush(self._heap, (self.key(job), seq, job))
+
+    def remove(self, job):
+        self._valid.pop(job.id, None)
+        self._parked.pop(job.id, None)
+
+    def peek(self):
+        """Heap entry (key, seq, job) of the next job."""
+        while self._heap:
+            entry = self._heap[0]
+            job = entry[2]
+            if self._valid.get(job.id) != entry[1]:
+                heapq.heappop(self._heap)  # stale entry
+            elif not self.fits_any_worker(demand(job)):
+                self._parked[job.id] = heapq.heappop(self._heap)
+            else:
+                return entry
+        raise IndexError("pop from empty queue")
+
+    def pop(self, resources=None):
+        job = self.peek()[2]
+        if not fits(job, resources):
+            raise IndexError("the next job does not fit the free resources")
+        heapq.heappop(self._heap)
+        del self._valid[job.id]
+        return job
+
+    def __len__(self):
+        return len(self._valid) - len(self._parked)
+
+
+class AgingScheduler(PriorityScheduler):
+    """Priority scheduling where waiting jobs slowly rise in priority.
+
+    A job that was submitted t seconds ago has the effective priority
+    `priority + rate * t`. Since all jobs age at the same rate, their order
+    does not change while they wait and the heap stays valid. The age is
+    counted from the submission, so a job keeps it when it is added again
+    (i.e. after an update, a retry or a restart of the daemon).
+    """
+
+    def __init__(self, rate=1 / 3600):
+        super().__init__()
+        self.rate = rate  # priority gained per second of waiting
+
+    def key(self, job):
+        return self.rate * job._created - job.priority
+
+
+class FairShareScheduler(Scheduler):
+    """Share the dispatched jobs between their owners.
+
+    Every owner has their own queue (by default ordered by priority). The
+    owner that has received the fewest jobs relative to their share is served
+    next (stride scheduling), so a user submitting many jobs does not starve
+    the others. An owner that had no pending jobs (or none that fits any of
+    the workers) starts at the usage of the last served owner, and does not
+    get to make up for the time they were idle.
+    If the next job of the owner to be served does not fit the free resources,
+    no job is dispatched.
+    """
+
+    def __init__(self, shares=None, policy=PriorityScheduler):
+        self.shares = {} if shares is None else shares  # owner -> weight, default 1
+        self.policy = policy  # creates the queue of each owner
+        self._queues = {}  # owner -> scheduler of their pending jobs
+        self._usage = defaultdict(float)  # owner -> dispatched jobs / share
+        self._heap = []  # entries (usage, seq, owner) of owners with pending jobs
+        self._valid = {}  # owner -> seq of their valid heap entry
+        self._vtime = 0.0  # usage of the last served owner
+
+    def add(self, job):
+        owner = job.owner
+        if owner not in self._queues:
+            self._queues[owner] = self.policy()
+            self._queues[owner].set_capacities(self.capacities)
+        self._queues[owner].add(job)
+        self._activate(owner)
+
+    def _activate(self, owner):
+        if owner not in self._valid and len(self._queues[owner]) > 0:
+            self._usage[owner] = max(self._usage[owner], self._vtime)
+            self._push(owner)
+
+    def set_capacities(self, capacities):
+        super().set_capacities(capacities)
+        for owner, queue in self._queues.items():
+            queue.set_capacities(capacities)
+            self._activate(owner)  # their jobs may fit the new workers
+
+    def _push(self, owner):
+        seq = next(_seq)
+        self._valid[owner] = seq
+        heapq.heappush(self._heap, (self._usage[owner], seq, owner))
+
+    def remove(self, job):
+        if job.owner in self._queues:
+            self._queues[job.owner].remove(job)
+
+    def pop(self, resources=None):
+        while self._heap:
+            usage, seq, owner = self._heap[0]
+            queue = self._queues[owner]
+            if self._valid.get(owner) != seq or len(queue) == 0:
+                heapq.heappop(self._heap)  # stale or all jobs were removed
+                if self._valid.get(owner) == seq:
+                    del self._valid[owner]
+                continue
+
+            try:
+                job = queue.pop(resources)
+            except IndexError:
+                if len(queue) > 0:
+                    raise
+                continue  # all their jobs fit none of the workers
+            heapq.heappop(self._heap)
+            self._vtime = usage
+            self._usage[owner] = usage + 1 / self.shares.get(owner, 1)
+            if len(queue) > 0:
+                self._push(owner)
+            else:
+                del self._valid[owner]
+            return job
+        raise IndexError("pop from empty queue")
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+
+class BackfillScheduler(Scheduler):
+    """Run smaller jobs on free resources that the next job does not fit.
+
+    Jobs are grouped by their shape (the resources they need), each group is
+    ordered by priority. A worker gets the highest priority job among the
+    first jobs of all groups that fit its free resources, so dispatching takes
+    O(shapes + log n).
+
+    Without runtime estimates no resources can be reserved for large jobs.
+    Instead, once the highest priority job was skipped `max_skips` times, no
+    smaller jobs are started until it could be dispatched.
+    """
+
+    def __init__(self, max_skips=100, policy=PriorityScheduler):
+        self.max_skips = max_skips
+        self.policy = policy  # creates the queue of each shape
+        self._queues = {}  # shape -> scheduler of the pending jobs of that shape
+        self._skips = defaultdict(int)  # id -> times smaller jobs were run instead
+
+    def add(self, job):
+        shape = tuple(sorted(demand(job).items()))
+        if shape not in self._queues:
+            self._queues[shape] = self.policy()
+            self._queues[shape].set_capacities(self.capacities)
+        self._queues[shape].add(job)
+
+    def set_capacities(self, capacities):
+        super().set_capacities(capacities)
+        for queue in self._queues.values():
+            queue.set_capacities(capacities)
+
+    def remove(self, job):
+        shape = tuple(sorted(demand(job).items()))
+        if shape in self._queues:
+            self._queues[shape].remove(job)
+        self._skips.pop(job.id, None)
+
+    def pop(self, resources=None):
+        heads = []
+        for queue in self._queues.values():
+            try:
+                heads.append((queue.peek(), queue))
+            except IndexError:
+                continue
+        if not heads:
+            raise IndexError("pop from empty queue")
+        heads.sort(key=lambda head: head[0][:2])
+
+        first_job = heads[0][0][2]
+        if (
+            not fits(first_job, resources)
+            and self._skips.get(first_job.id, 0) >= self.max_skips
+        ):
+            raise IndexError("waiting for resources to free up for the next job")
+        for (_, _, job), queue in heads:
+            if fits(job, resources):
+                queue.pop()
+                if job is first_job:
+                    self._skips.pop(job.id, None)
+                else:
+                    self._skips[first_job.id] += 1
+                return job
+        raise IndexError("no pending job fits the free resources")
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+
+class WorkerIndex:
+    """Free resources of the workers, sorted by free cpus and memory.
+
+    Finds the worker that a job fits best (the one with the fewest free cpus
+    that still fits it) with a binary search, so that jobs are packed onto as
+    few workers as possible and large holes are left for large jobs.
+    """
+
+    def __init__(self):
+        self._free = {}  # worker id -> (cpus, mem)
+        self._sorted = []  # entries (cpus, mem, worker id)
+
+    def update(self, worker_id, cpus, mem):
+        self.remove(worker_id)
+        self._free[worker_id] = (cpus, mem)
+        bisect.insort(self._sorted, (cpus, mem, worker_id))
+
+    def add(self, worker_id, cpus=0, mem=0):
+        """Change the free resources of a worker by `cpus` and `mem`."""
+        free_cpus, free_mem = self._free[worker_id]
+        self.update(worker_id, free_cpus + cpus, free_mem + mem)
+
+    def remove(self, worker_id):
+        if worker_id in self._free:
+            cpus, mem = self._free.pop(worker_id)
+            del self._sorted[bisect.bisect_left(self._sorted, (cpus, mem, worker_id))]
+
+    def free(self, worker_id):
+        cpus, mem = self._free[worker_id]
+        return {"cpus": cpus, "mem": mem}
+
+    def best_fit(self, job, candidates=None):
+        """Id of the worker that fits `job` best, None if it fits no worker.
+
+        Args:
+            candidates: only consider these workers, i.e. the idle ones.
+        """
+        need = demand(job)
+        start = bisect.bisect_left(self._sorted, (need["cpus"],))
+        for i in range(start, len(self._sorted)):
+            _, mem, worker_id = self._sorted[i]
+            if mem >= need["mem"] and (candidates is None or worker_id in candidates):
+                return worker_id
+        return None
+
+    def __contains__(self, worker_id):
+        return worker_id in self._free
+
+    def __len__(self):
+        return len(self._free)
+
+
+SCHEDULERS = {
+    "priority": PriorityScheduler,
+    "aging": AgingScheduler,
+    "fairshare": FairShareScheduler,
+    "backfill": BackfillScheduler,
+}
+
+
+def make_scheduler(name="priority", **kwargs):
+    """Create one of the SCHEDULERS by name."""
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler {name}, use one of {list(SCHEDULERS)}")
+    return SCHEDULERS[name](**kwargs)
@@ -0,0 +1,334 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import functools
+import hmac
+import http.client
+import ipaddress
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import threading
+import xmlrpc.client
+from urllib.parse import urlsplit
+from xmlrpc.server import SimpleXMLRPCRequestHandler
+
+DEFAULT_ADDRESS = "http://localhost:8000"  # overwritten by $PYQUEUE_ADDRESS
+
+# The daemon unpickles what clients send it, so anyone who can connect to it
+# can run code as the user of the daemon. A daemon that listens on a network
+# interface therefore only talks to clients that know its shared secret, which
+# clients and daemon read from $PYQUEUE_TOKEN.
+TOKEN_ENV = "PYQUEUE_TOKEN"
+TOKEN_HEADER = "X-Pyqueue-Token"  # of XML-RPC requests
+MAX_TOKEN_SIZE = 1024
+
+# Binary protocol: a connection starts with the token of the client (possibly
+# empty), then every message is a pickle (protocol 5) prefixed by its length.
+# Requests are (method, args, kwargs), responses (True, result) or (False, fault).
+HEADER = struct.Struct("!I")
+
+
+def send_msg(sock, obj):
+    send_bytes(sock, pickle.dumps(obj, protocol=5))
+
+
+def send_bytes(sock, data):
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_msg(rfile):
+    return pickle.loads(recv_bytes(rfile))
+
+
+def recv_bytes(rfile, max_size=None):
+    header = rfile.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise EOFError("connection was closed")
+    (size,) = HEADER.unpack(header)
+    if max_size is not None and size > max_size:
+        raise EOFError(f"message of {size} bytes is too large")
+    data = rfile.read(size)
+    if len(data) < size:
+        raise EOFError("connection was closed")
+    return data
+
+
+def get_token():
+    """Shared secret of daemon and clients, None if $PYQUEUE_TOKEN is not set."""
+    return os.environ.get(TOKEN_ENV) or None
+
+
+def check_token(expected, given):
+    """Whether a client sent the token of the server, any if the server has none."""
+    if expected is None:
+        return True
+    return hmac.compare_digest(expected.encode(), (given or "").encode())
+
+
+def is_loopback(host):
+    """Whether only clients on this machine can connect to `host`."""
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+class UnixSocketMixin:
+    """Lets a socketserver listen on a unix socket if its address is a path.
+
+    A socket file that was left behind by a server that is no longer running is
+    replaced, the socket file is removed when the server is closed.
+    """
+
+    def __init__(self, address, *args, **kwargs):
+        is_path = isinstance(address, str)
+        self.address_family = socket.AF_UNIX if is_path else socket.AF_INET
+        self._socket_path = None
+        super().__init__(address, *args, **kwargs)
+
+    def server_bind(self):
+        if self.address_family == socket.AF_UNIX:
+            remove_stale_socket(self.server_address)
+        super().server_bind()
+        if self.address_family == socket.AF_UNIX:
+            self._socket_path = self.server_address
+
+    def server_close(self):
+        super().server_close()
+        if self._socket_path is not None and os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        self._socket_path = None
+
+
+def remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)  # nobody is listening anymore
+            return
+    raise OSError(f"Another server is already listening on {path}")
+
+
+class XMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
+    def setup(self):
+        # TCP_NODELAY can only be set on TCP sockets
+        self.disable_nagle_algorithm = self.server.address_family != socket.AF_UNIX
+        super().setup()
+
+    def do_POST(self):
+        # before the request is read, its arguments are unpickled later on
+        if not check_token(self.server.token, self.headers.get(TOKEN_HEADER)):
+            self.send_error(403, f"Invalid or missing {TOKEN_ENV}")
+            return
+        super().do_POST()
+
+
+class KeepAliveXMLRPCRequestHandler(XMLRPCRequestHandler):
+    """Keeps connections open between requests, if the client supports it.
+
+    Only suitable for threaded servers, since a connection occupies the thread
+    handling it until the client closes it.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+
+class UnixStreamHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, *args, **kwargs):
+        super().__init__("localhost", *args, **kwargs)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = connect_unix_socket(self.socket_path)
+
+
+class UnixStreamTransport(xmlrpc.client.Transport):
+    """Transport for xmlrpc.client.ServerProxy that talks to a unix socket."""
+
+    def __init__(self, socket_path, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.socket_path = socket_path
+
+    def make_connection(self, host):
+        # reuse the connection like xmlrpc.client.Transport (HTTP keep-alive)
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        self._connection = host, UnixStreamHTTPConnection(self.socket_path)
+        return self._connection[1]
+
+
+def connect_unix_socket(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except FileNotFoundError:
+        sock.close()
+        raise ConnectionRefusedError(f"No server is listening on {path}")
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class BinaryRequestHandler(socketserver.StreamRequestHandler):
+    """Answer requests on a persistent connection until the client closes it."""
+
+    def handle(self):
+        try:
+            token = recv_bytes(self.rfile, MAX_TOKEN_SIZE).decode()
+        except (EOFError, OSError, UnicodeDecodeError):
+            return
+        if not check_token(self.server.token, token):
+            # answers the first request of the client, before it is unpickled
+            send_msg(self.connection, (False, f"Invalid or missing {TOKEN_ENV}"))
+            return
+        while True:
+            try:
+                method, args, kwargs = recv_msg(self.rfile)
+            except (EOFError, OSError):
+                return
+            try:
+                response = (True, self.server.dispatch(method, args, kwargs))
+            except Exception as exception:
+                # same format as the faults of SimpleXMLRPCServer
+                response = (False, f"{type(exception)}:{exception}")
+            try:
+                send_msg(self.connection, response)
+            except pickle.PicklingError as exception:
+                send_msg(self.connection, (False, f"{type(exception)}:{exception}"))
+
+
+class BinaryServer(
+    UnixSocketMixin, socketserver.ThreadingMixIn, socketserver.TCPServer
+):
+    """Server for the binary protocol with the interface of SimpleXMLRPCServer.
+
+    Listens on (host, port) or on a unix socket if `address` is a path. Every
+    connection is handled in its own thread. Methods of the registered
+    instance that pickle their inputs and outputs (see `utils.check_pickle`)
+    are called without it, since the protocol can send jobs as they are.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, bind_and_activate=True, token=None):
+        self.token = token  # clients have to send it first, see check_token
+        super().__init__(address, BinaryRequestHandler, bind_and_activate)
+        self.instance = None
+        self.funcs = {}
+
+    def register_instance(self, instance):
+        self.instance = instance
+
+    def register_function(self, function, name=None):
+        self.funcs[function.__name__ if name is None else name] = function
+
+    def dispatch(self, method, args, kwargs):
+        if method in self.funcs:
+            return self.funcs[method](*args, **kwargs)
+        if self.instance is None or method.startswith("_"):
+            raise Exception(f'method "{method}" is not supported')
+        func = getattr(self.instance, method)
+        without_pickling = getattr(func, "without_pickling", None)
+        if without_pickling is not None:
+            return without_pickling(self.instance, *args, **kwargs)
+        return func(*args, **kwargs)
+
+
+class BinaryServerProxy:
+    """Client for a BinaryServer, used like `xmlrpc.client.ServerProxy`.
+
+    Keeps one connection open for all calls. Calls from several threads are
+    serialized, so long-polling threads should use their own proxy.
+    """
+
+    def __init__(self, address, token=None):
+        self._address = address
+        self._token = token
+        self._sock = None
+        self._rfile = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if isinstance(self._address, str):
+            self._sock = connect_unix_socket(self._address)
+        else:
+            self._sock = socket.create_connection(self._address)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._rfile = self._sock.makefile("rb")
+        send_bytes(self._sock, (self._token or "").encode())
+
+    def _call(self, method, *args, **kwargs):
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._connect()
+                send_msg(self._sock, (method, args, kwargs))
+                ok, result = recv_msg(self._rfile)
+            except OSError:
+                self.close()
+                raise
+            except EOFError:
+                self.close()
+                # like http.client.RemoteDisconnected
+                raise ConnectionResetError("server closed the connection")
+        if not ok:
+            raise xmlrpc.client.Fault(1, result)
+        return result
+
+    def close(self):
+        if self._sock is not None:
+            self._rfile.close()
+            self._sock.close()
+        self._sock = None
+        self._rfile = None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return functools.partial(self._call, name)
+
+
+def parse_address(url):
+    """Split a daemon address into its protocol and (host, port) or socket path.
+
+    "http://<host>:<port>" refers to the XML-RPC server,
+    "pyq://<host>:<port>" to the binary protocol. With "http+unix://<path>" and
+    "pyq+unix://<path>" they listen on a unix socket instead, i.e.
+    "pyq+unix:///tmp/pyqueue.sock".
+    """
+    parts = urlsplit(url)
+    transport, _, family = parts.scheme.partition("+")
+    if transport not in ["http", "pyq"] or family not in ["", "unix"]:
+        raise ValueError(f"Unsupported protocol in daemon address {url}")
+    if family == "unix":
+        return transport, parts.netloc + parts.path
+    return transport, (parts.hostname, parts.port)
+
+
+def connect(url, token=None):
+    """Create a client for the daemon listening at `url`.
+
+    Args:
+        token: shared secret of the daemon, defaults to $PYQUEUE_TOKEN.
+    """
+    token = get_token() if token is None else token
+    transport, address = parse_address(url)
+    if transport == "pyq":
+        return BinaryServerProxy(address, token)
+    headers = [] if token is None else [(TOKEN_HEADER, token)]
+    if isinstance(address, str):
+        return xmlrpc.client.ServerProxy(
+            "http://localhost/",
+            transport=UnixStreamTransport(address, headers=headers),
+            allow_none=True,
+        )
+    return xmlrpc.client.ServerProxy(url, allow_none=True, headers=headers)
@@ -5,6 +5,7 @@ import codecs
 import datetime
 import logging
 import pickle
+import socket
 import time
 from collections.abc import Iterable
 
@@ -51,7 +52,14 @@ def is_up(server):
     return catch_connection_refused(server.sinfo)
 
 
+def make_worker_id(pid, host=None):
+    """Id of a worker that is unique across hosts, i.e. "node1:1234"."""
+    return f"{socket.gethostname() if host is None else host}:{pid}"
+
+
 def fix_datetime(xmlrpc_datetime):
+    if isinstance(xmlrpc_datetime, datetime.datetime):
+        return xmlrpc_datetime  # the binary protocol sends datetimes as they are
     return datetime.datetime.strptime(str(xmlrpc_datetime), "%Y%m%dT%H:%M:%S")
 
 
@@ -125,4 +133,5 @@ def check_pickle(func, *args, **kwargs):
             out = try_pickle(out)
         return out
 
+    wrapped_func_pickle.without_pickling = func  # for protocols that can send jobs
     return wrapped_func_pickle
@@ -1,36 +1,97 @@
 # This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
 # under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
 
+import argparse
 import datetime
+import functools
+import importlib
 import logging
+import multiprocessing
 import os
+import pickle
+import signal
+import socket
+import tempfile
+import threading
 import time
 import xmlrpc.client
-from signal import signal
 from abc import ABC, abstractmethod
 
+import psutil
+
 from pyqueue.helpers import timedelta2dict
 from pyqueue.jobs import *
-from pyqueue.utils import get_logger, try_unpickle
+from pyqueue.results import CHUNK_SIZE
+from pyqueue.transport import DEFAULT_ADDRESS, connect
+from pyqueue.utils import get_logger, make_worker_id, try_unpickle
 
 log = get_logger("WORKER")
 
+# errors of calls to a daemon that is down or restarting, the calls are retried
+CONNECTION_ERRORS = (OSError, xmlrpc.client.ProtocolError)
+MAX_BACKOFF = 30  # max. seconds between retries
+# seconds between heartbeats while the daemon is down, so that the worker
+# registers again before the daemon requeues its jobs after a restart
+RETRY_INTERVAL = 1
+
+
 class BaseWorker(ABC):
-    def __init__(self, queue_server=None):
-        self.current_job = None
+    def __init__(self, queue_server=None, slots=1, cpus=None, mem=None):
+        self.jobs = {}  # pid of the child process -> job it runs
+        # guards self.jobs, which the threads of a worker change concurrently
+        self._jobs_changed = threading.Condition()
+        self.slots = slots  # max. number of jobs that are run at once
+        # capacity shared by the jobs, defaults to the whole machine
+        self.cpus = psutil.cpu_count() if cpus is None else cpus
+        self.mem = psutil.virtual_memory().total // 2**20 if mem is None else mem
         self.pid = os.getpid()
+        self.host = socket.gethostname()
+        self.id = make_worker_id(self.pid, self.host)  # unique across hosts
         self._tup = datetime.datetime.now()
         self._tidle = None
         self.queue_server = queue_server
         self.status = "idle"
+        self.lease_timeout = None  # as told by the daemon on registration
 
     def register_with_queue_server(self, server):
         self.queue_server = server
-        self.queue_server.register_worker(# TODO: sent self and extract attrs server side ? 
-            self.pid,
-            {"t_up": self._tup, "status": self.status, "current_job": self.current_job},
+        # TODO: sent self and extract attrs server side ?
+        self.lease_timeout = self.queue_server.register_worker(
+            self.id, self.get_registration()
         )
 
+    def get_registration(self):
+        """Attributes the daemon tracks for this worker."""
+        return {
+            "host": self.host,
+            "pid": self.pid,
+            "t_up": self._tup,
+            "status": self.status,
+            "slots": self.get_slots(),
+            "cpus": self.cpus,
+            "mem": self.mem,
+        }
+
+    def get_slots(self):
+        """Id of the job run in each slot, None for free slots."""
+        job_ids = self.get_job_ids()
+        return job_ids + [None] * (self.slots - len(job_ids))
+
+    def get_job_ids(self):
+        with self._jobs_changed:
+            return [job.id for job in self.jobs.values()]
+
+    def has_free_slot(self):
+        return len(self.jobs) < self.slots and self.get_free_resources()["cpus"] > 0
+
+    def get_free_resources(self):
+        with self._jobs_changed:
+            jobs = list(self.jobs.values())
+        return {
+            "cpus": self.cpus - sum(job.cpus for job in jobs),
+            "mem": self.mem - sum(job.mem for job in jobs),
+        }
+
     def show_uptime(self):
         dt = datetime.datetime.now() - self._tup
         return f"{dt.days}:{dt.hours}:{dt.minutes}:{dt.seconds}"
@@ -42,13 +103,14 @@ class BaseWorker(ABC):
         else:
             return datetime.datetime.now() - self._tidle
 
-    def update_worker_status(self, job_id, status="idle"):
-        self.current_job = job_id
-        self.queue_server.update_worker_status( # TODO: sent self and extract attrs server side ?
-            self.pid, {"status": status, "current_job": self.current_job}
+    def update_worker_status(self):
+        status = "busy" if len(self.jobs) > 0 else "idle"
+        self.queue_server.update_worker_status(  # TODO: sent self and extract attrs server side ?
+            self.id, {"status": status, "slots": self.get_slots()}
         )
-        if status == "idle":
+        if (status == "idle" and self.status != "idle") or self._tidle is None:
             self._tidle = datetime.datetime.now()
+        self.status = status
 
     @abstractmethod
     def start(self):
@@ -58,92 +120,430 @@ class BaseWorker(ABC):
     def kill(self):
         pass
 
+
 class Worker(BaseWorker):
-    def __init__(self, queue_server=None):
-        super().__init__(queue_server=queue_server)
+    """Worker that runs up to `slots` jobs at once, each in a forked process.
+
+    Finished jobs are collected by a separate thread that blocks in `waitpid`
+    and reports the exit code of each job to the daemon as soon as it exits.
+    If `address` is given, that thread opens its own connection to the daemon.
+    Every `heartbeat_interval` seconds the worker renews its lease with the
+    daemon. If the lease expired, the daemon has requeued the jobs of the
+    worker already, so they are killed and the worker registers again. While
+    the daemon can not be reached, the heartbeat is retried every
+    RETRY_INTERVAL seconds, so the worker rejoins a restarted daemon quickly.
+    The worker shuts down after `idle_timeout` seconds without jobs, never if
+    it is None (i.e. when the workers are managed by the daemon's autoscaler).
+    """
+
+    def __init__(
+        self,
+        queue_server=None,
+        poll_timeout=5,
+        slots=1,
+        address=None,
+        cpus=None,
+        mem=None,
+        idle_timeout=60,
+        heartbeat_interval=5,
+    ):
+        super().__init__(queue_server=queue_server, slots=slots, cpus=cpus, mem=mem)
+        self.poll_timeout = poll_timeout  # max. seconds to wait for a new job
+        self.idle_timeout = idle_timeout  # seconds until an idle worker shuts down
+        self.address = address  # address of the daemon
+        self.heartbeat_interval = heartbeat_interval
+        self._exited = {}  # pid -> exit code of reaped jobs that were not reported
+        self._results = {}  # pid -> result of an exited job, if it was not read
 
     def start(self):
         log.info("Starting worker")
         assert self.queue_server != None, "No queue sever was registered."
-        self.update_worker_status(None, "idle")
+        self.update_worker_status()
+        threading.Thread(target=self._reap_forever, daemon=True).start()
+        threading.Thread(target=self._heartbeat_forever, daemon=True).start()
 
         while True:
-            if self.queue_server.get_num_pending_jobs() > 0:
-                job = self.queue_server.acquire_job()
-                job = try_unpickle(job)
-                self.update_worker_status(job.id, "busy")
-
-                newpid = os.fork()
-                if newpid == 0:
-                    job.run()
-                    os._exit(0)
-                else:
-                    job.pid = newpid
-                    job.ppid = self.pid
-                    self.queue_server.update_job_status(
-                        job.id,
-                        {
-                            "status": "running",
-                            "pid": newpid,
-                            "ppid": job.ppid,
-                            "_start_time": datetime.datetime.now(),
-                        },
-                    )
-                    log.info(
-                        f"Submitted job [ID:{job.id}] [PID:{job.pid}] [CMD:{job.cmd}]."
+            with self._jobs_changed:
+                self._jobs_changed.wait_for(self.has_free_slot)
+            t_poll = time.time()
+            # long-poll, returns as soon as a job is queued
+            try:
+                job = try_unpickle(
+                    self.queue_server.try_acquire_job(
+                        self.poll_timeout, self.get_free_resources(), self.id
                     )
-                time.sleep(0.5)
-
-                while self.queue_server.check_alive(job.id):
-                    # TODO: HERE wait for scancel signal or job to finish
-                    # job.kill()
-                    # while self.queue_server.check_alive(job.id):
-                    # check finished
-                    # if exit 0 -> finished
-                    # if exit 1 -> failed
-                    # check scancel
-                    # if scancel job.kill()
-
-                    pid = self.queue_server.get_job_pid(job.id)
-                    if pid != None:
-                        os.waitpid(pid, 0)
-                        time.sleep(0.5)
-                    else:
-                        raise ValueError("pid of job was not valid.")
-                    self.queue_server.update_job_status(
-                        job.id,
-                        {
-                            "exit": 0,
-                            "status": "finished",
-                            "_end_time": datetime.datetime.now(),
-                        },
-                    )  # reset ppid/pid ?
-
-                    # try:
-                    #     self.queue_server.update_job_status(job.id, {"exit": 0, "status": "finished"})
-                    #     job.run()
-                    # except:
-                    #     self.queue_server.update_job_status(job.id, {"exit": 1, "status": "failed"})
-
-                self.update_worker_status(None, "idle")
-            else:
-                if self.idletime()["seconds"] < 5:
-                    log.info("Worker is currently idle and accepting jobs")
-                time.sleep(5)
-
-            if self.idletime()["minutes"] > 1:
-                self.queue_server.deregister_worker(self.pid)
+                )
+            except CONNECTION_ERRORS as exception:
+                log.error(f"Could not reach the daemon: {exception!r}")
+                job = None
+            if job is not None:
+                self.run_job(job)
+                continue
+
+            if not self.jobs and self.idletime()["seconds"] < 5:
+                log.info("Worker is currently idle and accepting jobs")
+            # daemons that do not support long-polling return immediately
+            time.sleep(max(0, self.poll_timeout - (time.time() - t_poll)))
+
+            if self.idle_timeout is not None and self._is_idle_for(self.idle_timeout):
+                try:
+                    self.queue_server.deregister_worker(self.id)
+                except CONNECTION_ERRORS as exception:
+                    # the worker has no jobs, the daemon drops it once the lease expires
+                    log.error(f"Could not deregister: {exception!r}")
                 break  # shut down worker
         log.info("Worker was shut down due to inactivity.")
 
+    def _call_daemon(self, method, *args):
+        """Call `method` of the daemon, retried with backoff while it is down."""
+        failures = 0
+        while True:
+            try:
+                return getattr(self.queue_server, method)(*args)
+            except CONNECTION_ERRORS as exception:
+                failures += 1
+                log.error(f"Could not reach the daemon: {exception!r}")
+                time.sleep(min(2**failures, MAX_BACKOFF))
+
+    def _is_idle_for(self, seconds):
+        if self.jobs or self._tidle is None:
+            return False
+        return (datetime.datetime.now() - self._tidle).total_seconds() > seconds
+
+    def run_job(self, job):
+        with self._jobs_changed:
+            newpid = os.fork()
+            if newpid == 0:
+                self._run_in_child(job)
+
+            job.pid = newpid
+            job.ppid = self.pid
+            self.jobs[newpid] = job
+            self._jobs_changed.notify_all()
+        # the job runs already, a daemon that restarted meanwhile adopts it
+        self._call_daemon("job_started", job.id, newpid, self.id)
+        log.info(f"Submitted job [ID:{job.id}] [PID:{job.pid}] [NAME:{job.name}].")
+
+    def _run_in_child(self, job):
+        try:
+            returncode = job.run()[0]
+            if isinstance(job, CallableJob) and returncode == 0:
+                # the parent uploads the return value once the child exited
+                with open(result_path(job), "wb") as f:
+                    pickle.dump(job.result, f)
+        except BaseException:
+            os._exit(1)
+        # exit codes are limited to 0-255
+        os._exit(returncode if 0 <= returncode < 256 else 1)
+
+    def _reap_forever(self):
+        # the main thread may be blocked in a long-poll, hence own connection
+        reporter = self.queue_server if self.address is None else connect(self.address)
+        failures = 0
+        while True:
+            with self._jobs_changed:
+                self._jobs_changed.wait_for(lambda: self._job_pids() or self._exited)
+            try:
+                self.reap_jobs(block=True, reporter=reporter)
+                failures = 0
+                continue
+            except CONNECTION_ERRORS as exception:
+                log.error(f"Could not report finished jobs: {exception!r}")
+            except Exception:  # i.e. a Fault, the thread has to keep reaping
+                log.exception("Could not report finished jobs")
+            # the exit codes are kept and reported with the next attempt
+            failures += 1
+            time.sleep(min(2**failures, MAX_BACKOFF))
+
+    def _heartbeat_forever(self):
+        server = self.queue_server if self.address is None else connect(self.address)
+        failed = False
+        while True:
+            interval = self.heartbeat_interval
+            if self.lease_timeout is not None:
+                # beat a few times per lease, so a late heartbeat does no harm
+                interval = min(interval, self.lease_timeout / 3)
+            if failed:
+                # the lease of a restarted daemon is unknown, it may be shorter
+                interval = min(interval, RETRY_INTERVAL)
+            time.sleep(interval)
+            try:
+                self.heartbeat(server)
+                failed = False
+            except CONNECTION_ERRORS as exception:
+                # i.e. the daemon is restarting, the worker rejoins once it is up
+                if not failed:
+                    log.error(f"Heartbeat failed: {exception!r}")
+                failed = True
+
+    def heartbeat(self, server):
+        """Renew the lease and follow the orders of the daemon."""
+        orders = server.heartbeat(self.id)
+        if not orders["registered"]:
+            self.rejoin(server)
+            return
+        if orders["cancel"]:
+            self.cancel_jobs(orders["cancel"])
+        if orders["stop"]:
+            log.warning("Stopped by the daemon")
+            server.deregister_worker(self.id)  # requeues the jobs
+            self.cancel_jobs(self.get_job_ids())
+            self.kill()
+
+    def rejoin(self, server):
+        """Register again, i.e. after the lease expired or the daemon restarted.
+
+        The daemon keeps the jobs that it still knows to run on this worker,
+        the others (i.e. those requeued when the lease expired) are cancelled
+        with the next heartbeat.
+        """
+        log.warning("Not registered with the daemon, registering again")
+        self.lease_timeout = server.register_worker(self.id, self.get_registration())
+
+    def cancel_jobs(self, job_ids):
+        """Kill the processes of jobs, the reaper thread reports them."""
+        with self._jobs_changed:
+            jobs = [job for job in self.jobs.values() if job.id in job_ids]
+        for job in jobs:
+            try:
+                job.kill()
+            except psutil.NoSuchProcess:
+                pass
+            log.info(f"Cancelled job [ID:{job.id}] [PID:{job.pid}].")
+
+    def _job_pids(self):
+        """Pids of the processes of the jobs, jobs run in a pool have none."""
+        with self._jobs_changed:
+            return [
+                pid
+                for pid in self.jobs
+                if isinstance(pid, int) and pid not in self._exited
+            ]
+
+    def reap_jobs(self, block=False, reporter=None):
+        """Collect finished jobs and report them to the daemon.
+
+        Only the processes of jobs are reaped, other children (i.e. those of a
+        multiprocessing pool) are left to whoever started them.
+
+        Args:
+            block: wait for at least one job to finish.
+            reporter: connection to the daemon, defaults to `queue_server`.
+        """
+        while True:
+            for pid in self._job_pids():
+                try:
+                    done, status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    self._exited[pid] = 1  # reaped elsewhere, the exit code is lost
+                    continue
+                if done:
+                    self._exited[pid] = exit_code(status)
+            reported = bool(self._exited)
+            for pid, code in list(self._exited.items()):
+                self.finish_job(pid, code, reporter, self._results.get(pid))
+                del self._exited[pid]
+                self._results.pop(pid, None)
+            if reported or not block or not self._job_pids():
+                return
+            self._wait_for_child()
+
+    def _wait_for_child(self):
+        """Block until a child process has exited, without reaping it."""
+        try:
+            info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOWAIT)
+        except ChildProcessError:
+            return
+        if info is not None and info.si_pid not in self._job_pids():
+            # not a job, i.e. a process of the pool, which reaps it on its own
+            time.sleep(0.1)
+
+    def finish_job(self, pid, exit_code, reporter=None, result=None):
+        with self._jobs_changed:
+            job = self.jobs.get(pid)
+        if job is None:
+            return  # not one of the job processes
+        reporter = self.queue_server if reporter is None else reporter
+        self.upload_result(reporter, job, result)
+        # report first, so the daemon frees the slot before it is used again
+        reporter.job_finished(job.id, exit_code, self.id)
+        with self._jobs_changed:
+            self.jobs.pop(pid, None)
+            if not self.jobs:
+                self._tidle = datetime.datetime.now()
+            self._jobs_changed.notify_all()
+        # pool jobs are too many and short to log each of them
+        level = logging.DEBUG if job.pid is None else logging.INFO
+        log.log(
+            level, f"Finished job [ID:{job.id}] [PID:{pid}] with exit code {exit_code}."
+        )
+
+    def upload_result(self, reporter, job, result=None):
+        """Send the result of a job to the daemon in chunks of CHUNK_SIZE bytes.
+
+        `result` defaults to the output file of a job, or the return value a
+        forked CallableJob left behind. Empty results are not sent.
+        """
+        if result is not None:
+            chunks = (
+                result[i : i + CHUNK_SIZE] for i in range(0, len(result), CHUNK_SIZE)
+            )
+            for index, chunk in enumerate(chunks):
+                reporter.put_result(job.id, index, chunk, self.id)
+            return
+        path = result_path(job)
+        if path is None or not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            for index, chunk in enumerate(iter(lambda: f.read(CHUNK_SIZE), b"")):
+                reporter.put_result(job.id, index, chunk, self.id)
+        if isinstance(job, CallableJob):
+            os.remove(path)
+
     def kill(self):
         os.kill(self.pid, signal.SIGTERM)
 
 
+def result_path(job):
+    """File the result of a forked job is read from, None if it has none."""
+    if isinstance(job, CallableJob):
+        return os.path.join(tempfile.gettempdir(), f"pyqueue_{job.id}.result")
+    return job._out
+
+
+class PoolWorker(Worker):
+    """Worker that runs CallableJobs in a pool of warm processes.
+
+    The `slots` processes of the pool are started once and import the
+    modules in `preload`, so that a job costs a message to a pool process
+    instead of a fork and a shell. The pickled return values are reported to
+    the daemon. Other jobs are run in forked processes like by Worker.
+    """
+
+    def __init__(self, *args, preload=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preload = preload  # names of the modules the pool imports
+        self._pool = None
+        self._reporter = None  # connection used by the result thread of the pool
+
+    def start(self):
+        self.start_pool()  # before the threads of the worker are started
+        super().start()
+
+    def start_pool(self):
+        if self._pool is not None:
+            return
+        self._pool = multiprocessing.Pool(
+            self.slots, initializer=import_modules, initargs=(self.preload,)
+        )
+        self._reporter = (
+            self.queue_server if self.address is None else connect(self.address)
+        )
+
+    def run_job(self, job):
+        if not isinstance(job, CallableJob):
+            return super().run_job(job)
+        self.start_pool()
+        with self._jobs_changed:
+            self.jobs[job.id] = job  # pool jobs have no process of their own
+            self._jobs_changed.notify_all()
+        self._call_daemon("job_started", job.id, None, self.id)
+        self._pool.apply_async(
+            run_in_pool,
+            (job,),
+            callback=functools.partial(self._pool_job_done, job.id),
+            error_callback=functools.partial(self._pool_job_failed, job.id),
+        )
+        log.debug(f"Submitted job [ID:{job.id}] [NAME:{job.name}] to the pool.")
+
+    def _pool_job_done(self, job_id, outcome):
+        returncode, result = outcome
+        self._finish_pool_job(job_id, returncode, result)
+
+    def _pool_job_failed(self, job_id, exception):
+        log.error(f"Job [ID:{job_id}] could not be run in the pool: {exception!r}")
+        self._finish_pool_job(job_id, 1)
+
+    def _finish_pool_job(self, job_id, exit_code, result=None):
+        """Report a pool job, in the result thread of the pool.
+
+        That thread must not raise, or no pool job would ever finish again. If
+        the report fails, the reaper thread sends it again like for forked jobs.
+        """
+        try:
+            self.finish_job(job_id, exit_code, self._reporter, result)
+            return
+        except CONNECTION_ERRORS as exception:
+            log.error(f"Could not report job [ID:{job_id}]: {exception!r}")
+        except Exception:
+            log.exception(f"Could not report job [ID:{job_id}]")
+        with self._jobs_changed:
+            self._exited[job_id] = exit_code
+            self._results[job_id] = result
+            self._jobs_changed.notify_all()
+
+    def close(self):
+        """Stop the processes of the pool."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+def import_modules(names):
+    """Initializer of the pool processes, so jobs do not pay for their imports."""
+    for name in names:
+        importlib.import_module(name)
+
+
+def run_in_pool(job):
+    """Run a CallableJob in a pool process, returns its exit code and result."""
+    returncode = job.run()[0]
+    return returncode, None if returncode != 0 else pickle.dumps(job.result)
+
+
+def exit_code(status):
+    """Exit code of a process from its `waitpid` status, -signal if it was killed."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
 if __name__ == "__main__":
     log = get_logger("WORKER", console_level=logging.INFO)
 
-    queue_server = xmlrpc.client.ServerProxy("http://localhost:8000", allow_none=True)
-    worker = Worker()
+    parser = argparse.ArgumentParser(description="Run a pyqueue worker")
+    parser.add_argument("--slots", default=1, type=int)
+    parser.add_argument("--cpus", type=int)
+    parser.add_argument("--mem", type=int, help="in MB")
+    parser.add_argument(
+        "--idle-timeout",
+        default=60,
+        type=float,
+        help="seconds without jobs until the worker shuts down, never if < 0",
+    )
+    parser.add_argument(
+        "--pool",
+        action="store_true",
+        help="run CallableJobs in a pool of warm processes",
+    )
+    parser.add_argument(
+        "--preload",
+        default="",
+        help="comma separated modules the processes of the pool import up front",
+    )
+    args = parser.parse_args()
+
+    address = os.environ.get("PYQUEUE_ADDRESS", DEFAULT_ADDRESS)
+    queue_server = connect(address)
+    kwargs = {"preload": [m for m in args.preload.split(",") if m]} if args.pool else {}
+    worker = (PoolWorker if args.pool else Worker)(
+        address=address,
+        slots=args.slots,
+        cpus=args.cpus,
+        mem=args.mem,
+        idle_timeout=None if args.idle_timeout < 0 else args.idle_timeout,
+        **kwargs,
+    )
     worker.register_with_queue_server(queue_server)
     worker.start()
@@ -0,0 +1,80 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import os
+
+from pyqueue.archive import Archive
+from pyqueue.daemon import CtlDaemon, Queue
+from pyqueue.results import CHUNK_SIZE
+from pyqueue.utils import try_unpickle
+from tests.utils import DummyJob
+
+
+def test_archive_old_jobs():
+    queue = Queue(archive=Archive(), keep_jobs=2, keep_seconds=60, archive_batch=3)
+    jobs = [DummyJob() for _ in range(6)]
+    queue.extend(jobs)
+    for job in jobs[:4]:
+        queue.set_status(job, "finished")
+    assert queue.archive_old_jobs() == [], "fewer jobs than archive_batch"
+    queue.set_status(jobs[4], "failed")
+    assert queue.archive_old_jobs() == [job.id for job in jobs[:3]]
+    assert [job.id for job in queue] == [job.id for job in jobs[3:]]
+    assert queue.get_job(jobs[0].id).status == "finished", "archived jobs are kept"
+    assert queue.archive.ids({"status": "finished"}) == [j.id for j in jobs[:3]]
+
+    # jobs that ended more than keep_seconds ago are archived right away
+    assert len(queue.archive_old_jobs(now=queue._ended[jobs[4].id] + 61)) == 2
+    assert [job.id for job in queue] == [jobs[5].id]
+
+    # dependencies on archived jobs are still resolved
+    blocked, failed = DummyJob(), DummyJob()
+    blocked.dependencies, failed.dependencies = [jobs[0].id], [jobs[4].id]
+    queue.extend([blocked, failed])
+    assert [blocked.status, failed.status] == ["pending", "failed"]
+    queue.archive.close()
+
+
+def test_squeue_finished_from_archive(tmp_path):
+    path = str(tmp_path / "queue.journal")
+    daemon = CtlDaemon(journal_path=path, keep_jobs=0)
+    daemon.queue.archive_batch = 1
+    jobs = [DummyJob() for _ in range(3)]
+    daemon.submit_jobs(jobs)
+    daemon.job_finished(try_unpickle(daemon.try_acquire_job()).id, 0, None)
+    assert [job.id for job in daemon.queue] == [job.id for job in jobs[1:]]
+
+    filter = {"me": False, "user": None, "job": None, "status": None}
+    ids = lambda page: [row["id"] for row in page["jobs"]]
+    assert jobs[0].id not in ids(daemon.squeue("me", {**filter, "finished": False}))
+    page = daemon.squeue("me", {**filter, "finished": True}, limit=2, sort="-status")
+    assert page["total"] == 3 and ids(page) == [jobs[1].id, jobs[2].id]
+    page = daemon.squeue("me", {**filter, "finished": True}, offset=2)
+    assert ids(page) == [jobs[2].id], "archived jobs come first"
+    daemon.close()
+
+    # archived jobs stay out of the memory of a restarted daemon
+    daemon = CtlDaemon(journal_path=path)
+    assert [job.id for job in daemon.queue] == [job.id for job in jobs[1:]]
+    assert daemon.queue.get_job(jobs[0].id).status == "finished"
+    daemon.close()
+
+
+def test_results_of_archived_jobs_are_removed(tmp_path):
+    daemon = CtlDaemon(result_dir=str(tmp_path), keep_jobs=1)
+    daemon.queue.archive_batch = 1
+    jobs = [DummyJob() for _ in range(2)]
+    daemon.submit_jobs(jobs)
+    for job in jobs:
+        job = try_unpickle(daemon.try_acquire_job())
+        daemon.put_result(job.id, 0, b"x" * 2 * CHUNK_SIZE)  # spilled to a file
+        daemon.job_finished(job.id, 0, None)
+
+    assert jobs[0].id not in daemon.results and jobs[1].id in daemon.results
+    assert os.listdir(tmp_path) == [f"{jobs[1].id}.result"]
+    assert daemon.get_result_info(jobs[0].id) is None
+
+    # as are those of removed jobs
+    daemon.scancel(jobs[1].id)
+    assert len(daemon.results) == 0 and not os.listdir(tmp_path)
+    daemon.close()
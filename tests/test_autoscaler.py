@@ -0,0 +1,112 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import datetime
+import itertools
+
+from pyqueue.autoscaler import Autoscaler
+from pyqueue.daemon import CtlDaemon
+from tests.utils import DummyJob
+
+
+class FakeProcess:
+    returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self.returncode = -15
+
+    def wait(self):
+        return self.returncode
+
+
+class FakeAutoscaler(Autoscaler):
+    """Autoscaler that starts fake processes instead of workers."""
+
+    _pids = itertools.count(1000)
+
+    def start_workers(self, num):
+        for _ in range(num):
+            self.processes[next(self._pids)] = FakeProcess()
+
+
+def register(daemon, pid):
+    daemon.register_worker(
+        pid, {"t_up": None, "status": "idle", "slots": [None], "cpus": 1, "mem": 0}
+    )
+
+
+def test_autoscaler():
+    t = [0.0]
+    load = [0.0]
+    daemon = CtlDaemon()
+    scaler = FakeAutoscaler(
+        daemon,
+        "http://localhost:8000",
+        min_workers=1,
+        max_workers=3,
+        scale_up_delay=2,
+        scale_down_delay=10,
+        clock=lambda: t[0],
+        load=lambda: load[0],
+    )
+
+    scaler.scale()
+    assert len(scaler.processes) == 1, "min_workers should be started"
+    for pid in scaler.processes:
+        register(daemon, pid)
+
+    jobs = [DummyJob() for _ in range(5)]
+    daemon.submit_jobs(jobs)
+    scaler.scale()
+    assert len(scaler.processes) == 1, "a new backlog should not start workers yet"
+
+    for job in jobs:
+        job.created_at -= datetime.timedelta(seconds=5)
+    load[0] = 100.0
+    scaler.scale()
+    assert len(scaler.processes) == 1, "no workers should be started on a busy host"
+    load[0] = 0.0
+    scaler.scale()
+    assert len(scaler.processes) == 3, "workers should be started up to max_workers"
+
+    # idle workers are stopped after scale_down_delay, busy ones are kept
+    busy_pid, *idle_pids = scaler.processes
+    for pid in idle_pids:
+        register(daemon, pid)
+    daemon.try_acquire_job(worker_id=busy_pid)
+    for job in jobs[1:]:
+        daemon.queue.remove(job.id)
+    scaler.scale()
+    t[0] += 10
+    scaler.scale()
+    assert list(scaler.processes) == [busy_pid]
+    assert all(not daemon.is_worker(pid) for pid in idle_pids)
+
+
+def test_autoscaler_reaps_crashed_workers():
+    daemon = CtlDaemon()
+    scaler = FakeAutoscaler(daemon, "http://localhost:8000", min_workers=1)
+    scaler.scale()
+    ((pid, process),) = scaler.processes.items()
+    register(daemon, pid)
+
+    process.returncode = 1
+    scaler.scale()
+    assert not daemon.is_worker(pid), "crashed worker should be deregistered"
+    assert len(scaler.processes) == 1 and pid not in scaler.processes
+
+
+def test_started_workers_share_the_machine(monkeypatch):
+    monkeypatch.setattr("psutil.cpu_count", lambda: 8)
+    daemon = CtlDaemon()
+    cmd = Autoscaler(daemon, "http://localhost:8000", max_workers=4).worker_command()
+    assert cmd[cmd.index("--cpus") + 1] == "2"
+    total = int(cmd[cmd.index("--mem") + 1])
+
+    scaler = Autoscaler(daemon, "http://localhost:8000", max_workers=16, mem=512)
+    cmd = scaler.worker_command()
+    assert cmd[cmd.index("--cpus") + 1] == "1", "every worker gets at least one"
+    assert cmd[cmd.index("--mem") + 1] == "512" and total > 0
@@ -1,6 +1,11 @@
 # This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
 # under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
 
+import datetime
+import os
+import signal
+import socket
+import subprocess
 import threading
 import time
 import xmlrpc.client
@@ -8,8 +13,10 @@ import xmlrpc.client
 import pytest
 
 from pyqueue import worker
-from pyqueue.daemon import CtlDaemon, StoppableServerThread
-from pyqueue.utils import try_pickle, try_unpickle
+from pyqueue.daemon import CtlDaemon, Queue, StoppableServerThread, make_server
+from pyqueue.jobs import BashJob
+from pyqueue.transport import connect
+from pyqueue.utils import make_worker_id, try_pickle, try_unpickle, wait_until
 from pyqueue.worker import Worker
 from tests.utils import DummyJob
 
@@ -88,17 +95,445 @@ def test_update_worker_status(server=None, client=None):
     assert status == "running", f"job status should be running, instead it is {status}"
 
 
+def test_queue_dispatch_order():
+    queue = Queue()
+    jobs = [DummyJob(priority=p) for p in [0, 2, 1, 2, 0]]
+    for job in jobs:
+        queue.append(job)
+    assert len(queue) == 5, "number of pending jobs does not match"
+
+    # highest priority first, submission order among equal priorities
+    order = [queue.next_job() for _ in range(5)]
+    assert order == [jobs[1], jobs[3], jobs[2], jobs[0], jobs[4]]
+    assert len(queue) == 0 and queue.count("submitted") == 5
+    with pytest.raises(IndexError):
+        queue.next_job()
+
+
+def test_queue_update_reschedules_pending_jobs():
+    queue = Queue()
+    jobs = [DummyJob(priority=1), DummyJob(priority=0)]
+    queue.extend(jobs)
+    queue.update(jobs[1].id, {"priority": 10})
+    assert queue.next_job() is jobs[1]
+    assert queue.next_job() is jobs[0]
+    with pytest.raises(IndexError):
+        queue.next_job()
+
+
+def test_queue_status_index():
+    queue = Queue()
+    job1 = DummyJob(priority=1)
+    job2 = DummyJob(priority=0)
+    queue.append(job1)
+    queue.append(job2)
+
+    queue.set_status(job1, "running")
+    assert queue.get_running_jobs() == [job1]
+    assert queue.get_pending_jobs() == [job2]
+
+    assert queue.get_job(job2.id) is job2 and job2 in queue
+
+    # requeued jobs are dispatched again, removed jobs are not
+    queue.set_status(job1, "pending")
+    queue.remove(job2.id)
+    assert job2 not in queue and job2.id not in queue.get_dict()
+    assert queue.next_job() is job1
+    with pytest.raises(IndexError):
+        queue.next_job()
+
+
+def test_queue_query():
+    queue = Queue()
+    jobs = [DummyJob(priority=p) for p in [0, 2, 1, 2]]
+    for i, (job, owner) in enumerate(zip(jobs, ["a", "b", "a", "a"])):
+        job.owner, job.created_at = owner, datetime.datetime(2022, 1, 1, i)
+    queue.extend(jobs)
+    queue.set_status(jobs[0], "finished")
+    queue.update(jobs[1].id, {"owner": "a"})
+
+    assert queue.query({"owner": "a"}) == (4, jobs), "submission order"
+    assert queue.query({"owner": "b"}) == (0, [])
+    assert queue.query({"owner": "a", "finished": False}, offset=1) == (3, jobs[2:])
+    total, page = queue.query({"status": "pending"}, sort="-priority", limit=2)
+    assert total == 3 and page == [jobs[1], jobs[3]]
+    assert queue.query(sort="priority", offset=1, limit=2)[1] == [jobs[2], jobs[1]]
+    assert jobs[0].row()["runtime"] == 0.0 and jobs[0].row()["owner"] == "a"
+
+
+def test_queue_query_by_array_id(tmp_path):
+    queue = Queue()
+    array = BashJob.array("echo {idx}", range(3), output_dir=str(tmp_path))
+    queue.extend([DummyJob(), *array])
+    array_id = array[0].array_id
+
+    assert queue.query({"array_id": array_id}) == (3, array)
+    assert queue._indexes["array_id"][array_id] == {job.id: job for job in array}
+    queue.remove(array[0].id)
+    assert queue.query({"array_id": array_id}) == (2, array[1:])
+
+
+def test_change_feed():
+    daemon = CtlDaemon()
+    jobs = [DummyJob() for _ in range(3)]
+    daemon.submit_jobs(jobs[:2])
+    filter = {"me": False, "user": None, "job": None, "finished": False}
+    seq = daemon.squeue("me", filter)["seq"]
+    assert daemon.get_changes(seq) == {
+        "seq": seq,
+        "reset": False,
+        "jobs": [],
+        "removed": [],
+    }
+
+    daemon.submit_job(jobs[2])
+    job = try_unpickle(daemon.try_acquire_job())
+    daemon.job_finished(job.id, 0, None)
+    daemon.scancel(jobs[1].id)
+    changes = daemon.get_changes(seq)
+    assert [row["id"] for row in changes["jobs"]] == [jobs[0].id, jobs[2].id]
+    assert changes["jobs"][0]["status"] == "finished"
+    assert changes["removed"] == [jobs[1].id]
+    assert not daemon.get_changes(changes["seq"])["jobs"]
+
+    # changes that are no longer known have to be reloaded with squeue
+    assert daemon.get_changes("restarted:0")["reset"]
+    queue = Queue(max_changes=2)
+    queue.extend([DummyJob() for _ in range(3)])
+    assert queue.changes_since(0) is None and len(queue.changes_since(1)) == 2
+
+
+def check_concurrent_clients(server, client=None):
+    daemon = server.instance
+
+    def submit_and_acquire(jobs, acquired):
+        client = xmlrpc.client.ServerProxy("http://localhost:8001", allow_none=True)
+        for job in jobs:
+            client.submit_job(try_pickle(job))
+        for _ in jobs:
+            job = try_unpickle(client.try_acquire_job(1))
+            if job is not None:
+                acquired.append(job.id)
+
+    jobs = [DummyJob() for _ in range(100)]
+    acquired = []
+    threads = [
+        threading.Thread(target=submit_and_acquire, args=(jobs[i::10], acquired))
+        for i in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(acquired) == sorted(job.id for job in jobs), "jobs were lost"
+    assert daemon.queue.count("submitted") == 100
+    assert daemon.get_num_pending_jobs() == 0
+
+
+def test_unix_socket(tmp_path):
+    socket_path = str(tmp_path / "pyqueue.sock")
+    thread = StoppableServerThread(threaded=True, socket_path=socket_path)
+    thread.start()
+    client = connect(f"http+unix://{socket_path}")
+    try:
+        assert client.get_num_pending_jobs() == 0
+        with pytest.raises(OSError):  # only one daemon per socket
+            StoppableServerThread(socket_path=socket_path)
+    finally:
+        thread.stop()
+    assert not os.path.exists(socket_path), "socket file was not removed"
+    with pytest.raises(ConnectionRefusedError):
+        connect(f"http+unix://{socket_path}").get_num_pending_jobs()
+
+
+@pytest.mark.parametrize("transport", ["http", "pyq"])
+def test_token(transport, monkeypatch):
+    monkeypatch.delenv("PYQUEUE_TOKEN", raising=False)
+    # the daemon unpickles what it is sent, so it may not listen on the network
+    # without a shared secret
+    with pytest.raises(ValueError):
+        make_server(8002, host="0.0.0.0")
+
+    thread = StoppableServerThread(
+        port=8002, threaded=True, transport=transport, token="secret"
+    )
+    thread.start()
+    try:
+        url = f"{transport}://localhost:8002"
+        assert connect(url, token="secret").get_num_pending_jobs() == 0
+        for client in [connect(url), connect(url, token="wrong")]:
+            with pytest.raises((xmlrpc.client.ProtocolError, xmlrpc.client.Fault)):
+                client.get_num_pending_jobs()
+        monkeypatch.setenv("PYQUEUE_TOKEN", "secret")
+        assert connect(url).get_num_pending_jobs() == 0
+    finally:
+        thread.stop()
+
+
+def test_wait_for_jobs():
+    daemon = CtlDaemon(allow_blocking=True)
+    timer = threading.Timer(0.2, daemon.submit_job, args=(DummyJob(),))
+    timer.start()
+    t0 = time.time()
+    assert daemon.wait_for_jobs(timeout=5) == 1, "long-poll returned without a job"
+    assert time.time() - t0 < 1, "long-poll was not woken up by the new job"
+    timer.join()
+
+    # without long-poll support the call returns immediately
+    daemon = CtlDaemon(allow_blocking=False)
+    t0 = time.time()
+    assert daemon.wait_for_jobs(timeout=5) == 0
+    assert time.time() - t0 < 1
+
+
+def test_submit_jobs_and_sbatch_array(tmp_path, monkeypatch):
+    daemon = CtlDaemon()
+    daemon.submit_jobs([try_pickle(DummyJob()) for _ in range(3)])
+    assert daemon.get_num_pending_jobs() == 3
+
+    kwargs = {"owner": "me", "priority": "1", "array": "0-99"}
+    monkeypatch.chdir(tmp_path)  # sbatch writes outputs to ./outputs
+    daemon.sbatch("echo {idx}", kwargs)
+    assert daemon.get_num_pending_jobs() == 103
+    job = try_unpickle(daemon.try_acquire_job())
+    assert job.cmd == "echo 0" and job.owner == "me" and job.priority == 1
+
+
+def test_try_acquire_job():
+    daemon = CtlDaemon()
+    job = DummyJob()
+    daemon.submit_job(job)
+
+    assert try_unpickle(daemon.try_acquire_job()).id == job.id
+    assert daemon.try_acquire_job() is None, "empty queue should return no job"
+
+
+def test_failed_jobs_are_retried():
+    daemon = CtlDaemon(allow_blocking=True)
+    job = DummyJob(priority=1)
+    job.max_retries, job.retry_delay = 2, 0.1
+    daemon.submit_job(job)
+    job = try_unpickle(daemon.try_acquire_job())
+
+    for delay in [0.1, 0.2]:
+        daemon.job_finished(job.id, 1, None)
+        job = daemon.queue.get_job(job.id)
+        assert job.status == "retrying" and job._exit == 1
+        assert daemon.try_acquire_job() is None, "job was retried without backoff"
+
+        # the long-poll wakes up once the backoff has passed
+        t0 = time.time()
+        assert try_unpickle(daemon.try_acquire_job(timeout=5)).id == job.id
+        assert delay * 0.9 <= time.time() - t0 < delay + 1
+
+    assert job.retries == 2 and job.priority == -1, "retries have lower priority"
+    daemon.job_finished(job.id, 1, None)
+    assert job.status == "failed" and daemon.queue.count("failed") == 1
+
+
+def test_job_dependencies(tmp_path, monkeypatch):
+    daemon = CtlDaemon()
+    a, b, c, d = [DummyJob() for _ in range(4)]
+    c.dependencies = [a.id, b.id]
+    d.dependencies = [c.id]
+    daemon.submit_jobs([a, b, c, d])
+    assert [c.status, d.status] == ["blocked", "blocked"]
+    assert daemon.get_num_pending_jobs() == 2
+
+    for job in [a, b]:
+        assert try_unpickle(daemon.try_acquire_job()).id == job.id
+    daemon.job_finished(a.id, 0, None)
+    assert c.status == "blocked", "c also waits for b"
+    daemon.job_finished(b.id, 0, None)
+    assert c.status == "pending" and d.status == "blocked"
+
+    # failed and cancelled jobs fail all jobs that depend on them
+    e, f = DummyJob(), DummyJob()
+    e.dependencies, f.dependencies = [d.id], [e.id]
+    daemon.submit_jobs([e, f])
+    daemon.scancel(c.id)
+    assert [d.status, e.status, f.status] == ["failed"] * 3
+
+    monkeypatch.chdir(tmp_path)  # sbatch writes outputs to ./outputs
+    array_id = daemon.sbatch("echo {idx}", {"array": "0-1"})
+    job_id = daemon.sbatch("echo done", {"dependency": f"afterok:{array_id}"})
+    assert daemon.queue.get_job(job_id).dependencies == [
+        f"{array_id}_{i}" for i in [0, 1]
+    ]
+    with pytest.raises(ValueError):
+        daemon.sbatch("echo", {"dependency": "afterok:unknown"})
+    with pytest.raises(ValueError):
+        daemon.sbatch("echo", {"dependency": f"afternotok:{job_id}"})
+
+
+def test_resource_aware_dispatch(tmp_path, monkeypatch):
+    daemon = CtlDaemon(allow_blocking=True)
+    for pid, cpus in [(1, 2), (2, 8)]:
+        daemon.register_worker(
+            pid,
+            {
+                "t_up": None,
+                "status": "idle",
+                "slots": [None],
+                "cpus": cpus,
+                "mem": 4096,
+            },
+        )
+    monkeypatch.chdir(tmp_path)
+    daemon.sbatch("echo big", {"cpus": "4", "mem": "1G"})
+    job = daemon.queue.get_pending_jobs()[0]
+    assert job.cpus == 4 and job.mem == 1024
+
+    # jobs that no worker can run are rejected
+    with pytest.raises(ValueError):
+        daemon.sbatch("echo huge", {"cpus": "64"})
+
+    # the job only fits the large worker
+    assert daemon.try_acquire_job(worker_id=1) is None
+    assert try_unpickle(daemon.try_acquire_job(worker_id=2)).id == job.id
+    daemon.job_started(job.id, 123, 2)
+    assert daemon.worker_index.free(2) == {"cpus": 4, "mem": 3072}
+    daemon.job_finished(job.id, 0, 2)
+    assert daemon.worker_index.free(2) == {"cpus": 8, "mem": 4096}
+
+    # a new job wakes up the waiting worker it fits best
+    results = {}
+
+    def poll(pid):
+        results[pid] = try_unpickle(daemon.try_acquire_job(1, worker_id=pid))
+
+    threads = [threading.Thread(target=poll, args=(pid,)) for pid in [1, 2]]
+    for thread in threads:
+        thread.start()
+    assert wait_until(lambda: len(daemon._waiting) == 2, timeout=1)
+    daemon.sbatch("echo small", {"cpus": "2"})
+    for thread in threads:
+        thread.join()
+    assert results[1] is not None and results[1].cmd == "echo small"
+    assert results[2] is None
+
+
+def test_scancel_jobs_of_unregistered_workers():
+    daemon = CtlDaemon()
+    jobs = [DummyJob(), DummyJob()]
+    daemon.submit_jobs(jobs)
+    processes = [subprocess.Popen(["sleep", "10"]) for _ in jobs]
+    for job, worker_id, process in zip(jobs, ["node:1", make_worker_id(1)], processes):
+        daemon.try_acquire_job()
+        daemon.job_started(job.id, process.pid, worker_id)
+
+    # the pid of a job on another host means nothing on the host of the daemon
+    daemon.scancel(jobs[0].id)
+    assert processes[0].poll() is None
+    daemon.register_worker(
+        "node:1",
+        {"t_up": None, "status": "busy", "slots": [jobs[0].id], "cpus": 1, "mem": 0},
+    )
+    assert daemon.heartbeat("node:1")["cancel"] == [jobs[0].id]
+    processes[0].kill()
+
+    daemon.scancel(jobs[1].id)
+    assert processes[1].wait(5) == -signal.SIGTERM
+
+
+def test_expired_lease_requeues_jobs():
+    daemon = CtlDaemon(lease_timeout=10)
+    for pid in [1, 2]:
+        daemon.register_worker(
+            pid,
+            {"t_up": None, "status": "idle", "slots": [None], "cpus": 1, "mem": 0},
+        )
+    job = DummyJob()
+    daemon.submit_job(job)
+    assert try_unpickle(daemon.try_acquire_job(worker_id=1)).id == job.id
+    daemon.job_started(job.id, 123, 1)
+    job = daemon.queue.get_job(job.id)
+
+    now = time.monotonic()
+    assert daemon.heartbeat(2)["registered"]
+    assert daemon.reap_dead_workers(now + 5) == []
+    assert daemon.reap_dead_workers(now + 11) == [1, 2]
+    daemon.heartbeat(2)  # worker 2 is alive, but its heartbeat came too late
+    assert not daemon.heartbeat(1)["registered"] and not daemon.is_worker(1)
+    assert job.status == "pending" and job.pid is None
+
+    # the job runs again, late reports of the dead worker are ignored
+    daemon.register_worker(
+        2, {"t_up": None, "status": "idle", "slots": [None], "cpus": 1, "mem": 0}
+    )
+    assert try_unpickle(daemon.try_acquire_job(worker_id=2)).id == job.id
+    daemon.job_started(job.id, 123, 1)
+    daemon.job_finished(job.id, 1, 1)
+    assert job.status == "submitted" and job.worker == 2
+    daemon.job_started(job.id, 456, 2)
+    daemon.job_finished(job.id, 0, 2)
+    assert job.status == "finished" and job.pid == 456
+
+
+def test_killed_local_workers_are_removed():
+    daemon = CtlDaemon()
+    process = subprocess.Popen(["true"])
+    process.wait()  # a worker on this host that was killed
+    for pid in [process.pid, os.getpid()]:
+        daemon.register_worker(
+            make_worker_id(pid),
+            {
+                "host": socket.gethostname(),
+                "pid": pid,
+                "slots": [None],
+                "cpus": 1,
+                "mem": 0,
+            },
+        )
+    job = DummyJob()
+    daemon.submit_job(job)
+    daemon.try_acquire_job(worker_id=make_worker_id(process.pid))
+
+    # its jobs are requeued without waiting for its lease to expire
+    assert daemon.remove_killed_workers() == [make_worker_id(process.pid)]
+    assert list(daemon.workers) == [make_worker_id(os.getpid())]
+    assert daemon.queue.get_job(job.id).status == "pending"
+
+
+@pytest.mark.parametrize(
+    "threaded, transport, unix",
+    [
+        (False, "http", False),
+        (True, "http", False),
+        (True, "pyq", False),
+        (False, "http", True),
+        (True, "http", True),
+        (True, "pyq", True),
+    ],
+)
 @pytest.mark.parametrize(
     "test",
     [test_update_worker_status, test_submit_update_and_get_jobs, test_submit_job],
 )
-def test_server_client_interaction(test):
+def test_server_client_interaction(test, threaded, transport, unix, tmp_path):
+    socket_path = str(tmp_path / "pyqueue.sock") if unix else None
+    run_with_server_and_client(test, threaded, transport, socket_path)
+
+
+def test_threaded_server():
+    run_with_server_and_client(check_concurrent_clients, threaded=True)
+
+
+def run_with_server_and_client(
+    test, threaded=False, transport="http", socket_path=None
+):
     def test_with_server_and_client(test):
-        thread = StoppableServerThread(port=8001)
+        thread = StoppableServerThread(
+            port=8001, threaded=threaded, transport=transport, socket_path=socket_path
+        )
         server = thread.server
         thread.start()
 
-        client = xmlrpc.client.ServerProxy("http://localhost:8001", allow_none=True)
+        if socket_path is None:
+            client = connect(f"{transport}://localhost:8001")
+        else:
+            client = connect(f"{transport}+unix://{socket_path}")
 
         # ensures that the server is closed before the exception is raised!
         try:
@@ -114,4 +549,4 @@ def test_server_client_interaction(test):
     )  # for some reason without this OSError: [Errno 98] (Address already in use) is raised
 
 
-# test if all inputs/outputs are pickled
\ No newline at end of file
+# test if all inputs/outputs are pickled
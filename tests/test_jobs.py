@@ -1,13 +1,16 @@
 # This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
 # under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
 
+import datetime
 import inspect
 import os
+import pickle
 from abc import ABC
 
 import pytest
 
 import pyqueue.jobs as Jobs
+from pyqueue.helpers import parse_array
 from tests.utils import DummyJob, is_picklable
 
 testable_jobs = [DummyJob]
@@ -34,6 +37,42 @@ def test_bashjob_name_extraction():
         assert job.name == name, "job was not named as expected. "
 
 
+def test_bashjob_array(tmp_path):
+    assert parse_array("0-3,7,10-20:5") == [0, 1, 2, 3, 7, 10, 15, 20]
+
+    jobs = Jobs.BashJob.array("echo {idx}", [0, 1, 5], output_dir=tmp_path)
+    assert [job.cmd for job in jobs] == ["echo 0", "echo 1", "echo 5"]
+    assert [job.array_index for job in jobs] == [0, 1, 5]
+    assert len({job.array_id for job in jobs}) == 1
+    assert len({job.id for job in jobs}) == 3, "array jobs need unique ids"
+    assert len({job._out for job in jobs}) == 3, "array jobs need own outputs"
+
+
+def test_compact_jobs(tmp_path):
+    jobs = Jobs.BashJob.array("echo {idx}", [0, 1], output_dir=tmp_path)
+    assert not hasattr(jobs[0], "__dict__"), "jobs should only have slots"
+    assert jobs[0]._cmd is jobs[1]._cmd, "array jobs should share their cmd"
+    assert pickle.loads(pickle.dumps(jobs)) == jobs
+
+    # jobs pickled before they had slots, i.e. in old journals, still load
+    job = Jobs.BashJob.__new__(Jobs.BashJob)
+    state = {**jobs[1].__getstate__(), "type": "BashJob", "cmd": "echo 1"}
+    state["created_at"] = datetime.datetime(2022, 1, 1)
+    del state["_created"], state["_cmd"]
+    job.__setstate__(state)
+    assert job.cmd == "echo 1" and job.created_at == datetime.datetime(2022, 1, 1)
+    assert job._created == datetime.datetime(2022, 1, 1).timestamp()
+
+
+def test_callablejob_run():
+    job = Jobs.CallableJob(divmod, (7, 2))
+    assert job.name == "divmod"
+    assert job.run() == (0, (3, 1), None) and job.result == (3, 1)
+
+    returncode, _, err = Jobs.CallableJob(divmod, (7, 0)).run()
+    assert returncode == 1 and "ZeroDivisionError" in err
+
+
 @pytest.mark.parametrize(
     "Job, expected_out, expected_err",
     [(DummyJob, "test print", "test warn"), (Jobs.BashJob, "no cmd provided\n", "")],
@@ -0,0 +1,104 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import os
+import time
+
+from pyqueue.daemon import CtlDaemon, Queue
+from pyqueue.journal import Journal
+from pyqueue.utils import try_unpickle
+from tests.utils import DummyJob
+
+
+def test_restore_queue_from_journal(tmp_path):
+    path = str(tmp_path / "queue.journal")
+    daemon = CtlDaemon(journal_path=path)
+    jobs = [DummyJob(priority=p) for p in [0, 2, 1, 0]]
+    daemon.submit_jobs(jobs)
+    acquired = try_unpickle(daemon.try_acquire_job())
+    daemon.update_job_status(acquired.id, {"status": "running", "pid": 42})
+    daemon.scancel(jobs[3].id)
+    daemon.queue.journal.close()
+
+    # a restarted daemon continues where the old one stopped
+    daemon = CtlDaemon(journal_path=path, lease_timeout=10)
+    assert [job.id for job in daemon.queue] == [job.id for job in jobs[:3]]
+    assert daemon.get_running_ids() == [jobs[1].id]
+    assert daemon.queue.get_job(jobs[1].id).pid == 42
+    assert daemon.get_num_pending_jobs() == 2
+    assert try_unpickle(daemon.try_acquire_job()).id == jobs[2].id
+
+    # jobs of workers that do not register again within the lease are requeued
+    now = time.monotonic()
+    daemon.reap_dead_workers(now + 5)
+    assert daemon.get_running_ids() == [jobs[1].id]
+    daemon.reap_dead_workers(now + 11)
+    assert daemon.queue.get_job(jobs[1].id).status == "pending"
+    assert daemon.queue.get_job(jobs[1].id).pid is None
+    assert daemon.queue.get_job(jobs[2].id).status == "submitted"
+
+
+def test_restored_jobs_are_kept_by_their_worker(tmp_path):
+    path = str(tmp_path / "queue.journal")
+    daemon = CtlDaemon(journal_path=path, lease_timeout=10)
+    worker = {"t_up": None, "status": "idle", "slots": [None, None], "cpus": 2}
+    daemon.register_worker("node:1", {**worker, "mem": 0})
+    jobs = [DummyJob() for _ in range(2)]
+    daemon.submit_jobs(jobs)
+    for job in jobs:
+        acquired = try_unpickle(daemon.try_acquire_job(worker_id="node:1"))
+        daemon.job_started(acquired.id, 42, "node:1")
+    daemon.scancel(jobs[1].id)
+    daemon.queue.journal.close()
+
+    # the worker registers with the restarted daemon and keeps its running job
+    daemon = CtlDaemon(journal_path=path, lease_timeout=10)
+    slots = [job.id for job in jobs]
+    daemon.register_worker("node:1", {**worker, "slots": slots, "mem": 0})
+    assert daemon.heartbeat("node:1")["cancel"] == [jobs[1].id]
+    assert daemon.workers["node:1"]["slots"] == [jobs[0].id, None]
+    assert daemon.worker_index.free("node:1")["cpus"] == 1
+    daemon._restored_at -= 11  # the lease of the restored jobs expired
+    daemon.reap_dead_workers()
+    assert daemon.get_running_ids() == [jobs[0].id]
+
+
+def test_restore_job_dependencies(tmp_path):
+    path = str(tmp_path / "queue.journal")
+    daemon = CtlDaemon(journal_path=path)
+    jobs = [DummyJob() for _ in range(4)]
+    for parent, job in zip(jobs, jobs[1:]):
+        job.dependencies = [parent.id]
+    daemon.submit_jobs(jobs)
+    daemon.job_finished(try_unpickle(daemon.try_acquire_job()).id, 0, None)
+    daemon.queue.journal.close()
+
+    daemon = CtlDaemon(journal_path=path)
+    statuses = [job.status for job in daemon.queue]
+    assert statuses == ["finished", "pending", "blocked", "blocked"]
+    daemon.job_finished(try_unpickle(daemon.try_acquire_job()).id, 0, None)
+    assert daemon.queue.get_job(jobs[2].id).status == "pending"
+
+
+def test_journal_compaction(tmp_path):
+    path = str(tmp_path / "queue.journal")
+    queue = Queue(journal=Journal(path, compact_every=10))
+    jobs = [DummyJob() for _ in range(25)]
+    queue.extend(jobs)
+    assert queue.journal.num_records == 5, "journal was not compacted"
+    assert os.path.exists(path + ".snapshot")
+
+    queue.journal.close()
+    assert [job.id for job in Journal(path).replay()] == [job.id for job in jobs]
+
+
+def test_journal_with_truncated_record(tmp_path):
+    path = str(tmp_path / "queue.journal")
+    journal = Journal(path)
+    journal.log_append(DummyJob())
+    journal.log_append(DummyJob())
+    journal.close()
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 10)  # crash while writing
+
+    assert len(Journal(path).replay()) == 1
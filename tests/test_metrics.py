@@ -0,0 +1,74 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import time
+
+import pytest
+
+from pyqueue.daemon import CtlDaemon
+from pyqueue.metrics import Histogram
+from pyqueue.utils import try_unpickle
+from tests.utils import DummyJob
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.percentile(50) is None
+    for ms in range(1, 1001):
+        histogram.record(ms / 1000)
+    for p, value in [(50, 0.5), (90, 0.9), (99, 0.99)]:
+        assert value <= histogram.percentile(p) <= value * histogram.growth
+    assert histogram.percentile(100) == histogram.max == 1.0
+    assert histogram.summary()["mean"] == pytest.approx(0.5005)
+
+    # values out of range end up in the first and last bucket
+    histogram.record(-1)
+    histogram.record(1e9)
+    assert histogram.counts[0] == 1 and histogram.counts[-1] == 1
+    assert histogram.count == 1002 and histogram.max == 1e9
+
+    other = Histogram()
+    other.record(2.0)
+    histogram.merge(other)
+    assert histogram.count == 1003 and sum(histogram.counts) == 1003
+
+
+def test_job_timings():
+    daemon = CtlDaemon()
+    jobs = [DummyJob() for _ in range(3)]
+    jobs[2].owner = "other"
+    daemon.submit_jobs(jobs)
+    for _ in jobs:
+        job = try_unpickle(daemon.try_acquire_job())
+        daemon.job_started(job.id, 1, None)
+        daemon.job_finished(job.id, 0, None)
+
+    stats = daemon.get_stats()
+    assert list(stats) == ["wait", "dispatch", "runtime"]
+    assert stats["wait"]["all"]["count"] == 3
+    assert stats["runtime"]["all"]["max"] < 1
+    by_owner = daemon.get_stats(["owner", "type"])["dispatch"]
+    assert by_owner[f"{jobs[0].owner}/DummyJob"]["count"] == 2
+    assert by_owner["other/DummyJob"]["count"] == 1
+    assert not daemon._dispatched_at
+    with pytest.raises(ValueError):
+        daemon.get_stats(["status"])
+
+
+def test_wait_is_measured_from_when_jobs_became_pending():
+    daemon = CtlDaemon(lease_timeout=10)
+    daemon.register_worker(1, {"slots": [None], "cpus": 1, "mem": 0})
+    first, blocked = DummyJob(), DummyJob()
+    blocked.dependencies = [first.id]
+    daemon.submit_jobs([first, blocked])
+    daemon.try_acquire_job(worker_id=1)
+    time.sleep(0.2)  # the lease of the worker expires while it runs the job
+    daemon.reap_dead_workers(time.monotonic() + 11)
+    daemon.register_worker(1, {"slots": [None], "cpus": 1, "mem": 0})
+
+    # neither the time it ran before, nor the time it was blocked count
+    daemon.job_finished(try_unpickle(daemon.try_acquire_job(worker_id=1)).id, 0, 1)
+    daemon.job_finished(try_unpickle(daemon.try_acquire_job(worker_id=1)).id, 0, 1)
+    wait = daemon.get_stats()["wait"]["all"]
+    assert wait["count"] == 3 and wait["max"] < 0.2
+    assert not daemon.queue._pending_since
@@ -0,0 +1,43 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import os
+
+import pytest
+
+from pyqueue.results import ResultStore
+
+
+def test_result_store(tmp_path):
+    store = ResultStore(tmp_path, inline_limit=8, max_inline=16)
+    store.write("small", b"12345")
+    store.write("large", b"12345678")
+    store.write("large", b"9", offset=8)
+    assert os.listdir(tmp_path) == ["large.result"], "large results are spilled"
+    assert store.size("large") == 9
+    assert store.read("large", 4, 3) == b"567" and store.read("large", 9) == b""
+
+    # the least recently used inline results are spilled beyond max_inline
+    store.write("other", b"abcdef")
+    store.read("small")
+    store.write("new", b"xyzxyz")
+    assert sorted(os.listdir(tmp_path)) == ["large.result", "other.result"]
+    assert [store.read(id) for id in ["small", "other", "new"]] == [
+        b"12345",
+        b"abcdef",
+        b"xyzxyz",
+    ]
+
+    with pytest.raises(ValueError):
+        store.write("new", b"!", offset=2)
+    store.write("large", b"again")  # a retried job replaces its result
+    assert store.read("large") == b"again" and "large.result" not in os.listdir(
+        tmp_path
+    )
+    store.remove("other")
+    assert "other" not in store and len(store) == 3
+
+    # spilled results outlive the daemon
+    assert "large" not in ResultStore(tmp_path), "inline results are lost"
+    store.write("large", b"123456789")
+    assert ResultStore(tmp_path).read("large") == b"123456789"
@@ -0,0 +1,140 @@
+# This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
+# under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
+
+import pytest
+
+from pyqueue.daemon import Queue
+from pyqueue.journal import Journal
+from pyqueue.scheduler import (
+    AgingScheduler,
+    BackfillScheduler,
+    FairShareScheduler,
+    WorkerIndex,
+    make_scheduler,
+)
+from tests.utils import DummyJob
+
+
+def make_job(owner=None, priority=0, cpus=1):
+    job = DummyJob(priority=priority)
+    job.owner = owner
+    job.cpus = cpus
+    return job
+
+
+def test_fair_share():
+    queue = Queue(scheduler=FairShareScheduler())
+    queue.extend([make_job("alice", priority=5) for _ in range(100)])
+    bob = [make_job("bob") for _ in range(2)]
+    queue.extend(bob)
+
+    # bob is served right away, despite alice's many high priority jobs
+    owners = [queue.next_job().owner for _ in range(4)]
+    assert owners.count("bob") == 2, f"bob was starved: {owners}"
+
+    # cancelled jobs are skipped, owners without jobs drop out
+    carol = [make_job("carol") for _ in range(2)]
+    queue.extend(carol)
+    queue.remove(carol[0].id)
+    owners = [queue.next_job().owner for _ in range(4)]
+    assert owners.count("carol") == 1
+
+    # jobs handed over to another owner are found and removed by their new owner
+    dave = make_job("dave")
+    queue.append(dave)
+    queue.update(dave.id, {"owner": "erin"})
+    queue.remove(dave.id)
+    assert dave not in [queue.next_job() for _ in range(len(queue))]
+
+
+def test_fair_share_weights():
+    scheduler = FairShareScheduler(shares={"alice": 3})
+    queue = Queue(scheduler=scheduler)
+    queue.extend([make_job(owner) for owner in ["alice", "bob"] for _ in range(20)])
+
+    owners = [queue.next_job().owner for _ in range(8)]
+    assert owners.count("alice") == 6 and owners.count("bob") == 2
+
+
+def test_aging(tmp_path):
+    path = str(tmp_path / "queue.journal")
+    queue = Queue(scheduler=AgingScheduler(rate=1), journal=Journal(path))
+    jobs = [make_job(priority=p) for p in [0, 5, 20]]
+    jobs[0]._created -= 10  # the old job has waited long enough to gain 10 levels
+    queue.extend(jobs)
+
+    # jobs keep their age when they are added again, i.e. after an update
+    queue.update(jobs[0].id, {"owner": "other"})
+    restored = Queue.load(Journal(path), AgingScheduler(rate=1))
+    assert [queue.next_job().priority for _ in range(3)] == [20, 0, 5]
+    # ... or when the queue is restored
+    assert [restored.next_job().priority for _ in range(3)] == [20, 0, 5]
+
+
+def test_backfill():
+    queue = Queue(scheduler=BackfillScheduler(max_skips=2))
+    big = make_job(priority=1, cpus=8)
+    small = [make_job(cpus=1) for _ in range(4)]
+    queue.append(big)
+    queue.extend(small)
+
+    # small jobs fill in while the big job does not fit
+    assert queue.next_job({"cpus": 2}) is small[0]
+    assert queue.next_job({"cpus": 2}) is small[1]
+    # ... until it was skipped max_skips times
+    with pytest.raises(IndexError):
+        queue.next_job({"cpus": 2})
+    assert queue.next_job({"cpus": 8}) is big
+    assert queue.next_job({"cpus": 2}) is small[2]
+
+
+def test_priority_scheduler_does_not_backfill():
+    queue = Queue(scheduler=make_scheduler("priority"))
+    queue.append(make_job(priority=1, cpus=8))
+    queue.append(make_job(cpus=1))
+    with pytest.raises(IndexError):
+        queue.next_job({"cpus": 2})
+    assert queue.next_job().cpus == 8
+
+
+@pytest.mark.parametrize("name", ["priority", "fairshare", "backfill"])
+def test_jobs_that_fit_no_worker_are_set_aside(name):
+    queue = Queue(scheduler=make_scheduler(name))
+    queue.scheduler.set_capacities([{"cpus": 4, "mem": 0}])
+    huge = make_job("alice", priority=1, cpus=64)
+    small = [make_job("bob", cpus=2) for _ in range(2)]
+    queue.extend([huge, *small])
+
+    # the huge job does not hold up the others
+    assert queue.next_job({"cpus": 4}) is small[0]
+    assert len(queue.scheduler) == 1
+    # ... but the jobs that fit a worker do keep their order
+    with pytest.raises(IndexError):
+        queue.next_job({"cpus": 1})
+    assert queue.next_job({"cpus": 4}) is small[1]
+    with pytest.raises(IndexError):
+        queue.next_job()
+
+    # until a worker that fits it registers
+    queue.scheduler.set_capacities([{"cpus": 4, "mem": 0}, {"cpus": 64, "mem": 0}])
+    assert queue.next_job() is huge
+
+
+def test_worker_index():
+    index = WorkerIndex()
+    index.update("a", cpus=8, mem=1000)
+    index.update("b", cpus=2, mem=1000)
+    index.update("c", cpus=4, mem=100)
+
+    assert index.best_fit(make_job(cpus=1)) == "b", "tightest fit first"
+    job = make_job(cpus=3)
+    job.mem = 500
+    assert index.best_fit(job) == "a", "c has too little memory"
+    assert index.best_fit(make_job(cpus=1), candidates={"c"}) == "c"
+    assert index.best_fit(make_job(cpus=16)) is None
+
+    index.add("b", cpus=-2)
+    assert index.free("b") == {"cpus": 0, "mem": 1000}
+    assert index.best_fit(make_job(cpus=1)) == "c"
+    index.remove("c")
+    assert "c" not in index and len(index) == 2
@@ -1,6 +1,30 @@
 # This file is part of pyqueue, a simple slurm like job queue written in python. pyqueue is licensed
 # under the GNU General Public License v3, see <https://www.gnu.org/licenses/>. Copyright 2022 Jonas Beck
 
+import multiprocessing
+import pickle
+import threading
+import time
+
+from pyqueue.daemon import CtlDaemon
+from pyqueue.jobs import BashJob, CallableJob
+from pyqueue.utils import try_unpickle, wait_until
+from pyqueue.worker import PoolWorker, Worker
+
+
+class DownDaemon:
+    """Proxy of a daemon that refuses connections while `down` is set."""
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.down = threading.Event()
+
+    def __getattr__(self, name):
+        if self.down.is_set():
+            raise ConnectionRefusedError(name)
+        return getattr(self.daemon, name)
+
+
 # test all worker scenarios
 # def test_update_worker_status():
 #     server = CtlDaemon()
@@ -17,4 +41,212 @@
 # def test_worker_server_interaction():
 #     test kill worker
 #     test status checks worker
-#     test registering and unregistering worker
\ No newline at end of file
+#     test registering and unregistering worker
+
+
+def test_worker_slots(tmp_path):
+    daemon = CtlDaemon()
+    worker = Worker(slots=2, cpus=2)
+    worker.register_with_queue_server(daemon)
+    jobs = [BashJob("sleep 0.2", output_dir=tmp_path) for _ in range(3)]
+    for job in jobs:
+        daemon.submit_job(job)
+
+    while worker.has_free_slot():
+        worker.run_job(try_unpickle(daemon.try_acquire_job()))
+    assert daemon.get_num_running_jobs() == 2, "both slots should run a job"
+    assert daemon.get_num_pending_jobs() == 1
+    slots = daemon.workers[worker.id]["slots"]
+    assert sorted(slots) == sorted(job.id for job in jobs[:2])
+    assert daemon.check_busy(worker.id)
+
+    worker.reap_jobs(block=True)
+    worker.reap_jobs(block=True)
+    assert daemon.queue.count("finished") == 2
+    assert daemon.workers[worker.id]["slots"] == [None, None]
+    assert not daemon.check_busy(worker.id)
+
+
+def test_worker_reports_exit_codes(tmp_path):
+    daemon = CtlDaemon()
+    worker = Worker(slots=2, cpus=2)
+    worker.register_with_queue_server(daemon)
+    ok, failed = BashJob("true", output_dir=tmp_path), BashJob(
+        "exit 3", output_dir=tmp_path
+    )
+    daemon.submit_jobs([ok, failed])
+
+    # finished jobs are collected in the background
+    threading.Thread(target=worker._reap_forever, daemon=True).start()
+    worker.run_job(try_unpickle(daemon.try_acquire_job()))
+    worker.run_job(try_unpickle(daemon.try_acquire_job()))
+    assert wait_until(lambda: daemon.queue.count("failed") == 1, timeout=5)
+    assert wait_until(lambda: daemon.queue.count("finished") == 1, timeout=5)
+    assert daemon.queue.get_job(ok.id)._exit == 0
+    assert daemon.queue.get_job(failed.id)._exit == 3
+    assert daemon.queue.get_job(failed.id)._end_time is not None
+
+
+def test_worker_cancels_jobs_on_heartbeat(tmp_path):
+    daemon = CtlDaemon()
+    worker = Worker(slots=1, cpus=1)
+    worker.register_with_queue_server(daemon)
+    assert worker.id.endswith(f":{worker.pid}")
+    assert daemon.workers[worker.id]["host"] == worker.host
+    job = BashJob("sleep 10", output_dir=tmp_path)
+    daemon.submit_job(job)
+    worker.run_job(try_unpickle(daemon.try_acquire_job(worker_id=worker.id)))
+    assert daemon.check_alive(job.id)
+
+    # the job may run on another host, so the worker kills it
+    daemon.scancel(job.id)
+    assert daemon.workers[worker.id]["slots"] == [None]
+    orders = daemon.heartbeat(worker.id)
+    assert orders["cancel"] == [job.id] and not orders["stop"]
+    worker.cancel_jobs(orders["cancel"])
+    worker.reap_jobs(block=True)
+    assert not worker.jobs and daemon.heartbeat(worker.id)["cancel"] == []
+
+
+def test_worker_survives_a_daemon_that_is_down(tmp_path, monkeypatch):
+    monkeypatch.setattr("pyqueue.worker.MAX_BACKOFF", 0.1)
+    daemon = CtlDaemon()
+    proxy = DownDaemon(daemon)
+    down = proxy.down
+    worker = Worker(heartbeat_interval=0.05)
+    worker.register_with_queue_server(proxy)
+    job = BashJob("exit 3", output_dir=tmp_path)
+    daemon.submit_job(job)
+    worker.run_job(try_unpickle(daemon.try_acquire_job(worker_id=worker.id)))
+    down.set()
+    threading.Thread(target=worker._reap_forever, daemon=True).start()
+    threading.Thread(target=worker._heartbeat_forever, daemon=True).start()
+    assert wait_until(lambda: worker._exited, timeout=5), "the job was reaped"
+    time.sleep(0.2)
+
+    # the exit code is reported once the daemon is up again
+    down.clear()
+    assert wait_until(lambda: daemon.queue.count("failed") == 1, timeout=5)
+    assert daemon.queue.get_job(job.id)._exit == 3 and not worker.jobs
+
+    # the worker registers again, if its lease expired in the meantime
+    daemon.deregister_worker(worker.id)
+    assert wait_until(lambda: worker.id in daemon.workers, timeout=5)
+
+    # while the daemon is down, heartbeats are retried at a short interval, so
+    # the worker registers with a restarted daemon before its lease expires
+    monkeypatch.setattr("pyqueue.worker.RETRY_INTERVAL", 0.05)
+    monkeypatch.setattr("pyqueue.worker.MAX_BACKOFF", 30)
+    down.set()
+    time.sleep(0.2)
+    worker.heartbeat_interval = 60
+    daemon.deregister_worker(worker.id)
+    down.clear()
+    assert wait_until(lambda: worker.id in daemon.workers, timeout=5)
+
+
+def test_pool_worker(tmp_path):
+    daemon = CtlDaemon()
+    worker = PoolWorker(slots=2, cpus=2, preload=["json"])
+    worker.register_with_queue_server(daemon)
+    jobs = [CallableJob(pow, (2, i)) for i in range(10)]
+    jobs += [CallableJob(divmod, (1, 0)), BashJob("exit 3", output_dir=tmp_path)]
+    daemon.submit_jobs(jobs)
+
+    threading.Thread(target=worker._reap_forever, daemon=True).start()
+    try:
+        while daemon.get_num_pending_jobs() > 0:
+            with worker._jobs_changed:
+                worker._jobs_changed.wait_for(worker.has_free_slot)
+            worker.run_job(try_unpickle(daemon.try_acquire_job(worker_id=worker.id)))
+        assert wait_until(lambda: daemon.queue.count("finished") == 10, timeout=5)
+        assert wait_until(lambda: daemon.queue.count("failed") == 2, timeout=5)
+    finally:
+        worker.close()
+    results = [pickle.loads(daemon.get_result(job.id)) for job in jobs[:10]]
+    assert results == [2**i for i in range(10)]
+    assert daemon.get_result_info(jobs[10].id) is None
+    assert daemon.queue.get_job(jobs[11].id)._exit == 3, "bash jobs are forked"
+
+
+def test_worker_reports_the_start_once_the_daemon_is_up(tmp_path, monkeypatch):
+    monkeypatch.setattr("pyqueue.worker.MAX_BACKOFF", 0.1)
+    daemon = CtlDaemon()
+    proxy = DownDaemon(daemon)
+    worker = Worker()
+    worker.register_with_queue_server(proxy)
+    job = BashJob("sleep 1", output_dir=tmp_path)
+    daemon.submit_job(job)
+
+    proxy.down.set()
+    threading.Timer(0.3, proxy.down.clear).start()
+    worker.run_job(try_unpickle(daemon.try_acquire_job(worker_id=worker.id)))
+    assert daemon.queue.get_job(job.id).status == "running"
+    worker.reap_jobs(block=True)
+    assert daemon.queue.get_job(job.id).status == "finished"
+
+
+def test_pool_worker_survives_a_daemon_that_is_down(monkeypatch):
+    monkeypatch.setattr("pyqueue.worker.MAX_BACKOFF", 0.1)
+    daemon = CtlDaemon()
+    proxy = DownDaemon(daemon)
+    worker = PoolWorker(slots=1, cpus=1)
+    worker.register_with_queue_server(proxy)
+    jobs = [CallableJob(pow, (2, i)) for i in range(2)]
+    daemon.submit_jobs(jobs)
+
+    try:
+        worker.run_job(try_unpickle(daemon.try_acquire_job(worker_id=worker.id)))
+        proxy.down.set()
+        assert wait_until(lambda: worker._exited, timeout=5), "the job has ended"
+
+        # the result is reported once the daemon is up again
+        threading.Thread(target=worker._reap_forever, daemon=True).start()
+        proxy.down.clear()
+        assert wait_until(lambda: daemon.queue.count("finished") == 1, timeout=5)
+        assert pickle.loads(daemon.get_result(jobs[0].id)) == 1
+        assert not worker._results
+
+        # ... and the pool still runs jobs
+        worker.run_job(try_unpickle(daemon.try_acquire_job(worker_id=worker.id)))
+        assert wait_until(lambda: daemon.queue.count("finished") == 2, timeout=5)
+    finally:
+        worker.close()
+
+
+def test_worker_only_reaps_its_jobs(tmp_path):
+    daemon = CtlDaemon()
+    worker = Worker(slots=1, cpus=1)
+    worker.register_with_queue_server(daemon)
+    daemon.submit_job(BashJob("sleep 0.3", output_dir=tmp_path))
+    worker.run_job(try_unpickle(daemon.try_acquire_job(worker_id=worker.id)))
+
+    # other children, i.e. the processes of a pool, are left to their parent
+    other = multiprocessing.Process(target=time.sleep, args=(0,))
+    other.start()
+    worker.reap_jobs(block=True)
+    assert daemon.queue.count("finished") == 1
+    other.join(5)
+    assert other.exitcode == 0
+
+
+def test_worker_uploads_results(tmp_path, monkeypatch):
+    monkeypatch.setattr("pyqueue.worker.CHUNK_SIZE", 4)
+    monkeypatch.setattr("pyqueue.daemon.CHUNK_SIZE", 4)
+    daemon = CtlDaemon(result_dir=tmp_path / "results")
+    worker = Worker(slots=2, cpus=2)
+    worker.register_with_queue_server(daemon)
+    bash, func = BashJob("echo hello world", output_dir=tmp_path), CallableJob(
+        str.upper, ("abc",)
+    )
+    daemon.submit_jobs([bash, func])
+
+    for _ in range(2):
+        worker.run_job(try_unpickle(daemon.try_acquire_job(worker_id=worker.id)))
+    worker.reap_jobs(block=True)
+    worker.reap_jobs(block=True)
+    assert daemon.get_result_info(bash.id) == {"chunks": 3, "type": "BashJob"}
+    chunks = [daemon.get_result(bash.id, i) for i in range(4)]
+    assert chunks == [b"hell", b"o wo", b"rld\n", b""]
+    result = b"".join(daemon.get_result(func.id, i) for i in range(10))
+    assert pickle.loads(result) == "ABC"